@@ -1,15 +1,24 @@
 # annotate_images.py
 import os
-import csv
+import time
 import argparse
 import numpy as np
 from PIL import Image
 import supervision as sv
 from supervision.draw.utils import draw_text
 import re
+from concurrent.futures import ProcessPoolExecutor
+from image_loader import (iter_decoded_images, iter_reduced_images, load_reduced_image, load_rgb_image,
+                          read_image_list, DecodeStats)
+from record_store import load_records
+from crop_store import CropStore, CROP_STORE_DIR
+import profiling
 
 # --- CONFIGURATION ---
 CLF_CONF_THRES = 0.8 # Confidence threshold for species prediction
+VISUALIZE_WORKERS = 1 # Number of processes drawing, cropping and encoding images
+ANNOTATE_MAX_SIDE = None # Longest side of the rendered annotated images and crops (None keeps full resolution)
+PRERENDER = False # Also draw and save an annotated copy of every non-empty image (otherwise render_service.py draws them on request)
 # ---------------------
 
 # MegaDetector Class Lookup
@@ -20,129 +29,322 @@ MD_CLASS_NAME_LUT = {
 }
 # -----------------------------------------------------------------
 
-def load_csv_data(csv_path):
-    """Loads all records from the CSV file."""
-    with open(csv_path, 'r', newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        return list(reader)
+# Annotators and output directories of the current process, set once by init_worker
+_WORKER_STATE = {}
 
-def process_visual_outputs(input_dir, input_csv_path, annotated_output_dir, crop_output_dir):
-    """Annotates images and performs cropping based on CSV data."""
+def make_annotators():
+    """Returns the (box, label) annotators every annotated image is drawn with."""
+    box_annotator = sv.BoxAnnotator(
+        thickness=4, 
+    )
+    label_annotator = sv.LabelAnnotator(
+        text_position=sv.Position.TOP_LEFT, 
+        text_scale=1.2,
+        text_thickness=2
+    )
+    return box_annotator, label_annotator
+
+def init_worker(input_dir, annotated_output_dir, crop_output_dir, max_side=ANNOTATE_MAX_SIDE,
+                prerender=PRERENDER, crop_store_dir=None):
+    """Creates the annotators (and opens the crop store) once per worker process instead of once per image."""
+    box_annotator, label_annotator = make_annotators()
+    _WORKER_STATE.update(
+        input_dir=input_dir,
+        max_side=max_side,
+        prerender=prerender,
+        crop_store=CropStore(crop_store_dir) if crop_store_dir else None,
+        annotated_output_dir=annotated_output_dir,
+        crop_output_dir=crop_output_dir,
+        box_annotator=box_annotator,
+        label_annotator=label_annotator
+    )
+
+def crop_folder_name(record):
+    """Returns the sanitized species folder an animal crop is saved under."""
+    species = record.get('Predicted_Species', '')
+    clf_conf = float(record.get('Classification_Confidence', 0.0) or 0.0)
+
+    # Determine the folder name
+    if species and clf_conf > CLF_CONF_THRES:
+        folder_name = species
+    else:
+        folder_name = 'unknown' 
+
+    # Sanitize folder name
+    return re.sub(r'\W+', '_', folder_name).strip('_').lower()
+
+def fit_image(image, scale, max_side):
+    """Shrinks an RGB array so its longest side is at most max_side, returning (image, scale) with the scale updated."""
+    height, width = image.shape[:2]
+    if not max_side or max(width, height) <= max_side:
+        return image, scale
+    img = Image.fromarray(image)
+    img.thumbnail((max_side, max_side), Image.BILINEAR)
+    return np.array(img), (scale[0] * width / img.size[0], scale[1] * height / img.size[1])
+
+def load_output_image(img_path, max_side=None):
+    """Decodes an image for rendering at no more than max_side pixels, returning (image, scale)."""
+    if not max_side:
+        return load_rgb_image(img_path), (1.0, 1.0)
+    image, scale = load_reduced_image(img_path, min_side=max_side)
+    return fit_image(image, scale, max_side)
+
+def scaled_box(record, scale):
+    """Returns a record's box in the pixels of an image decoded at scale (image pixels -> logged coordinates)."""
+    return [round(record['X_min'] / scale[0]), round(record['Y_min'] / scale[1]),
+            round(record['X_max'] / scale[0]), round(record['Y_max'] / scale[1])]
+
+def detection_label(record):
+    """Returns the label drawn next to a detection's box."""
+    md_class = int(record['MD_Class_ID'])
+    species = record.get('Predicted_Species', '')
+    clf_conf = float(record.get('Classification_Confidence', 0.0) or 0.0)
+
+    if md_class == 0 and species and clf_conf > CLF_CONF_THRES:
+        return f"{species} {clf_conf:.2f}"
+    elif md_class == 0 and species:
+        # Use the first word of the species name if confidence is low
+        return f"Unknown ({species.split()[0]}) {clf_conf:.2f}"
+    elif md_class == 0:
+        # Use the generic animal label for md_class 0 (animal/unknown)
+        return f"Animal {float(record['MD_Confidence']):.2f}"
+    else: # Person (1) or Vehicle (2)
+        return f"{MD_CLASS_NAME_LUT.get(md_class, 'Object')} {float(record['MD_Confidence']):.2f}"
+
+def draw_annotations(image, image_records, scale, box_annotator, label_annotator):
+    """
+    Draws the boxes and labels of an image's records onto a copy of image,
+    decoded at scale. Returns None if the image has no detections.
+    """
+    # Skip the 'empty' placeholder record (MD_Class_ID == -1)
+    drawn = [record for record in image_records if int(record['MD_Class_ID']) != -1]
+    if not drawn:
+        return None
+
+    detections = sv.Detections(
+        xyxy=np.array([scaled_box(record, scale) for record in drawn], dtype=int),
+        confidence=np.array([float(record.get('MD_Confidence', 0.0)) for record in drawn]),
+        class_id=np.array([int(record['MD_Class_ID']) for record in drawn])
+    )
+    
+    annotated_img = box_annotator.annotate(
+        scene=image.copy(),
+        detections=detections,
+    )
+    
+    return label_annotator.annotate(
+        scene=annotated_img,
+        detections=detections,
+        labels=[detection_label(record) for record in drawn]
+    )
+
+def render_image(task):
+    """
+    Crops (and with prerender, draws) and saves one image using the worker's annotators.
+
+    Takes (filename, image_records, image, scale, stored_crops) where image may
+    be None, in which case the worker decodes it itself, and scale maps image
+    pixels to the logged (original) coordinates. stored_crops, the image's
+    animal crops from the crop store in record order, are written without
+    decoding the image; without them and without prerender, the worker looks
+    them up in its own crop store. Returns
+    (filename, annotated, crop_counts, from_store) with crop_counts mapping
+    species folder -> number of crops written and from_store telling whether
+    the crops came from the crop store.
+    """
+    filename, image_records, input_img_np, scale, stored_crops = task
+    crop_output_dir = _WORKER_STATE['crop_output_dir']
+    prerender = _WORKER_STATE['prerender']
+    crop_store = _WORKER_STATE['crop_store']
+    animal_records = [record for record in image_records if int(record['MD_Class_ID']) == 0]
+
+    if (stored_crops is None and not prerender and input_img_np is None and crop_store is not None
+            and not _WORKER_STATE['max_side']):
+        stored_crops = crop_store.get_image_crops(_WORKER_STATE['input_dir'], filename, animal_records)
+
+    if stored_crops is None and input_img_np is None:
+        try:
+            input_img_np, scale = load_output_image(os.path.join(_WORKER_STATE['input_dir'], filename),
+                                                    _WORKER_STATE['max_side'])
+        except FileNotFoundError:
+            return filename, False, {}, False
+    elif stored_crops is None:
+        input_img_np, scale = fit_image(input_img_np, scale, _WORKER_STATE['max_side'])
+
+    # Cropping Logic (species directories are created up front)
+    crop_counts = {}
+    for position, record in enumerate(animal_records):
+        safe_folder_name = crop_folder_name(record)
+        species_crop_dir = os.path.join(crop_output_dir, safe_folder_name)
+
+        if stored_crops is not None:
+            cropped_img = stored_crops[position]
+        else:
+            cropped_img = sv.crop_image(image=input_img_np, xyxy=np.array(scaled_box(record, scale), dtype=int))
+        crop_name = f"{os.path.splitext(filename)[0]}_crop_{record['Detection_Index']}.jpg"
+        
+        Image.fromarray(cropped_img).save(os.path.join(species_crop_dir, crop_name))
+        crop_counts[safe_folder_name] = crop_counts.get(safe_folder_name, 0) + 1
     
-    all_records = load_csv_data(input_csv_path)
+    # Annotation Logic (otherwise render_service.py draws the image when it is requested)
+    from_store = stored_crops is not None
+    if not prerender:
+        return filename, False, crop_counts, from_store
+    annotated_img = draw_annotations(input_img_np, image_records, scale,
+                                     _WORKER_STATE['box_annotator'], _WORKER_STATE['label_annotator'])
+    if annotated_img is None:
+        return filename, False, crop_counts, from_store
+    
+    Image.fromarray(annotated_img).save(os.path.join(_WORKER_STATE['annotated_output_dir'], filename))
+    return filename, True, crop_counts, from_store
+
+def timed_render(task):
+    """Runs render_image and also returns the seconds it took (top-level so the process pool can pickle it)."""
+    start = time.perf_counter()
+    return render_image(task), time.perf_counter() - start
+
+@profiling.timed_stage('visualize')
+def process_visual_outputs(input_dir, input_csv_path, annotated_output_dir, crop_output_dir,
+                           records=None, images=None, only_files=None, workers=VISUALIZE_WORKERS,
+                           max_side=ANNOTATE_MAX_SIDE, prerender=PRERENDER, crop_store=None):
+    """
+    Crops the animal detections by species and, with prerender, annotates images based on CSV data.
+
+    When called in-process, an in-memory record table and image table
+    (filename -> RGB array) can be passed in instead of re-reading the CSV
+    and re-decoding every image. If only_files is given, only those images
+    are rendered. With workers > 1 the images are sharded across a process
+    pool; each worker builds its annotators once and is sent filenames only,
+    so it decodes its own images (or reads their crops from the crop store)
+    rather than receiving pickled pixel arrays.
+    With max_side, the outputs are rendered at most max_side pixels on their
+    longest side, and JPEGs are decoded at a matching reduced DCT scale.
+
+    Annotated images are only drawn and saved with prerender; otherwise
+    render_service.py draws them from the log when they are requested. Without
+    prerender and with a CropStore filled by the classify step, images whose
+    full-resolution crops are all stored are not decoded at all.
+    """
+    
+    all_records = records if records is not None else load_records(input_csv_path)
     if not all_records:
         print("Error: Input CSV is empty or cannot be read.")
         return
 
-    os.makedirs(annotated_output_dir, exist_ok=True)
+    if prerender:
+        os.makedirs(annotated_output_dir, exist_ok=True)
     
     records_by_image = {}
     for record in all_records:
         records_by_image.setdefault(record['Image_Filename'], []).append(record)
-
-    processed_count = 0
+    if only_files is not None:
+        records_by_image = {filename: records_by_image[filename] for filename in only_files if filename in records_by_image}
     
-    for filename, records in records_by_image.items():
-        img_path = os.path.join(input_dir, filename)
-        
-        try:
-            input_img_np = np.array(Image.open(img_path).convert('RGB'))
-            annotated_img = input_img_np.copy()
-        except FileNotFoundError:
-            continue
+    # Only images with at least one detection are drawn or cropped
+    non_empty_images = [filename for filename, image_records in records_by_image.items()
+                        if any(int(record['MD_Class_ID']) != -1 for record in image_records)]
+    if not prerender:
+        # Nothing is drawn, so images without an animal have nothing to crop
+        non_empty_images = [filename for filename in non_empty_images
+                            if any(int(record['MD_Class_ID']) == 0 for record in records_by_image[filename])]
 
-        xyxy_list = []
-        label_list = []
-        
-        # Process Detections for Annotation and Cropping
-        for record in records:
-            md_class = int(record['MD_Class_ID'])
-            
-            # Skip if it's the 'empty' placeholder record (MD_Class_ID == -1)
-            if md_class == -1:
-                continue
+    # Images whose crops can be written straight from the crop store (filename -> crops).
+    # Pool workers look their images up in the store themselves.
+    use_store = not prerender and crop_store is not None and not max_side
+    stored_crops = {}
+    if use_store and workers <= 1:
+        with profiling.substep('crop_store'):
+            for filename in non_empty_images:
+                if images is not None and filename in images:
+                    continue
+                animal_records = [record for record in records_by_image[filename] if int(record['MD_Class_ID']) == 0]
+                crops = crop_store.get_image_crops(input_dir, filename, animal_records)
+                if crops is not None:
+                    stored_crops[filename] = crops
 
-            xyxy = [record['X_min'], record['Y_min'], record['X_max'], record['Y_max']]
-            xyxy_list.append(xyxy)
-            
-            species = record.get('Predicted_Species', '')
-            clf_conf = float(record.get('Classification_Confidence', 0.0))
-            
-            # Determine the annotation label
-            if md_class == 0 and species and clf_conf > CLF_CONF_THRES:
-                label = f"{species} {clf_conf:.2f}"
-            elif md_class == 0 and species:
-                # Use the first word of the species name if confidence is low
-                label = f"Unknown ({species.split()[0]}) {clf_conf:.2f}"
-            elif md_class == 0:
-                # Use the generic animal label for md_class 0 (animal/unknown)
-                label = f"Animal {float(record['MD_Confidence']):.2f}"
-            else: # Person (1) or Vehicle (2)
-                label = f"{MD_CLASS_NAME_LUT.get(md_class, 'Object')} {float(record['MD_Confidence']):.2f}"
-
-            label_list.append(label)
-
-            # Cropping Logic
-            if md_class == 0:
-                # Determine the folder name
-                if species and clf_conf > CLF_CONF_THRES:
-                    folder_name = species
-                else:
-                    folder_name = 'unknown' 
-
-                # Sanitize folder name
-                safe_folder_name = re.sub(r'\W+', '_', folder_name).strip('_').lower()
-                
-                species_crop_dir = os.path.join(crop_output_dir, safe_folder_name)
-                os.makedirs(species_crop_dir, exist_ok=True)
-
-                cropped_img = sv.crop_image(image=input_img_np, xyxy=np.array(xyxy, dtype=int))
-                crop_name = f"{os.path.splitext(filename)[0]}_crop_{record['Detection_Index']}.jpg"
-                
-                Image.fromarray(cropped_img).save(os.path.join(species_crop_dir, crop_name))
-        
-        # Annotation Logic
-        if xyxy_list:
-            detections = sv.Detections(
-                xyxy=np.array(xyxy_list, dtype=int),
-                confidence=np.array([float(r.get('MD_Confidence', 0.0)) for r in records if int(r['MD_Class_ID']) != -1]),
-                class_id=np.array([int(r['MD_Class_ID']) for r in records if int(r['MD_Class_ID']) != -1])
-            )
-            
-            box_annotator = sv.BoxAnnotator(
-                thickness=4, 
-            )
-            
-            label_annotator = sv.LabelAnnotator(
-                text_position=sv.Position.TOP_LEFT, 
-                text_scale=1.2,
-                text_thickness=2
-            )
-            
-            annotated_img = box_annotator.annotate(
-                scene=annotated_img,
-                detections=detections,
-            )
-            
-            annotated_img = label_annotator.annotate(
-                scene=annotated_img,
-                detections=detections,
-                labels=label_list
-            )
-            
-            Image.fromarray(annotated_img).save(os.path.join(annotated_output_dir, filename))
-            processed_count += 1
+    # Create every species crop directory once, before any worker writes to it
+    crop_folders = {crop_folder_name(record) for filename in non_empty_images
+                    for record in records_by_image[filename] if int(record['MD_Class_ID']) == 0}
+    for folder in crop_folders:
+        os.makedirs(os.path.join(crop_output_dir, folder), exist_ok=True)
+
+    if workers > 1:
+        # Workers get filenames only: they read stored crops from their own handle on the
+        # crop store and decode the rest themselves
+        tasks = [(filename, records_by_image[filename], None, (1.0, 1.0), None) for filename in non_empty_images]
+        store_dir = crop_store.store_dir if use_store and crop_store.has_full_resolution_crops() else None
+        with profiling.substep('render'):
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                     initargs=(input_dir, annotated_output_dir, crop_output_dir, max_side,
+                                               prerender, store_dir)) as executor:
+                timed_results = list(executor.map(timed_render, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+    else:
+        # The crops found above are passed on as they are; the other images are decoded in
+        # the background and all are rendered in input order
+        init_worker(input_dir, annotated_output_dir, crop_output_dir, max_side, prerender)
+        to_decode = [filename for filename in non_empty_images if filename not in stored_crops]
+        decode_stats = DecodeStats()
+        if max_side:
+            decoded = iter_reduced_images(input_dir, to_decode, min_side=max_side, images=images, stats=decode_stats)
+        else:
+            decoded = ((filename, img, (1.0, 1.0), error) for filename, img, error in
+                       iter_decoded_images(input_dir, to_decode, images=images))
+        decoded = profiling.timed_iter(decoded, 'decode')
+        timed_results = []
+        for filename in non_empty_images:
+            if filename in stored_crops:
+                task = (filename, records_by_image[filename], None, (1.0, 1.0), stored_crops[filename])
+            else:
+                _, input_img_np, scale, error = next(decoded)
+                if isinstance(error, FileNotFoundError):
+                    continue
+                elif error is not None:
+                    raise error
+                task = (filename, records_by_image[filename], input_img_np, scale, None)
+            timed_results.append(timed_render(task))
+            profiling.add_substep_time('render', timed_results[-1][1])
+        decode_stats.report()
+    results = [result for result, _ in timed_results]
+    profiling.add_latencies([seconds for _, seconds in timed_results])
+
+    # Ordered summary (results come back in input order)
+    processed_count = sum(1 for _, annotated, _, _ in results if annotated)
+    stored_count = sum(1 for _, _, _, from_store in results if from_store)
+    crop_totals = {}
+    for _, _, crop_counts, _ in results:
+        for folder, count in crop_counts.items():
+            crop_totals[folder] = crop_totals.get(folder, 0) + count
             
     print(f"\n--- Visual Outputs Complete ---")
-    print(f"Annotated {processed_count} images in: {annotated_output_dir}")
+    if prerender:
+        print(f"Annotated {processed_count} images in: {annotated_output_dir}")
+    else:
+        print(f"Annotated images are drawn on request (render_service.py); {stored_count} images were cropped from the crop store without decoding.")
     print(f"Cropped images organized into species subfolders inside: {crop_output_dir}")
+    for folder in sorted(crop_totals):
+        print(f"  {folder}: {crop_totals[folder]} crops")
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Node 4 & 5: Creates annotated images and cropped images using the classified CSV data.")
+    parser = argparse.ArgumentParser(description="Node 4 & 5: Creates cropped images (and optionally annotated images) using the classified CSV data.")
     parser.add_argument("input_dir", type=str, help="Directory containing source images.")
     parser.add_argument("input_csv_path", type=str, help="Path to the Master Detection CSV file (should be classified).")
-    parser.add_argument("annotated_output_dir", type=str, help="Directory to save images with boundary boxes and labels.")
+    parser.add_argument("annotated_output_dir", type=str, help="Directory to save images with boundary boxes and labels (with --prerender).")
     parser.add_argument("crop_output_dir", type=str, help="Directory to save cropped images (will contain species subfolders).")
+    parser.add_argument("--images-from", type=str, default=None,
+                        help="File listing the image filenames to process (one per line).")
+    parser.add_argument("--workers", type=int, default=VISUALIZE_WORKERS,
+                        help=f"Number of worker processes; images are sharded across them. (Default: {VISUALIZE_WORKERS})")
+    parser.add_argument("--max-side", type=int, default=ANNOTATE_MAX_SIDE,
+                        help="Render the annotated images and crops at most this many pixels on the longest side (default: full resolution).")
+    parser.add_argument("--prerender", action="store_true", default=PRERENDER,
+                        help="Also draw and save an annotated copy of every non-empty image now, instead of on request.")
+    parser.add_argument("--crop-store", type=str, default=CROP_STORE_DIR,
+                        help="Directory of the crop store filled by classify; stored crops are written without decoding.")
     args = parser.parse_args()
-    process_visual_outputs(args.input_dir, args.input_csv_path, args.annotated_output_dir, args.crop_output_dir)
\ No newline at end of file
+    crop_store = CropStore(args.crop_store) if args.crop_store else None
+    with profiling.profile_run():
+        process_visual_outputs(args.input_dir, args.input_csv_path, args.annotated_output_dir, args.crop_output_dir,
+                               only_files=read_image_list(args.images_from) if args.images_from else None,
+                               workers=args.workers, max_side=args.max_side, prerender=args.prerender,
+                               crop_store=crop_store)
\ No newline at end of file
@@ -0,0 +1,5 @@
+# backend_names.py
+# Inference backends each model can run on (implemented in inference_backend.py). They live
+# apart from it so run_pipeline.py can offer them without importing PyTorch.
+DETECTOR_BACKENDS = ['eager', 'torchscript', 'compile', 'onnx']
+CLASSIFIER_BACKENDS = ['eager', 'int8', 'torchscript', 'compile', 'onnx']
\ No newline at end of file
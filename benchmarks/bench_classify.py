@@ -0,0 +1,75 @@
+# benchmarks/bench_classify.py
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import supervision as sv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classify_data import load_classification_model, classify_crop_batch
+from record_store import load_records
+from image_loader import load_rgb_image
+
+def collect_crops(input_dir, input_csv_path, limit):
+    """Crops every animal detection (MD_Class_ID == 0) in the CSV, up to `limit` crops."""
+    crops = []
+    images = {}
+    for record in load_records(input_csv_path):
+        if int(record['MD_Class_ID']) != 0:
+            continue
+        filename = record['Image_Filename']
+        if filename not in images:
+            images[filename] = load_rgb_image(os.path.join(input_dir, filename))
+        xyxy = np.array([record['X_min'], record['Y_min'], record['X_max'], record['Y_max']], dtype=int)
+        crops.append(sv.crop_image(image=images[filename], xyxy=xyxy))
+        if len(crops) >= limit:
+            break
+    return crops
+
+def benchmark_classification(classification_model, crops, batch_sizes, repeats=3):
+    """Times the per-crop path and the batched path, returning crops/sec for each."""
+    results = {}
+
+    def best_rate(run):
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - start)
+        return len(crops) / best
+
+    results['per_crop'] = best_rate(
+        lambda: [classification_model.single_image_classification(crop) for crop in crops])
+
+    for batch_size in batch_sizes:
+        results[f'batch_{batch_size}'] = best_rate(
+            lambda: [classify_crop_batch(classification_model, crops[i:i + batch_size])
+                     for i in range(0, len(crops), batch_size)])
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compares per-crop and batched classification throughput (crops/sec).")
+    parser.add_argument("input_dir", type=str, help="Directory containing input images.")
+    parser.add_argument("input_csv_path", type=str, help="Master Detection CSV with animal detections.")
+    parser.add_argument("--batch-sizes", type=int, nargs='+', default=[8, 16, 32, 64],
+                        help="Batch sizes to compare against the per-crop path.")
+    parser.add_argument("--limit", type=int, default=256, help="Maximum number of crops to benchmark.")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed repetitions per configuration (best is kept).")
+    args = parser.parse_args()
+
+    crops = collect_crops(args.input_dir, args.input_csv_path, args.limit)
+    if not crops:
+        print("Error: No animal detections found in the CSV.")
+        sys.exit(1)
+
+    model = load_classification_model()
+    # Warm-up so lazy initialization is not timed
+    classify_crop_batch(model, crops[:1])
+
+    results = benchmark_classification(model, crops, args.batch_sizes, args.repeats)
+
+    print(f"\n--- Classification Benchmark ({len(crops)} crops) ---")
+    for name, rate in results.items():
+        print(f"{name:>10}: {rate:8.2f} crops/sec ({rate / results['per_crop']:.2f}x)")
\ No newline at end of file
@@ -0,0 +1,47 @@
+# benchmarks/bench_decode.py
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_loader import list_images, load_rgb_image, load_reduced_image, JPEG_REDUCTIONS, TURBOJPEG
+
+def benchmark_decode(input_dir, filenames, repeats=3):
+    """Times full-resolution decoding against each reduced JPEG scale, returning ms/image and MB per buffer."""
+    paths = [os.path.join(input_dir, filename) for filename in filenames]
+    results = {}
+
+    def best_time(decode):
+        best, buffer_bytes = float('inf'), 0
+        for _ in range(repeats):
+            start = time.perf_counter()
+            buffer_bytes = sum(decode(path).nbytes for path in paths)
+            best = min(best, time.perf_counter() - start)
+        return {'ms_per_image': round(1000 * best / len(paths), 2),
+                'mb_per_image': round(buffer_bytes / len(paths) / 2**20, 2)}
+
+    results['full'] = best_time(load_rgb_image)
+    for reduction in sorted(JPEG_REDUCTIONS):
+        results[f'1/{reduction}'] = best_time(
+            lambda path: load_reduced_image(path, max_reduction=reduction)[0])
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compares full-resolution JPEG decoding with the reduced DCT scales (ms/image and buffer size).")
+    parser.add_argument("input_dir", type=str, help="Directory containing input images.")
+    parser.add_argument("--limit", type=int, default=100, help="Maximum number of images to decode.")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed repetitions per scale (best is kept).")
+    args = parser.parse_args()
+
+    filenames = sorted(list_images(args.input_dir))[:args.limit]
+    if not filenames:
+        sys.exit(f"Error: No images found in {args.input_dir}")
+
+    results = benchmark_decode(args.input_dir, filenames, args.repeats)
+    print(f"--- Decode Benchmark: {len(filenames)} images, backend {'turbojpeg' if TURBOJPEG else 'PIL draft'} ---")
+    full = results['full']
+    for name, result in results.items():
+        print(f"{name:>6}: {result['ms_per_image']:8.2f} ms/image ({full['ms_per_image'] / result['ms_per_image']:.1f}x) | "
+              f"{result['mb_per_image']:6.2f} MB per RGB buffer")
\ No newline at end of file
@@ -0,0 +1,61 @@
+# benchmarks/bench_record_store.py
+import os
+import sys
+import csv
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from record_store import MASTER_FIELD_ORDER, load_records, save_records, pq
+from fixtures import make_records
+
+def legacy_csv_roundtrip(records, path):
+    """The pre-record_store path: DictWriter out, DictReader in, numbers re-parsed by hand."""
+    start = time.perf_counter()
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=MASTER_FIELD_ORDER)
+        writer.writeheader()
+        writer.writerows(records)
+    save_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with open(path, 'r', newline='') as csvfile:
+        rows = list(csv.DictReader(csvfile))
+    for row in rows:
+        int(row['MD_Class_ID']), float(row['MD_Confidence'])
+        int(row['X_min']), int(row['Y_min']), int(row['X_max']), int(row['Y_max'])
+    load_time = time.perf_counter() - start
+    return save_time, load_time
+
+def store_roundtrip(records, path):
+    """Saves and loads through record_store, returning both timings."""
+    start = time.perf_counter()
+    save_records(records, path)
+    save_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    load_records(path)
+    load_time = time.perf_counter() - start
+    return save_time, load_time
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks detection log load/save throughput for each record_store backend.")
+    parser.add_argument("--rows", type=int, default=100000, help="Number of synthetic detection records.")
+    args = parser.parse_args()
+
+    records = make_records(args.rows)
+    print(f"--- Record Store Benchmark ({args.rows} rows) ---")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = {'legacy csv': legacy_csv_roundtrip(records, os.path.join(tmp_dir, 'legacy.csv'))}
+        for name in ['csv', 'npz'] + (['parquet'] if pq is not None else []):
+            path = os.path.join(tmp_dir, f'log.{name}')
+            results[f'{name}'] = store_roundtrip(records, path)
+            results[f'{name}'] += (os.path.getsize(path),)
+
+    for name, timings in results.items():
+        save_time, load_time = timings[:2]
+        size = f"{timings[2] / (1024 * 1024):7.1f} MB" if len(timings) > 2 else ''
+        print(f"{name:>12}: save {args.rows / save_time:10.0f} rows/sec | load {args.rows / load_time:10.0f} rows/sec {size}")
\ No newline at end of file
@@ -0,0 +1,84 @@
+# benchmarks/fixtures.py
+import os
+import random
+import numpy as np
+from PIL import Image
+
+# --- CONFIGURATION ---
+FIXTURE_IMAGE_SIZE = (2048, 1536) # Same frame size as the Snapshot Serengeti cameras
+FIXTURE_JPEG_QUALITY = 85
+EXIF_IFD_POINTER = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+# ---------------------
+
+# Named log scales (rows) used by run_benchmarks.py --scale
+SCALES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+
+SPECIES = ['zebra', 'wildebeest', 'gazellethomsons', 'buffalo', 'elephant', 'impala', 'empty']
+
+def fixture_filename(index, rng):
+    """Builds a camera-trap style filename (site, roll, frame number)."""
+    return f"S5_B{rng.randrange(1, 13):02d}_R{rng.randrange(1, 4)}_IMAG{index:06d}.jpg"
+
+def make_records(count, seed=0):
+    """Builds `count` synthetic detection records with realistic field values, grouped by image."""
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        # Three detection rows per image, kept contiguous as the pipeline writes them
+        if i % 3 == 0:
+            filename = fixture_filename(i // 3, rng)
+        species = rng.choice(SPECIES)
+        x_min, y_min = rng.randrange(0, 1800), rng.randrange(0, 1300)
+        records.append({
+            'Image_Filename': filename,
+            'Detection_Index': i % 3,
+            'Image_Width': 2048, 'Image_Height': 1536,
+            'Timestamp': f"2012:06:{rng.randrange(1, 29):02d} {rng.randrange(24):02d}:{rng.randrange(60):02d}:00",
+            'MD_Class_ID': -1 if species == 'empty' else rng.choice([0, 0, 0, 1, 2]),
+            'MD_Confidence': round(rng.random(), 4),
+            'X_min': x_min, 'Y_min': y_min,
+            'X_max': x_min + rng.randrange(20, 240), 'Y_max': y_min + rng.randrange(20, 230),
+            'Predicted_Species': species,
+            'Classification_Confidence': round(rng.random(), 4)
+        })
+    return records
+
+def make_jpeg(path, rng, size=FIXTURE_IMAGE_SIZE, quality=FIXTURE_JPEG_QUALITY):
+    """
+    Writes one synthetic camera-trap frame: a smooth noisy background with a few
+    darker blobs, plus an EXIF DateTimeOriginal tag, so decode and header costs
+    are close to those of real captures.
+    """
+    width, height = size
+    # Upsampled low-resolution noise compresses like natural scenery
+    low = np.asarray(rng.integers(60, 200, size=(height // 32, width // 32, 3)), dtype=np.uint8)
+    img = np.asarray(Image.fromarray(low).resize((width, height), Image.BILINEAR)).copy()
+    img = np.clip(img.astype(np.int16) + rng.integers(-12, 12, size=img.shape), 0, 255).astype(np.uint8)
+    for _ in range(int(rng.integers(0, 4))):
+        x, y = int(rng.integers(0, width - 300)), int(rng.integers(0, height - 300))
+        w, h = int(rng.integers(60, 300)), int(rng.integers(60, 300))
+        img[y:y + h, x:x + w] //= 3
+
+    exif = Image.Exif()
+    exif.get_ifd(EXIF_IFD_POINTER)[EXIF_DATETIME_ORIGINAL] = \
+        f"2012:06:{int(rng.integers(1, 29)):02d} {int(rng.integers(24)):02d}:{int(rng.integers(60)):02d}:00"
+    Image.fromarray(img).save(path, quality=quality, exif=exif)
+
+def make_image_fixture(out_dir, count, seed=0, size=FIXTURE_IMAGE_SIZE):
+    """
+    Fills out_dir with `count` synthetic JPEGs and returns their filenames.
+
+    Existing files are reused, so a fixture directory can be kept between runs.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    name_rng = random.Random(seed)
+    pixel_rng = np.random.default_rng(seed)
+    filenames = []
+    for i in range(count):
+        filename = fixture_filename(i, name_rng)
+        path = os.path.join(out_dir, filename)
+        if not os.path.exists(path):
+            make_jpeg(path, pixel_rng, size=size)
+        filenames.append(filename)
+    return filenames
\ No newline at end of file
@@ -0,0 +1,224 @@
+# benchmarks/run_benchmarks.py
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import profiling
+from record_store import MASTER_FIELD_ORDER, load_records, save_records
+from fixtures import SCALES, make_image_fixture, make_records
+from stub_models import StubDetector, StubClassifier, STUB_LATENCY_MS
+
+# --- CONFIGURATION ---
+DEFAULT_SCALE = '1k'
+DEFAULT_IMAGES = 200 # Synthetic JPEGs for the image stages
+DEFAULT_REPEATS = 3 # Timed repetitions per benchmark; the fastest is reported
+# ---------------------
+
+FIELD_ORDER_STRING = ",".join(MASTER_FIELD_ORDER)
+IMAGE_STAGES = ['detect', 'metadata', 'classify', 'sort', 'visualize']
+LOG_STAGES = ['json', 'log_save', 'log_load']
+BENCHMARKS = IMAGE_STAGES + LOG_STAGES + ['end_to_end']
+
+def git_revision():
+    """Returns the current commit hash, or None outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def time_best(run, repeats, items, setup=None):
+    """
+    Runs `run` repeats times (after `setup` each time) and reports the fastest
+    run, with the profiler's substeps from that run.
+    """
+    best = None
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        profiling.PROFILER.stages.clear()
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best['seconds']:
+            best = {'seconds': round(elapsed, 4), 'items': items,
+                    'items_per_sec': round(items / elapsed, 2) if elapsed else None,
+                    'stages': profiling.PROFILER.summary()}
+    best['peak_rss_mb'] = profiling.peak_rss_mb()
+    return best
+
+def fresh_copy(src_path, dst_path):
+    """Returns a setup callback restoring dst_path from src_path, so in-place stages start from the same log."""
+    return lambda: shutil.copyfile(src_path, dst_path)
+
+def run_image_stages(work_dir, image_dir, stages, repeats, latency_ms):
+    """
+    Times detect, metadata, classify, sort and visualize one at a time.
+
+    Each stage gets a fresh copy of the log written by the previous stage.
+    """
+    import detect_and_log
+    import extract_metadata
+    import classify_data
+    import sort_images
+    import annotate_images
+
+    detector, classifier = StubDetector(latency_ms), StubClassifier(latency_ms)
+    image_count = len(os.listdir(image_dir))
+    logs = {step: os.path.join(work_dir, f'log_{step}.csv') for step in IMAGE_STAGES}
+    stage_log = os.path.join(work_dir, 'stage.csv')
+    results = {}
+
+    def bench(step, run, input_log=None):
+        setup = fresh_copy(input_log, stage_log) if input_log else None
+        if step in stages:
+            results[step] = time_best(run, repeats, image_count, setup=setup)
+        else:
+            # Not benchmarked, but later stages need its output
+            if setup:
+                setup()
+            run()
+        if os.path.exists(stage_log):
+            shutil.copyfile(stage_log, logs[step])
+
+    bench('detect', lambda: detect_and_log.detect_and_create_csv(
+        image_dir, stage_log, FIELD_ORDER_STRING, detection_model=detector))
+    bench('metadata', lambda: extract_metadata.update_metadata(
+        image_dir, stage_log, FIELD_ORDER_STRING), input_log=logs['detect'])
+    bench('classify', lambda: classify_data.update_csv_data(
+        image_dir, stage_log, FIELD_ORDER_STRING, classification_model=classifier), input_log=logs['metadata'])
+    if 'sort' in stages:
+        bench('sort', lambda: sort_images.sort_images_by_detection(
+            image_dir, stage_log, os.path.join(work_dir, 'sorted')), input_log=logs['classify'])
+    if 'visualize' in stages:
+        bench('visualize', lambda: annotate_images.process_visual_outputs(
+            image_dir, stage_log, os.path.join(work_dir, 'annotated'), os.path.join(work_dir, 'crops'),
+            prerender=True), input_log=logs['classify'])
+    return results
+
+def run_log_stages(work_dir, rows, stages, repeats):
+    """Times the JSON export and the detection log save/load at the chosen row scale."""
+    import export_to_json
+
+    records = make_records(rows)
+    log_path = os.path.join(work_dir, 'scale_log.csv')
+    save_records(records, log_path)
+    results = {}
+    if 'json' in stages:
+        results['json'] = time_best(lambda: export_to_json.create_researcher_json(
+            log_path, os.path.join(work_dir, 'export.json')), repeats, rows)
+    if 'log_save' in stages:
+        results['log_save'] = time_best(lambda: save_records(records, os.path.join(work_dir, 'save.csv')),
+                                        repeats, rows)
+    if 'log_load' in stages:
+        results['log_load'] = time_best(lambda: load_records(log_path), repeats, rows)
+    return results
+
+def run_end_to_end(work_dir, image_dir, repeats, latency_ms, chunk_size):
+    """Times the whole pipeline through run_pipeline.run_in_process with the stub models."""
+    import run_pipeline
+
+    args = argparse.Namespace(
+        input_dir=image_dir, steps=list(run_pipeline.PIPELINE_STEPS),
+        csv=os.path.join(work_dir, 'e2e', 'log.csv'), json_output=os.path.join(work_dir, 'e2e', 'data.json'),
+        json_format='json', sorted=os.path.join(work_dir, 'e2e', 'sorted'),
+        annotated=os.path.join(work_dir, 'e2e', 'annotated'), crops=os.path.join(work_dir, 'e2e', 'crops'),
+        batch_size=run_pipeline.DEFAULT_BATCH_SIZE, clf_batch_size=run_pipeline.DEFAULT_CLF_BATCH_SIZE,
+        visualize_workers=run_pipeline.DEFAULT_VISUALIZE_WORKERS, loader_workers=run_pipeline.DEFAULT_LOADER_WORKERS,
+        prefetch_depth=run_pipeline.DEFAULT_PREFETCH_DEPTH, chunk_size=chunk_size,
+        link_mode=run_pipeline.DEFAULT_LINK_MODE, cache=None, cache_max_mb=run_pipeline.DEFAULT_CACHE_MAX_MB,
+        prefilter=False, prefilter_threshold=run_pipeline.DEFAULT_PREFILTER_THRESHOLD, per_event=False,
+        reduced_decode=False, annotate_max_side=None, detector_backend='eager', classifier_backend='eager',
+        crop_store=None, prerender_annotated=True)
+
+    def run():
+        with profiling.stage('pipeline'):
+            run_pipeline.run_in_process(args, detection_model=StubDetector(latency_ms),
+                                        classification_model=StubClassifier(latency_ms))
+
+    def setup():
+        shutil.rmtree(os.path.join(work_dir, 'e2e'), ignore_errors=True)
+        os.makedirs(os.path.join(work_dir, 'e2e'))
+
+    return time_best(run, repeats, len(os.listdir(image_dir)), setup=setup)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks each pipeline stage and the whole pipeline offline with synthetic fixtures and stub models.")
+    parser.add_argument("--scale", choices=list(SCALES), default=DEFAULT_SCALE,
+                        help=f"Rows in the synthetic log for the log-only benchmarks. (Default: {DEFAULT_SCALE})")
+    parser.add_argument("--images", type=int, default=DEFAULT_IMAGES,
+                        help=f"Synthetic JPEGs for the image stages. (Default: {DEFAULT_IMAGES})")
+    parser.add_argument("--benchmarks", nargs='+', choices=BENCHMARKS, default=BENCHMARKS,
+                        help="Benchmarks to run (default: all).")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS,
+                        help=f"Timed repetitions per benchmark; the fastest is kept. (Default: {DEFAULT_REPEATS})")
+    parser.add_argument("--stub-latency-ms", type=float, default=STUB_LATENCY_MS,
+                        help=f"Simulated model time per image/crop. (Default: {STUB_LATENCY_MS})")
+    parser.add_argument("--chunk-size", type=int, default=256, help="Chunk size for the end-to-end run. (Default: 256)")
+    parser.add_argument("--fixture-dir", type=str, default=None,
+                        help="Keep the synthetic JPEGs here and reuse them across runs (default: a temporary directory).")
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON to this path.")
+    parser.add_argument("--verbose", action="store_true", help="Show the stages' own progress output.")
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, 'w')
+
+    def stage_output():
+        """Silences the stages' progress prints unless --verbose is given."""
+        return contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull)
+
+    work_dir = tempfile.mkdtemp(prefix='wildlife_bench_')
+    image_dir = args.fixture_dir or os.path.join(work_dir, 'images')
+    rows = SCALES[args.scale]
+
+    report = {
+        'generated': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_revision': git_revision(),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count()},
+        'config': {'scale': args.scale, 'rows': rows, 'images': args.images, 'repeats': args.repeats,
+                   'stub_latency_ms': args.stub_latency_ms, 'chunk_size': args.chunk_size},
+        'results': {},
+    }
+
+    try:
+        image_benchmarks = [name for name in args.benchmarks if name in IMAGE_STAGES + ['end_to_end']]
+        if image_benchmarks:
+            print(f"Generating {args.images} synthetic JPEGs in {image_dir}...")
+            make_image_fixture(image_dir, args.images)
+        if any(name in IMAGE_STAGES for name in args.benchmarks):
+            print("Timing the image stages...")
+            with stage_output():
+                report['results'].update(run_image_stages(work_dir, image_dir, args.benchmarks, args.repeats,
+                                                          args.stub_latency_ms))
+        if any(name in LOG_STAGES for name in args.benchmarks):
+            print(f"Timing the log stages on a {rows}-row synthetic detection log...")
+            with stage_output():
+                report['results'].update(run_log_stages(work_dir, rows, args.benchmarks, args.repeats))
+        if 'end_to_end' in args.benchmarks:
+            print("Timing the whole pipeline (in-process)...")
+            with stage_output():
+                report['results']['end_to_end'] = run_end_to_end(work_dir, image_dir, args.repeats,
+                                                                 args.stub_latency_ms, args.chunk_size)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"\n--- Benchmark Results (scale {args.scale}, {args.images} images) ---")
+    for name, result in report['results'].items():
+        print(f"{name:>12}: {result['seconds']:8.3f}s | {result['items_per_sec']:>12} items/sec")
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f"Results written to: {args.output}")
\ No newline at end of file
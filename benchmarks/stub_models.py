@@ -0,0 +1,105 @@
+# benchmarks/stub_models.py
+import time
+import zlib
+from types import SimpleNamespace
+import numpy as np
+import torch
+from PIL import Image
+import supervision as sv
+
+# --- CONFIGURATION ---
+STUB_LATENCY_MS = 0.0 # Simulated model time per image or crop; 0 measures pure pipeline overhead
+STUB_EMPTY_RATE = 0.3 # Fraction of frames the stub detector reports as empty
+STUB_INPUT_SIZE = 32 # Side of the square tensors the stub classifier's transform produces
+# ---------------------
+
+STUB_SPECIES = ['zebra', 'wildebeest', 'gazellethomsons', 'buffalo', 'elephant', 'impala']
+
+def name_seed(name):
+    """Stable per-image seed, so stub outputs do not depend on processing order."""
+    return zlib.crc32(str(name).encode('utf-8'))
+
+class StubPredictor:
+    """Stands in for the Ultralytics predictor; one stream_inference call runs a whole batch."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.args = SimpleNamespace(batch=1, conf=0.2)
+
+    def stream_inference(self, images):
+        if self.latency:
+            time.sleep(self.latency * len(images))
+        for img in images:
+            yield {'shape': img.shape[:2], 'conf': self.args.conf}
+
+class StubDetector:
+    """
+    Offline stand-in for MegaDetectorV6.
+
+    Like the real model it has a predictor with stream_inference and a
+    results_generation, so detect_image_batch takes its batched path;
+    single_image_detection goes through the same code one image at a time.
+    It returns 0-3 deterministic boxes per image, keyed by filename.
+    """
+
+    def __init__(self, latency_ms=STUB_LATENCY_MS, empty_rate=STUB_EMPTY_RATE):
+        self.latency = latency_ms / 1000.0
+        self.empty_rate = empty_rate
+        self.predictor = StubPredictor(self.latency)
+
+    def single_image_detection(self, img, img_path=None, det_conf_thres=0.2):
+        self.predictor.args.conf = det_conf_thres
+        return self.results_generation(next(self.predictor.stream_inference([img])), img_path)
+
+    def results_generation(self, result, img_id):
+        det_conf_thres = result['conf']
+        rng = np.random.default_rng(name_seed(img_id))
+        height, width = result['shape']
+        count = 0 if rng.random() < self.empty_rate else int(rng.integers(1, 4))
+
+        x_min = rng.uniform(0, width * 0.8, count)
+        y_min = rng.uniform(0, height * 0.8, count)
+        xyxy = np.stack([x_min, y_min,
+                         np.minimum(x_min + rng.uniform(40, width * 0.2, count), width - 1),
+                         np.minimum(y_min + rng.uniform(40, height * 0.2, count), height - 1)], axis=1)
+        detections = sv.Detections(
+            xyxy=xyxy.reshape(-1, 4),
+            confidence=rng.uniform(det_conf_thres, 1.0, count),
+            class_id=rng.choice([0, 0, 0, 1, 2], count)
+        )
+        return {"img_id": img_id, "detections": detections, "labels": []}
+
+class StubClassifier:
+    """
+    Offline stand-in for the AI4G classifier.
+
+    Like the real model it has a transform, forward and results_generation,
+    so classify_crop_batch takes its batched path; single_image_classification
+    goes through the same code one crop at a time. The prediction depends
+    only on the crop's pixels.
+    """
+
+    def __init__(self, latency_ms=STUB_LATENCY_MS):
+        self.latency = latency_ms / 1000.0
+
+    def transform(self, img):
+        if 0 in img.size:
+            return torch.zeros(3, STUB_INPUT_SIZE, STUB_INPUT_SIZE)
+        resized = np.asarray(img.convert('RGB').resize((STUB_INPUT_SIZE, STUB_INPUT_SIZE), Image.BILINEAR))
+        return torch.from_numpy(resized.astype(np.float32)).permute(2, 0, 1)
+
+    def forward(self, batch):
+        if self.latency:
+            time.sleep(self.latency * len(batch))
+        return batch.mean(dim=(1, 2, 3)).unsqueeze(1)
+
+    def results_generation(self, logits, img_ids):
+        results = []
+        for mean in logits[:, 0].tolist():
+            results.append({"prediction": STUB_SPECIES[int(mean) % len(STUB_SPECIES)],
+                            "confidence": 0.5 + (mean % 50) / 100})
+        return results
+
+    def single_image_classification(self, crop):
+        batch = self.transform(Image.fromarray(crop)).unsqueeze(0)
+        return self.results_generation(self.forward(batch), [None])[0]
\ No newline at end of file
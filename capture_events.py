@@ -0,0 +1,167 @@
+# capture_events.py
+import os
+import re
+import bisect
+import datetime
+
+# --- CONFIGURATION ---
+BURST_GAP_SECONDS = 10 # Frames of one camera closer together than this belong to the same burst
+BURST_CONTEXT_FRAMES = 10 # Frames of the same camera either side of an image read to complete its burst
+TRACK_IOU_THRES = 0.1 # Boxes in frames of one event overlapping at least this much are the same animal
+# ---------------------
+
+# Snapshot Serengeti style names: <season>_<site>_<roll>_IMAG<frame>, e.g. S5_B04_R1_IMAG0479.JPG
+CAPTURE_NAME_PATTERN = re.compile(r'^(?P<camera>.+?_R\d+)_IMAG(?P<frame>\d+)', re.IGNORECASE)
+EXIF_TIME_FORMAT = '%Y:%m:%d %H:%M:%S'
+
+def parse_capture_name(filename):
+    """
+    Returns (camera, frame_number) for an image filename.
+
+    The camera is the season/site/roll prefix. Names that do not follow the
+    camera-trap pattern use the folder-level camera '' and the digits of the
+    name (if any) as the frame number.
+    """
+    match = CAPTURE_NAME_PATTERN.match(os.path.basename(filename))
+    if match:
+        return match.group('camera'), int(match.group('frame'))
+    digits = re.findall(r'\d+', os.path.splitext(os.path.basename(filename))[0])
+    return '', int(digits[-1]) if digits else 0
+
+def split_camera(camera):
+    """Splits a camera prefix such as 'S5_B04_R1' into (season, site, roll); unknown parts are ''."""
+    parts = camera.split('_') if camera else []
+    roll = parts.pop() if parts else ''
+    site = parts.pop() if parts else ''
+    return '_'.join(parts), site, roll
+
+def parse_timestamp(timestamp):
+    """Parses an EXIF 'YYYY:MM:DD HH:MM:SS' timestamp, returning None if it is missing or malformed."""
+    try:
+        return datetime.datetime.strptime(timestamp.strip(), EXIF_TIME_FORMAT)
+    except (AttributeError, ValueError):
+        return None
+
+def group_bursts(filenames, timestamps, gap_seconds=BURST_GAP_SECONDS):
+    """
+    Groups frames into bursts (capture events).
+
+    Frames belong to one burst when they come from the same camera (site/roll),
+    have consecutive positions in that camera's time order and are less than
+    gap_seconds apart. A frame without a timestamp forms a burst of its own.
+    timestamps maps filename -> EXIF timestamp string. Returns a list of bursts,
+    each a list of filenames in capture order, ordered by camera and time.
+    """
+    by_camera = {}
+    for filename in filenames:
+        camera, frame = parse_capture_name(filename)
+        by_camera.setdefault(camera, []).append((parse_timestamp(timestamps.get(filename, '')), frame, filename))
+
+    bursts = []
+    for camera in sorted(by_camera):
+        frames = by_camera[camera]
+        # Frames without a time sort after the dated ones, by frame number
+        frames.sort(key=lambda item: (item[0] is None, item[0] or datetime.datetime.min, item[1]))
+        current, last_time = [], None
+        for frame_time, _, filename in frames:
+            joins = (current and frame_time is not None and last_time is not None
+                     and (frame_time - last_time).total_seconds() < gap_seconds)
+            if not joins and current:
+                bursts.append(current)
+                current = []
+            current.append(filename)
+            last_time = frame_time
+        if current:
+            bursts.append(current)
+    return bursts
+
+def event_id(burst):
+    """Names a capture event after its first frame, without the extension."""
+    return os.path.splitext(os.path.basename(burst[0]))[0]
+
+def record_event_id(record):
+    """Returns a record's Event_ID, treating an image without one as an event of its own."""
+    return record.get('Event_ID') or os.path.splitext(os.path.basename(record['Image_Filename']))[0]
+
+def assign_events(filenames, timestamps, gap_seconds=BURST_GAP_SECONDS):
+    """Returns {filename: event_id} for the bursts formed by filenames (see group_bursts)."""
+    return {filename: event_id(burst) for burst in group_bursts(filenames, timestamps, gap_seconds)
+            for filename in burst}
+
+def neighbour_frames(filenames, candidates, window=BURST_CONTEXT_FRAMES):
+    """Returns the candidates from the cameras of filenames whose frame numbers lie within window of one of them."""
+    frames_by_camera = {}
+    for filename in filenames:
+        camera, frame = parse_capture_name(filename)
+        frames_by_camera.setdefault(camera, []).append(frame)
+    for frames in frames_by_camera.values():
+        frames.sort()
+
+    neighbours = []
+    for filename in candidates:
+        camera, frame = parse_capture_name(filename)
+        frames = frames_by_camera.get(camera)
+        if frames is None:
+            continue
+        i = bisect.bisect_left(frames, frame - window)
+        if i < len(frames) and frames[i] <= frame + window:
+            neighbours.append(filename)
+    return neighbours
+
+def box_iou(a, b):
+    """Intersection over union of two records' boxes (X_min, Y_min, X_max, Y_max)."""
+    width = min(int(a['X_max']), int(b['X_max'])) - max(int(a['X_min']), int(b['X_min']))
+    height = min(int(a['Y_max']), int(b['Y_max'])) - max(int(a['Y_min']), int(b['Y_min']))
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    area_a = (int(a['X_max']) - int(a['X_min'])) * (int(a['Y_max']) - int(a['Y_min']))
+    area_b = (int(b['X_max']) - int(b['X_min'])) * (int(b['Y_max']) - int(b['Y_min']))
+    return intersection / float(area_a + area_b - intersection)
+
+def link_tracks(records, iou_thres=TRACK_IOU_THRES):
+    """
+    Links the detections of one capture event into tracks, one per animal.
+
+    Frames are visited in capture order. Each box joins the track whose latest
+    box overlaps it most (at least iou_thres), greedily from the best overlap
+    down; a track takes at most one box per frame. Boxes that match no track
+    start a new one. Returns a list of tracks, each a list of records.
+    """
+    frames = {}
+    for record in records:
+        frames.setdefault(record['Image_Filename'], []).append(record)
+
+    def capture_order(filename):
+        frame_time = parse_timestamp(frames[filename][0].get('Timestamp', ''))
+        return frame_time is None, frame_time or datetime.datetime.min, parse_capture_name(filename)[1]
+
+    tracks = []
+    for filename in sorted(frames, key=capture_order):
+        boxes = frames[filename]
+        pairs = sorted(((box_iou(track[-1], record), t, r) for t, track in enumerate(tracks)
+                        for r, record in enumerate(boxes)), reverse=True)
+        matched_tracks, matched_boxes = set(), set()
+        for iou, t, r in pairs:
+            if iou < iou_thres:
+                break
+            if t in matched_tracks or r in matched_boxes:
+                continue
+            tracks[t].append(boxes[r])
+            matched_tracks.add(t)
+            matched_boxes.add(r)
+        tracks.extend([record] for r, record in enumerate(boxes) if r not in matched_boxes)
+    return tracks
+
+def group_tracks(records, iou_thres=TRACK_IOU_THRES):
+    """Splits records by capture event (Event_ID) and links each event's detections into tracks."""
+    by_event = {}
+    for record in records:
+        by_event.setdefault(record_event_id(record), []).append(record)
+    return [track for event_records in by_event.values() for track in link_tracks(event_records, iou_thres)]
+
+def representative(track):
+    """Picks the detection of a track to classify: the most confident one, then the largest box."""
+    return max(track, key=lambda record: (float(record['MD_Confidence']),
+                                          (int(record['X_max']) - int(record['X_min'])) *
+                                          (int(record['Y_max']) - int(record['Y_min']))))
\ No newline at end of file
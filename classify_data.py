@@ -1,73 +1,286 @@
 # classify_data.py
 import os
-import csv
+import time
 import argparse
 import numpy as np
 from PIL import Image
 import torch
 import supervision as sv
 from PytorchWildlife.models import classification as pw_classification
+from capture_events import group_tracks, representative
+from crop_store import CropStore, CROP_STORE_DIR
+from image_loader import (iter_decoded_images, iter_reduced_images, read_image_list, DecodeStats,
+                          LOADER_WORKERS, PREFETCH_DEPTH)
+from inference_cache import InferenceCache, CACHE_MAX_MB
+from inference_backend import (apply_classifier_backend, backend_model_name, configure_threads, CLASSIFIER_BACKENDS,
+                               INFERENCE_THREADS, INTEROP_THREADS)
+from record_store import load_records, save_records
+import profiling
 
 # --- CONFIGURATION ---
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+CLASSIFICATION_BATCH_SIZE = 32 # Number of animal crops per classifier forward pass
+CLASSIFIER_NAME = "AI4GSnapshotSerengeti" # PytorchWildlife classification model class
+PER_EVENT = False # Classify one crop per animal track of each capture event and share the result
+CLASSIFIER_INPUT_SIZE = 224 # Side the classifier resizes each crop to
+REDUCED_DECODE = False # Decode JPEGs at the smallest DCT scale that keeps every crop at CLASSIFIER_INPUT_SIZE
+CLASSIFICATION_BACKEND = 'eager' # 'eager', 'int8', 'torchscript', 'compile' or 'onnx' (see inference_backend.py)
 # ---------------------
 
-def load_csv_data(csv_path):
-    """Loads all records (as strings) from the CSV file."""
-    with open(csv_path, 'r', newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        return list(reader)
-        
-def update_csv_data(input_dir, input_csv_path, field_order_str):
-    """Runs the classifier and updates the CSV."""
+def load_classification_model(backend=CLASSIFICATION_BACKEND):
+    """Initializes the AI4G Serengeti species classifier on the given inference backend."""
+    print(f"Initializing {CLASSIFIER_NAME} Classifier on {DEVICE}...")
+    classification_model = getattr(pw_classification, CLASSIFIER_NAME)(device=DEVICE)
+    return apply_classifier_backend(classification_model, backend, CLASSIFIER_NAME)
+
+def classify_crop_batch(classification_model, crops):
+    """
+    Classifies a list of RGB crops with a single forward pass of the backbone.
+
+    Each crop goes through the model's own inference transform (resize and
+    normalize), the tensors are stacked into one batch, and the logits are
+    converted with the model's results_generation, so every result matches
+    what single_image_classification returns for that crop.
+    """
+    transform = getattr(classification_model, 'transform', None)
+    if transform is None:
+        # Model without an exposed transform: fall back to one call per crop
+        return [classification_model.single_image_classification(crop) for crop in crops]
+
+    device = getattr(classification_model, 'device', DEVICE)
+    batch = torch.stack([transform(Image.fromarray(crop)) for crop in crops]).to(device)
+    with torch.no_grad():
+        logits = classification_model.forward(batch)
+    return classification_model.results_generation(logits.cpu(), [None] * len(crops))
+
+@profiling.timed_stage('classify')
+def update_csv_data(input_dir, input_csv_path, field_order_str, batch_size=CLASSIFICATION_BATCH_SIZE,
+                    loader_workers=LOADER_WORKERS, prefetch_depth=PREFETCH_DEPTH,
+                    classification_model=None, records=None, images=None, cache=None, only_files=None,
+                    per_event=PER_EVENT, reduced_decode=REDUCED_DECODE, backend=CLASSIFICATION_BACKEND,
+                    crop_store=None):
+    """
+    Runs the classifier and updates the CSV.
+
+    When called in-process, an in-memory record table is updated in place
+    and not written back. A preloaded classification_model and an image table
+    (filename -> RGB array) can also be passed in. If an InferenceCache is
+    given, images whose content and animal boxes were already classified are
+    served from it without being decoded. If only_files is given, only those
+    images are classified; all other rows are left as they are.
+
+    With per_event, the animal detections of each capture event (Event_ID) are
+    linked into tracks across its frames, only the best crop of every track is
+    classified, and its prediction is written to the whole track.
+
+    With reduced_decode, each image the step decodes itself is decoded at the
+    smallest JPEG scale that still leaves its smallest animal crop at least the
+    classifier's input size; boxes are scaled to match. backend selects the
+    inference backend the model is loaded with when none is passed in.
+
+    With a CropStore, every crop cut here is saved to it, and images whose
+    crops are all stored (and not already in memory) are classified from the
+    store without being decoded.
+    """
     
     field_order = field_order_str.split(',')
     
-    all_records = load_csv_data(input_csv_path)
+    all_records = records if records is not None else load_records(input_csv_path)
     if not all_records:
         print("Error: Input CSV is empty or cannot be read.")
-        return
-
-    print(f"Initializing AI4G Serengeti Classifier on {DEVICE}...")
-    classification_model = pw_classification.AI4GSnapshotSerengeti(device=DEVICE)
+        return all_records
 
     # Group records by image file
     records_by_image = {}
     for record in all_records:
         records_by_image.setdefault(record['Image_Filename'], []).append(record)
+    if only_files is not None:
+        records_by_image = {filename: records_by_image[filename] for filename in only_files if filename in records_by_image}
 
     processed_records_count = 0
+    batch_size = max(1, batch_size)
+
+    # Crops from many images are collected and classified together
+    pending_records, pending_crops = [], []
+
+    # Per-image time (crop extraction plus its share of each batch), for the profile
+    image_seconds = {}
+
+    def run_batch():
+        batch_start = time.perf_counter()
+        batch_results = classify_crop_batch(classification_model, pending_crops)
+        crop_seconds = (time.perf_counter() - batch_start) / len(pending_crops)
+        profiling.add_substep_time('inference', crop_seconds * len(pending_crops))
+        for record, results_clf in zip(pending_records, batch_results):
+            record['Predicted_Species'] = results_clf["prediction"]
+            record['Classification_Confidence'] = results_clf["confidence"]
+            image_seconds[record['Image_Filename']] = image_seconds.get(record['Image_Filename'], 0.0) + crop_seconds
+        pending_records.clear()
+        pending_crops.clear()
+
+    def queue_crop(record, crop):
+        pending_records.append(record)
+        pending_crops.append(crop)
+        if len(pending_crops) == batch_size:
+            run_batch()
     
-    for filename, records in records_by_image.items():
+    # Only decode images that hold at least one animal detection (MD_Class_ID == 0)
+    animal_records_by_image = {}
+    for filename, image_records in records_by_image.items():
+        animal_records = [record for record in image_records if int(record['MD_Class_ID']) == 0]
+        if animal_records:
+            animal_records_by_image[filename] = animal_records
+
+    # Per-event mode: one classifier call per tracked animal instead of one per frame
+    tracks = []
+    if per_event:
+        animal_records = [record for image_records in animal_records_by_image.values() for record in image_records]
+        tracks = [(representative(track), track) for track in group_tracks(animal_records)]
+        selected = {id(record) for record, _ in tracks}
+        chosen_by_image = {}
+        for filename, image_records in animal_records_by_image.items():
+            chosen = [record for record in image_records if id(record) in selected]
+            if chosen:
+                chosen_by_image[filename] = chosen
+        animal_records_by_image = chosen_by_image
+        print(f"Per-event classification: {len(animal_records)} animal detections linked into {len(tracks)} tracks.")
+    animal_images = list(animal_records_by_image)
+
+    # Serve previously classified image contents from the cache
+    cache_keys = {}
+    served_from_cache = set()
+    cache_start = time.perf_counter()
+    if cache is not None:
+        if classification_model is None:
+            model_name = backend_model_name(CLASSIFIER_NAME, backend)
+        else:
+            model_name = backend_model_name(type(classification_model).__name__,
+                                            getattr(classification_model, 'backend', 'eager'))
+        # Labels from reduced-decode crops may differ slightly, so they are cached apart from
+        # full-resolution ones (whose keys stay as they were, keeping existing caches valid)
+        decode_params = {'decode_min_side': CLASSIFIER_INPUT_SIZE} if reduced_decode and images is None else {}
+        for filename, animal_records in animal_records_by_image.items():
+            try:
+                image_hash = cache.image_hash(os.path.join(input_dir, filename))
+            except OSError:
+                continue
+            boxes = [[int(record[k]) for k in ('X_min', 'Y_min', 'X_max', 'Y_max')] for record in animal_records]
+            key = cache.make_key(image_hash, model_name, boxes=boxes, **decode_params)
+            cached = cache.get(key)
+            if cached is None:
+                cache_keys[filename] = key
+                continue
+            for record, (species, confidence) in zip(animal_records, cached):
+                record['Predicted_Species'] = species
+                record['Classification_Confidence'] = confidence
+            processed_records_count += len(animal_records)
+            served_from_cache.add(filename)
+        animal_images = [filename for filename in animal_images if filename not in served_from_cache]
+        profiling.add_substep_time('cache', time.perf_counter() - cache_start)
+
+    if classification_model is None and animal_images:
+        with profiling.substep('load_model'):
+            classification_model = load_classification_model(backend)
+
+    classified_images = []
+
+    # Crops kept from an earlier run are read back instead of decoding their image
+    if crop_store is not None:
+        stored_images = set()
+        for filename in animal_images:
+            if images is not None and filename in images:
+                continue
+            store_start = time.perf_counter()
+            crops = crop_store.get_image_crops(input_dir, filename, animal_records_by_image[filename],
+                                               full_resolution=not reduced_decode)
+            store_elapsed = time.perf_counter() - store_start
+            profiling.add_substep_time('crop_store', store_elapsed)
+            if crops is None:
+                continue
+            image_seconds[filename] = image_seconds.get(filename, 0.0) + store_elapsed
+            for record, crop in zip(animal_records_by_image[filename], crops):
+                queue_crop(record, crop)
+                processed_records_count += 1
+            classified_images.append(filename)
+            stored_images.add(filename)
+        animal_images = [filename for filename in animal_images if filename not in stored_images]
+
+    # Images are decoded in background workers while the classifier runs
+    decode_stats = DecodeStats()
+    if reduced_decode:
+        # The smallest crop of an image must not shrink below the classifier's input size
+        max_reductions = {}
+        for filename in animal_images:
+            smallest = min(max(int(record['X_max']) - int(record['X_min']), int(record['Y_max']) - int(record['Y_min']))
+                           for record in animal_records_by_image[filename])
+            max_reductions[filename] = max(1, smallest // CLASSIFIER_INPUT_SIZE)
+        decoded = iter_reduced_images(input_dir, animal_images, max_reductions=max_reductions, images=images,
+                                      workers=loader_workers, depth=prefetch_depth, stats=decode_stats)
+    else:
+        decoded = ((filename, img, (1.0, 1.0), error) for filename, img, error in
+                   iter_decoded_images(input_dir, animal_images, images=images, workers=loader_workers, depth=prefetch_depth))
+    for filename, input_img, scale, error in profiling.timed_iter(decoded, 'decode'):
         img_path = os.path.join(input_dir, filename)
-        
-        try:
-            input_img = np.array(Image.open(img_path).convert('RGB'))
-        except FileNotFoundError:
+
+        if isinstance(error, FileNotFoundError):
             print(f"Warning: Image not found for classification: {img_path}. Skipping.")
             continue
+        elif error is not None:
+            raise error
 
-        for record in records:
-            # Only classify if an animal was detected (MD_Class_ID == 0)
-            if int(record['MD_Class_ID']) == 0:
-                xyxy = np.array([record['X_min'], record['Y_min'], record['X_max'], record['Y_max']], dtype=int)
-                
-                cropped_image = sv.crop_image(image=input_img, xyxy=xyxy)
-                
-                results_clf = classification_model.single_image_classification(cropped_image)
-                
-                record['Predicted_Species'] = results_clf["prediction"]
-                record['Classification_Confidence'] = results_clf["confidence"]
+        # Only classify if an animal was detected (MD_Class_ID == 0)
+        for record in animal_records_by_image[filename]:
+            xyxy = np.array([record['X_min'] / scale[0], record['Y_min'] / scale[1],
+                             record['X_max'] / scale[0], record['Y_max'] / scale[1]]).round().astype(int)
+            
+            crop_start = time.perf_counter()
+            crop = sv.crop_image(image=input_img, xyxy=xyxy)
+            if crop_store is not None:
+                crop_store.put(input_dir, filename, record, crop, scale)
+            processed_records_count += 1
+            crop_elapsed = time.perf_counter() - crop_start
+            profiling.add_substep_time('crop', crop_elapsed)
+            image_seconds[filename] = image_seconds.get(filename, 0.0) + crop_elapsed
+            queue_crop(record, crop)
+        classified_images.append(filename)
+
+    if pending_crops:
+        run_batch()
+    profiling.add_latencies([image_seconds[filename] for filename in classified_images])
+    profiling.add_images(len(served_from_cache))
+    decode_stats.report()
+    if crop_store is not None:
+        crop_store.flush()
+        crop_store.report()
+
+    if cache is not None:
+        for filename in classified_images:
+            if filename in cache_keys:
+                cache.put(cache_keys[filename], [[record['Predicted_Species'], record['Classification_Confidence']]
+                                                 for record in animal_records_by_image[filename]])
+        cache.report()
+
+    # Share each track's prediction with the frames that were not classified
+    classified = served_from_cache.union(classified_images)
+    for chosen, track in tracks:
+        if chosen['Image_Filename'] not in classified:
+            continue
+        for record in track:
+            if record is not chosen:
+                record['Predicted_Species'] = chosen['Predicted_Species']
+                record['Classification_Confidence'] = chosen['Classification_Confidence']
                 processed_records_count += 1
-                
-    # Re-Export the entire updated CSV file
-    with open(input_csv_path, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=field_order)
-        writer.writeheader()
-        writer.writerows(all_records)
 
     print(f"\n--- Classification Complete ---")
-    print(f"Updated {processed_records_count} animal records in: {input_csv_path}")
+
+    # Re-Export the entire updated CSV file
+    if records is None:
+        with profiling.substep('write'):
+            save_records(all_records, input_csv_path, field_order)
+        print(f"Updated {processed_records_count} animal records in: {input_csv_path}")
+    else:
+        print(f"Updated {processed_records_count} animal records.")
+    return all_records
 
 
 if __name__ == '__main__':
@@ -75,5 +288,42 @@ if __name__ == '__main__':
     parser.add_argument("input_dir", type=str, help="Directory containing input images.")
     parser.add_argument("input_csv_path", type=str, help="Path to the Master Detection CSV file to be updated.")
     parser.add_argument("field_order", type=str, help="Comma-separated string defining the final CSV column order.")
+    parser.add_argument("--batch-size", type=int, default=CLASSIFICATION_BATCH_SIZE,
+                        help=f"Number of animal crops per classifier forward pass. (Default: {CLASSIFICATION_BATCH_SIZE})")
+    parser.add_argument("--loader-workers", type=int, default=LOADER_WORKERS,
+                        help=f"Number of background image decode workers. (Default: {LOADER_WORKERS})")
+    parser.add_argument("--prefetch-depth", type=int, default=PREFETCH_DEPTH,
+                        help=f"Maximum number of decoded images queued ahead of the model. (Default: {PREFETCH_DEPTH})")
+    parser.add_argument("--images-from", type=str, default=None,
+                        help="File listing the image filenames to process (one per line); other rows are left untouched.")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="Path to an SQLite inference cache; previously classified images are not re-run.")
+    parser.add_argument("--cache-max-mb", type=int, default=CACHE_MAX_MB,
+                        help=f"Size limit of the inference cache before LRU eviction. (Default: {CACHE_MAX_MB})")
+    parser.add_argument("--backend", choices=CLASSIFIER_BACKENDS, default=CLASSIFICATION_BACKEND,
+                        help=f"Inference backend for the classifier. (Default: {CLASSIFICATION_BACKEND})")
+    parser.add_argument("--threads", type=int, default=INFERENCE_THREADS,
+                        help="Intra-op threads for inference (default: the library's choice).")
+    parser.add_argument("--interop-threads", type=int, default=INTEROP_THREADS,
+                        help="Inter-op threads for inference (default: the library's choice).")
+    parser.add_argument("--reduced-decode", action="store_true", default=REDUCED_DECODE,
+                        help=f"Decode JPEGs at the smallest DCT scale that keeps every crop at {CLASSIFIER_INPUT_SIZE} px.")
+    parser.add_argument("--per-event", action="store_true", default=PER_EVENT,
+                        help="Classify one crop per tracked animal of each capture event and copy the prediction to its other frames.")
+    parser.add_argument("--crop-store", type=str, default=CROP_STORE_DIR,
+                        help="Directory of a shared crop store; crops are saved there and images already stored are not decoded.")
     args = parser.parse_args()
-    update_csv_data(args.input_dir, args.input_csv_path, args.field_order)
\ No newline at end of file
+    if args.threads or args.interop_threads:
+        configure_threads(args.threads, args.interop_threads)
+    cache = InferenceCache(args.cache, max_bytes=args.cache_max_mb * 1024 * 1024) if args.cache else None
+    crop_store = CropStore(args.crop_store) if args.crop_store else None
+    with profiling.profile_run():
+        update_csv_data(args.input_dir, args.input_csv_path, args.field_order, batch_size=args.batch_size,
+                        loader_workers=args.loader_workers, prefetch_depth=args.prefetch_depth, cache=cache,
+                        only_files=read_image_list(args.images_from) if args.images_from else None,
+                        per_event=args.per_event, reduced_decode=args.reduced_decode, backend=args.backend,
+                        crop_store=crop_store)
+    if cache is not None:
+        cache.close()
+    if crop_store is not None:
+        crop_store.close()
\ No newline at end of file
@@ -0,0 +1,141 @@
+# crop_store.py
+import os
+import sqlite3
+import threading
+import numpy as np
+from image_loader import image_stat
+
+# --- CONFIGURATION ---
+CROP_STORE_DIR = None # Directory of the shared crop store (None disables it)
+# ---------------------
+
+class CropStore:
+    """
+    On-disk store of animal crops, keyed by (image filename, Detection_Index).
+
+    The classify step saves every crop it cuts. Crop pixels (RGB uint8) are
+    appended to one raw data file, which readers memory-map. A SQLite index
+    holds each crop's offset and shape, its box and decode scale, and the size
+    and mtime of its source image. A crop is only served while the source file
+    and the logged box are unchanged. A crop cut from a reduced decode is only
+    served to readers that accept one. Only one process should write to a store
+    at a time; any number may read. A replaced crop leaves its old bytes in the
+    data file, so delete the directory now and then to reclaim the space.
+    """
+
+    def __init__(self, store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.data_path = os.path.join(store_dir, 'crops.bin')
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+        self._map = None
+        self._lock = threading.Lock()
+        self._data = None
+        self._conn = sqlite3.connect(os.path.join(store_dir, 'index.sqlite'), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS crops ("
+            " image TEXT NOT NULL,"
+            " detection_index INTEGER NOT NULL,"
+            " file_size INTEGER NOT NULL,"
+            " file_mtime_ns INTEGER NOT NULL,"
+            " box TEXT NOT NULL,"
+            " scale_x REAL NOT NULL,"
+            " scale_y REAL NOT NULL,"
+            " offset INTEGER NOT NULL,"
+            " height INTEGER NOT NULL,"
+            " width INTEGER NOT NULL,"
+            " PRIMARY KEY (image, detection_index))"
+        )
+        self._conn.commit()
+
+    def _file_stat(self, input_dir, filename):
+        """Returns (size, mtime_ns) of a source image, or None if it is missing."""
+        try:
+            return tuple(image_stat(os.path.join(input_dir, filename)))
+        except OSError:
+            return None
+
+    @staticmethod
+    def _box(record):
+        return ','.join(str(int(record[k])) for k in ('X_min', 'Y_min', 'X_max', 'Y_max'))
+
+    def _view(self, offset, height, width):
+        """Returns a read-only view of one crop, remapping the data file if it has grown."""
+        end = offset + height * width * 3
+        if end == offset:
+            return np.zeros((height, width, 3), dtype=np.uint8)
+        if self._map is None or len(self._map) < end:
+            if self._data is not None:
+                self._data.flush()
+            self._map = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        return self._map[offset:end].reshape(height, width, 3)
+
+    def get_image_crops(self, input_dir, filename, records, full_resolution=True):
+        """
+        Returns the stored crops of an image's records, in record order, or None
+        unless all of them are present and current. With full_resolution, crops
+        cut from a reduced decode do not count.
+        """
+        file_stat = self._file_stat(input_dir, filename)
+        crops = []
+        with self._lock:
+            rows = {} if file_stat is None else {
+                row[0]: row[1:] for row in self._conn.execute(
+                    "SELECT detection_index, file_size, file_mtime_ns, box, scale_x, scale_y, offset, height, width "
+                    "FROM crops WHERE image = ?", (filename,))}
+            for record in records:
+                row = rows.get(int(record['Detection_Index']))
+                if (row is None or tuple(row[:2]) != file_stat or row[2] != self._box(record)
+                        or (full_resolution and (row[3], row[4]) != (1.0, 1.0))):
+                    self.misses += 1
+                    return None
+                crops.append(self._view(*row[5:]))
+        self.hits += len(crops)
+        return crops
+
+    def has_full_resolution_crops(self):
+        """True if the store holds any crop cut from a full-resolution decode."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM crops WHERE scale_x = 1.0 AND scale_y = 1.0 LIMIT 1").fetchone() is not None
+
+    def put(self, input_dir, filename, record, crop, scale=(1.0, 1.0)):
+        """Stores the crop of one record, cut from an image decoded at scale (pixels -> logged coordinates)."""
+        file_stat = self._file_stat(input_dir, filename)
+        if file_stat is None:
+            return
+        crop = np.ascontiguousarray(crop, dtype=np.uint8)
+        with self._lock:
+            if self._data is None:
+                self._data = open(self.data_path, 'ab')
+            offset = self._data.seek(0, os.SEEK_END)
+            self._data.write(crop.tobytes())
+            self._conn.execute(
+                "INSERT OR REPLACE INTO crops VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (filename, int(record['Detection_Index']), file_stat[0], file_stat[1], self._box(record),
+                 float(scale[0]), float(scale[1]), offset, crop.shape[0], crop.shape[1]))
+            self.written += 1
+
+    def report(self):
+        """Prints how many crops were served and written."""
+        size_mb = os.path.getsize(self.data_path) / (1024 * 1024) if os.path.exists(self.data_path) else 0.0
+        print(f"Crop store: {self.hits} crops served, {self.misses} images missed, {self.written} crops written, "
+              f"{size_mb:.1f} MB in {self.store_dir}")
+
+    def flush(self):
+        """Writes out the crops stored so far, so other processes can read them."""
+        with self._lock:
+            if self._data is not None:
+                self._data.flush()
+            self._conn.commit()
+
+    def close(self):
+        """Flushes the data file and commits the index."""
+        with self._lock:
+            if self._data is not None:
+                self._data.close()
+                self._data = None
+            self._conn.commit()
\ No newline at end of file
@@ -1,89 +1,300 @@
 # detect_and_log.py
 import os
-import glob
-import csv
+import time
 import argparse
+import numpy as np
 import torch
 from PytorchWildlife.models import detection as pw_detection
+from image_loader import (iter_decoded_images, iter_reduced_images, list_images, read_image_list, DecodeStats,
+                          LOADER_WORKERS, PREFETCH_DEPTH)
+from inference_cache import InferenceCache, CACHE_MAX_MB
+from record_store import load_records, save_records
+from empty_prefilter import find_static_frames, PREFILTER_THRESHOLD
+from inference_backend import (apply_detector_backend, backend_model_name, configure_threads, DETECTOR_BACKENDS,
+                               INFERENCE_THREADS, INTEROP_THREADS)
+import profiling
 
 # --- CONFIGURATION ---
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+DETECTION_BATCH_SIZE = 1 # Number of images per MegaDetector forward pass
+DETECTION_CONF_THRES = 0.2 # Same default as single_image_detection
+DETECTION_MODEL_VERSION = "MDV6-yolov10-e" # MegaDetector V6 weights to load
+DETECTION_IMAGE_SIZE = 1280 # Longest side MegaDetector letterboxes its input to
+REDUCED_DECODE = False # Decode JPEGs at the smallest DCT scale still covering DETECTION_IMAGE_SIZE
+DETECTION_BACKEND = 'eager' # 'eager', 'torchscript', 'compile' or 'onnx' (see inference_backend.py)
 # ---------------------
 
-def detect_and_create_csv(input_dir, output_csv_path, field_order_str):
-    """Runs MegaDetector and logs bounding box data to a CSV."""
-    
-    field_order = field_order_str.split(',')
-    
+def build_detection_records(img_filename, results, scale=(1.0, 1.0)):
+    """
+    Converts one image's MegaDetector results into per-detection CSV records.
+
+    Boxes are multiplied by scale, the (x, y) factor from the decoded image to
+    the original, so the log always holds full-resolution coordinates.
+    """
+    # If no detections, create one 'empty' record for tracking
+    if not results["detections"]:
+        return [{
+            'Image_Filename': img_filename,
+            'Detection_Index': 0,
+            'X_min': 0, 'Y_min': 0, 'X_max': 0, 'Y_max': 0,
+            'MD_Class_ID': -1, # Using -1 to denote 'no detection'
+            'MD_Confidence': 0.0,
+            'Predicted_Species': 'empty',
+            'Classification_Confidence': 0.0
+        }]
+
+    records = []
+    # Loop through all detected objects
+    for i, (xyxy, det_id) in enumerate(zip(results["detections"].xyxy, results["detections"].class_id)):
+        det_conf = results["detections"].confidence[i]
+        x_min, y_min, x_max, y_max = xyxy * np.array([scale[0], scale[1], scale[0], scale[1]])
+
+        records.append({
+            'Image_Filename': img_filename,
+            'Detection_Index': i,
+            'X_min': int(x_min), 'Y_min': int(y_min),
+            'X_max': int(x_max), 'Y_max': int(y_max),
+            'MD_Class_ID': int(det_id),
+            'MD_Confidence': float(det_conf),
+            'Predicted_Species': '', # Placeholder for later classification
+            'Classification_Confidence': 0.0
+        })
+    return records
+
+def load_detection_model(backend=DETECTION_BACKEND):
+    """Initializes the MegaDetector V6 model used by the detection step on the given inference backend."""
     print(f"Initializing MegaDetector V6 on {DEVICE}...")
     detection_model = pw_detection.MegaDetectorV6(
         device=DEVICE, 
         pretrained=True, 
-        version="MDV6-yolov10-e"
+        version=DETECTION_MODEL_VERSION
     )
+    return apply_detector_backend(detection_model, backend, DETECTION_MODEL_VERSION)
+
+def detect_image_batch(detection_model, images, image_paths):
+    """
+    Runs MegaDetector on a list of decoded RGB images in a single forward pass.
 
-    image_paths = glob.glob(os.path.join(input_dir, '*.jpg'))
+    The images are handed to the underlying Ultralytics predictor together, which
+    letterboxes each one and stacks them into one input tensor. The images are
+    passed in the same RGB layout single_image_detection hands the predictor,
+    and the per-image results are converted with the model's own
+    results_generation, so the output matches single_image_detection
+    (inference_backend.py --batch-size checks this on sample frames).
+    """
+    predictor = getattr(detection_model, 'predictor', None)
+    if predictor is None:
+        # Model without a batchable predictor: fall back to one call per image
+        return [detection_model.single_image_detection(img, img_path=path, det_conf_thres=DETECTION_CONF_THRES)
+                for img, path in zip(images, image_paths)]
+
+    predictor.args.batch = len(images)
+    predictor.args.conf = DETECTION_CONF_THRES
+    det_results = list(predictor.stream_inference(list(images)))
+    return [detection_model.results_generation(result, path) for result, path in zip(det_results, image_paths)]
+
+@profiling.timed_stage('detect')
+def detect_and_create_csv(input_dir, output_csv_path, field_order_str, batch_size=DETECTION_BATCH_SIZE,
+                          loader_workers=LOADER_WORKERS, prefetch_depth=PREFETCH_DEPTH,
+                          detection_model=None, image_paths=None, images=None, cache=None, merge=False,
+                          prefilter_threshold=None, reduced_decode=REDUCED_DECODE, backend=DETECTION_BACKEND,
+                          context_filenames=None, keep_images=None):
+    """
+    Runs MegaDetector and logs bounding box data to a CSV.
+
+    When called in-process, a preloaded detection_model, an explicit list of
+    image_paths and an in-memory image table (filename -> RGB array) can be
+    passed in. The CSV is only written when output_csv_path is set. The
+    detection records are returned either way. If an InferenceCache is given,
+    images whose content was already detected with the same model and
+    threshold are served from it without being decoded. With merge=True, rows
+    of other images already in the CSV are kept and only the processed images'
+    rows are replaced. With a prefilter_threshold, frames that the empty-frame
+    prefilter finds static (see empty_prefilter.py) are logged as empty
+    without running the detector; context_filenames (a listing of input_dir,
+    made once if not given) supplies the prefilter's neighbouring frames.
+    With reduced_decode, images the step decodes itself are decoded at the
+    smallest JPEG scale whose longest side still covers the detector's input
+    size. backend selects the inference backend the model is loaded with when
+    none is passed in. keep_images, a dict, receives the full-resolution images
+    the step decodes itself, so later in-process steps can reuse them.
+    """
+    
+    field_order = field_order_str.split(',')
+
+    if image_paths is None:
+        context_filenames = list_images(input_dir)
+        image_paths = [os.path.join(input_dir, filename) for filename in context_filenames]
     if not image_paths:
         print(f"Error: No images found in {input_dir}")
-        return
+        return []
 
-    all_detection_records = []
-    print(f"Starting detection on {len(image_paths)} images...")
+    filenames = [os.path.basename(img_path) for img_path in image_paths]
+    records_by_image = {}
+    cache_keys = {}
+    if detection_model is not None:
+        backend = getattr(detection_model, 'backend', 'eager')
+    model_name = backend_model_name(DETECTION_MODEL_VERSION, backend)
+    # Boxes from a reduced decode may differ slightly, so they are cached apart from
+    # full-resolution ones (whose keys stay as they were, keeping existing caches valid)
+    decode_params = {}
+    if reduced_decode and images is None:
+        decode_params['decode_min_side'] = getattr(detection_model, 'IMAGE_SIZE', DETECTION_IMAGE_SIZE)
 
-    for img_path in image_paths:
-        img_filename = os.path.basename(img_path)
-        
+    # Serve previously seen image contents from the cache
+    cache_start = time.perf_counter()
+    if cache is not None:
+        for filename in filenames:
+            try:
+                image_hash = cache.image_hash(os.path.join(input_dir, filename))
+            except OSError:
+                continue
+            key = cache.make_key(image_hash, model_name, conf_thres=DETECTION_CONF_THRES, **decode_params)
+            cached = cache.get(key)
+            if cached is None:
+                cache_keys[filename] = key
+            else:
+                records_by_image[filename] = [dict(record, Image_Filename=filename) for record in cached]
+
+    to_detect = [filename for filename in filenames if filename not in records_by_image]
+    if cache is not None:
+        profiling.add_substep_time('cache', time.perf_counter() - cache_start)
+
+    # Route clearly static frames to 'empty' without running MegaDetector
+    if prefilter_threshold is not None and to_detect:
+        with profiling.substep('prefilter'):
+            static = find_static_frames(input_dir, to_detect, prefilter_threshold, context_filenames=context_filenames)
+        for filename in static:
+            records_by_image[filename] = build_detection_records(filename, {"detections": []})
+        print(f"Prefilter: {len(static)} of {len(to_detect)} frames static, skipped without detection "
+              f"({len(static) / len(to_detect):.1%}, threshold {prefilter_threshold:g})")
+        to_detect = [filename for filename in to_detect if filename not in static]
+
+    if detection_model is None and to_detect:
+        with profiling.substep('load_model'):
+            detection_model = load_detection_model(backend)
+
+    batch_size = max(1, batch_size)
+    print(f"Starting detection on {len(to_detect)} images (batch size {batch_size})...")
+
+    start_time = time.perf_counter()
+
+    batch_paths, batch_images, batch_scales = [], [], []
+
+    def run_batch():
         # Runs detection
-        results = detection_model.single_image_detection(img_path)
-        
-        # If no detections, create one 'empty' record for tracking
-        if not results["detections"]:
-            all_detection_records.append({
-                'Image_Filename': img_filename,
-                'Detection_Index': 0,
-                'X_min': 0, 'Y_min': 0, 'X_max': 0, 'Y_max': 0,
-                'MD_Class_ID': -1, # Using -1 to denote 'no detection'
-                'MD_Confidence': 0.0,
-                'Predicted_Species': 'empty',
-                'Classification_Confidence': 0.0
-            })
+        batch_start = time.perf_counter()
+        batch_results = detect_image_batch(detection_model, batch_images, batch_paths)
+        batch_elapsed = time.perf_counter() - batch_start
+        profiling.add_substep_time('inference', batch_elapsed)
+        profiling.add_images(len(batch_paths), batch_elapsed)
+        for img_path, results, scale in zip(batch_paths, batch_results, batch_scales):
+            filename = os.path.basename(img_path)
+            records_by_image[filename] = build_detection_records(filename, results, scale)
+            if filename in cache_keys:
+                cache.put(cache_keys[filename], records_by_image[filename])
+        batch_paths.clear()
+        batch_images.clear()
+        batch_scales.clear()
+
+    # Images are decoded in background workers while the previous batch runs
+    decode_stats = DecodeStats()
+    if reduced_decode:
+        min_side = getattr(detection_model, 'IMAGE_SIZE', DETECTION_IMAGE_SIZE)
+        decoded = iter_reduced_images(input_dir, to_detect, min_side=min_side, images=images,
+                                      workers=loader_workers, depth=prefetch_depth, stats=decode_stats)
+    else:
+        decoded = ((filename, img, (1.0, 1.0), error) for filename, img, error in
+                   iter_decoded_images(input_dir, to_detect, images=images, workers=loader_workers, depth=prefetch_depth))
+    for filename, img, scale, error in profiling.timed_iter(decoded, 'decode'):
+        if error is not None:
+            print(f"Warning: Could not read image {filename}: {error}. Skipping.")
             continue
 
-        # Loop through all detected objects
-        for i, (xyxy, det_id) in enumerate(zip(results["detections"].xyxy, results["detections"].class_id)):
-            det_conf = results["detections"].confidence[i]
-            x_min, y_min, x_max, y_max = xyxy
-            
-            record = {
-                'Image_Filename': img_filename,
-                'Detection_Index': i,
-                'X_min': int(x_min), 'Y_min': int(y_min), 
-                'X_max': int(x_max), 'Y_max': int(y_max),
-                'MD_Class_ID': int(det_id),
-                'MD_Confidence': float(det_conf),
-                'Predicted_Species': '', # Placeholder for later classification
-                'Classification_Confidence': 0.0
-            }
-            all_detection_records.append(record)
+        if keep_images is not None and scale == (1.0, 1.0):
+            keep_images[filename] = img
+        batch_paths.append(os.path.join(input_dir, filename))
+        batch_images.append(img)
+        batch_scales.append(scale)
+        if len(batch_paths) == batch_size:
+            run_batch()
+
+    if batch_paths:
+        run_batch()
+
+    elapsed = time.perf_counter() - start_time
+
+    all_detection_records = [record for filename in filenames for record in records_by_image.get(filename, [])]
     
     # Export all collected data to a single CSV file
-    if all_detection_records:
+    if all_detection_records and output_csv_path:
         
-        os.makedirs(os.path.dirname(output_csv_path) or '.', exist_ok=True)
-        
-        with open(output_csv_path, 'w', newline='') as csvfile:
-            # Fields not present (e.g., Image_Width, Timestamp) are left blank.
-            writer = csv.DictWriter(csvfile, fieldnames=field_order) 
-            writer.writeheader()
-            writer.writerows(all_detection_records)
+        # Keep the rows of images that were not part of this run
+        kept_records = []
+        if merge and os.path.exists(output_csv_path):
+            processed = set(filenames)
+            kept_records = [record for record in load_records(output_csv_path)
+                            if record['Image_Filename'] not in processed]
+
+        # Fields not present (e.g., Image_Width, Timestamp) are left blank.
+        with profiling.substep('write'):
+            save_records(kept_records + all_detection_records, output_csv_path, field_order)
             
         print(f"\n--- Detection Log Complete ---")
         print(f"Data for {len(all_detection_records)} detections saved to: {output_csv_path}")
 
+    if to_detect:
+        print(f"Throughput: {len(to_detect) / elapsed:.2f} images/sec "
+              f"({len(to_detect)} images in {elapsed:.1f}s, batch size {batch_size})")
+    decode_stats.report()
+    if cache is not None:
+        cache.report()
+
+    return all_detection_records
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Runs MegaDetector on images and logs detection data to a CSV.")
     parser.add_argument("input_dir", type=str, help="Directory containing input images.")
     parser.add_argument("output_csv_path", type=str, help="Path for the output Master Detection CSV file.")
     parser.add_argument("field_order", type=str, help="Comma-separated string defining the final CSV column order.")
+    parser.add_argument("--batch-size", type=int, default=DETECTION_BATCH_SIZE,
+                        help=f"Number of images per MegaDetector forward pass. (Default: {DETECTION_BATCH_SIZE})")
+    parser.add_argument("--loader-workers", type=int, default=LOADER_WORKERS,
+                        help=f"Number of background image decode workers. (Default: {LOADER_WORKERS})")
+    parser.add_argument("--prefetch-depth", type=int, default=PREFETCH_DEPTH,
+                        help=f"Maximum number of decoded images queued ahead of the model. (Default: {PREFETCH_DEPTH})")
+    parser.add_argument("--images-from", type=str, default=None,
+                        help="File listing the image filenames to process (one per line); other rows are left untouched.")
+    parser.add_argument("--merge", action="store_true",
+                        help="Merge into an existing CSV, replacing only the rows of the processed images.")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="Path to an SQLite inference cache; previously detected images are not re-run.")
+    parser.add_argument("--prefilter", action="store_true",
+                        help="Log frames that did not change within their burst or against the camera's background as empty, without detection.")
+    parser.add_argument("--prefilter-threshold", type=float, default=PREFILTER_THRESHOLD,
+                        help=f"Largest fraction of changed thumbnail pixels for a static frame. (Default: {PREFILTER_THRESHOLD})")
+    parser.add_argument("--cache-max-mb", type=int, default=CACHE_MAX_MB,
+                        help=f"Size limit of the inference cache before LRU eviction. (Default: {CACHE_MAX_MB})")
+    parser.add_argument("--backend", choices=DETECTOR_BACKENDS, default=DETECTION_BACKEND,
+                        help=f"Inference backend for MegaDetector. (Default: {DETECTION_BACKEND})")
+    parser.add_argument("--threads", type=int, default=INFERENCE_THREADS,
+                        help="Intra-op threads for inference (default: the library's choice).")
+    parser.add_argument("--interop-threads", type=int, default=INTEROP_THREADS,
+                        help="Inter-op threads for inference (default: the library's choice).")
+    parser.add_argument("--reduced-decode", action="store_true", default=REDUCED_DECODE,
+                        help=f"Decode JPEGs at the smallest DCT scale that still covers the detector input ({DETECTION_IMAGE_SIZE} px).")
     args = parser.parse_args()
-    detect_and_create_csv(args.input_dir, args.output_csv_path, args.field_order)
\ No newline at end of file
+    cache = InferenceCache(args.cache, max_bytes=args.cache_max_mb * 1024 * 1024) if args.cache else None
+    if args.threads or args.interop_threads:
+        configure_threads(args.threads, args.interop_threads)
+    image_paths = None
+    if args.images_from:
+        image_paths = [os.path.join(args.input_dir, filename) for filename in read_image_list(args.images_from)]
+    with profiling.profile_run():
+        detect_and_create_csv(args.input_dir, args.output_csv_path, args.field_order, batch_size=args.batch_size,
+                              loader_workers=args.loader_workers, prefetch_depth=args.prefetch_depth,
+                              image_paths=image_paths, cache=cache, merge=args.merge,
+                              prefilter_threshold=args.prefilter_threshold if args.prefilter else None,
+                              reduced_decode=args.reduced_decode, backend=args.backend)
+    if cache is not None:
+        cache.close()
\ No newline at end of file
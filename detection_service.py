@@ -0,0 +1,249 @@
+# detection_service.py
+import io
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import urllib.request
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from PIL import Image
+import supervision as sv
+from detect_and_log import load_detection_model, detect_image_batch, build_detection_records, DETECTION_BACKEND
+from classify_data import load_classification_model, classify_crop_batch, CLASSIFICATION_BATCH_SIZE, CLASSIFICATION_BACKEND
+from inference_backend import configure_threads, DETECTOR_BACKENDS, CLASSIFIER_BACKENDS
+from extract_metadata import read_image_metadata, get_exif_data
+from image_loader import load_rgb_image
+
+# --- CONFIGURATION ---
+SERVICE_HOST = '127.0.0.1' # Only local clients by default
+SERVICE_PORT = 8642
+SERVICE_MAX_BATCH = 16 # Most images per MegaDetector forward pass
+SERVICE_BATCH_WAIT_MS = 10 # How long the first queued image waits for others to join its batch
+SERVICE_TIMEOUT = 300 # Seconds a request waits for its results
+# ---------------------
+
+class DetectionService:
+    """
+    Keeps MegaDetector and the species classifier loaded and micro-batches requests.
+
+    Request threads decode images and put them on a queue. A single model thread
+    takes the first waiting image, waits up to batch_wait_ms for more, and runs
+    detection and classification on the whole batch. The records it returns
+    are the same row dicts the CSV pipeline writes.
+    """
+
+    def __init__(self, detection_model=None, classification_model=None, max_batch=SERVICE_MAX_BATCH,
+                 batch_wait_ms=SERVICE_BATCH_WAIT_MS, clf_batch_size=CLASSIFICATION_BATCH_SIZE,
+                 detector_backend=DETECTION_BACKEND, classifier_backend=CLASSIFICATION_BACKEND):
+        self.detection_model = detection_model or load_detection_model(detector_backend)
+        self.classification_model = classification_model or load_classification_model(classifier_backend)
+        self.max_batch = max(1, max_batch)
+        self.batch_wait = batch_wait_ms / 1000.0
+        self.clf_batch_size = max(1, clf_batch_size)
+        self.requests = queue.Queue()
+        self.stats = {'images': 0, 'batches': 0, 'started': time.time()}
+        self._worker = threading.Thread(target=self._run, name='model-worker', daemon=True)
+        self._worker.start()
+
+    def submit(self, filename, image, metadata, classify=True):
+        """Queues one decoded RGB image; returns a Future resolving to its records."""
+        future = Future()
+        self.requests.put((filename, image, metadata, classify, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.batch_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self.requests.get(timeout=max(0.0, remaining)) if remaining > 0
+                             else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self.process_batch(batch)
+            except Exception as e:
+                for *_, future in batch:
+                    future.set_exception(e)
+                continue
+            for (*_, future), image_records in zip(batch, results):
+                future.set_result(image_records)
+
+    def process_batch(self, batch):
+        """Runs detection on a batch of images, then classifies all their animal crops together."""
+        filenames = [item[0] for item in batch]
+        images = [item[1] for item in batch]
+        det_results = detect_image_batch(self.detection_model, images, filenames)
+
+        records_per_image = []
+        crops, crop_records = [], []
+        for (filename, image, metadata, classify, _), results in zip(batch, det_results):
+            image_records = build_detection_records(filename, results)
+            width, height, timestamp = metadata
+            for record in image_records:
+                record['Image_Width'] = width
+                record['Image_Height'] = height
+                record['Timestamp'] = timestamp
+                if classify and int(record['MD_Class_ID']) == 0:
+                    xyxy = np.array([record['X_min'], record['Y_min'], record['X_max'], record['Y_max']], dtype=int)
+                    crops.append(sv.crop_image(image=image, xyxy=xyxy))
+                    crop_records.append(record)
+            records_per_image.append(image_records)
+
+        for start in range(0, len(crops), self.clf_batch_size):
+            batch_results = classify_crop_batch(self.classification_model, crops[start:start + self.clf_batch_size])
+            for record, results_clf in zip(crop_records[start:start + self.clf_batch_size], batch_results):
+                record['Predicted_Species'] = results_clf["prediction"]
+                record['Classification_Confidence'] = results_clf["confidence"]
+
+        self.stats['images'] += len(batch)
+        self.stats['batches'] += 1
+        return records_per_image
+
+    def health(self):
+        batches = self.stats['batches']
+        return {
+            'status': 'ok',
+            'queued': self.requests.qsize(),
+            'images': self.stats['images'],
+            'batches': batches,
+            'mean_batch_size': round(self.stats['images'] / batches, 2) if batches else None,
+            'uptime_seconds': round(time.time() - self.stats['started'], 1),
+        }
+
+def load_path(img_path):
+    """Decodes an image on disk and reads its (width, height, timestamp) header."""
+    return load_rgb_image(img_path), read_image_metadata(img_path)
+
+def load_bytes(data):
+    """Decodes an uploaded image and reads its (width, height, timestamp)."""
+    with Image.open(io.BytesIO(data)) as img_pil:
+        timestamp = get_exif_data(img_pil).get('Timestamp', '')
+        image = np.array(img_pil.convert('RGB'))
+    return image, (image.shape[1], image.shape[0], timestamp)
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    HTTP front end of the DetectionService.
+
+    GET /health reports queue depth and batching statistics. POST /detect takes
+    either a JSON body {"paths": [...]} naming images readable by the service,
+    or raw image bytes (with ?filename=NAME). Add ?classify=0 to skip species
+    classification. The reply is {"records": [...], "errors": [...]}.
+    """
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self.send_json(200, self.service.health())
+        else:
+            self.send_json(404, {'error': 'Unknown endpoint'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/detect':
+            self.send_json(404, {'error': 'Unknown endpoint'})
+            return
+        query = parse_qs(url.query)
+        classify = query.get('classify', ['1'])[0] not in ('0', 'false')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        # Decode in this request's thread so the model thread only runs inference
+        pending, errors = [], []
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            try:
+                paths = json.loads(body)['paths']
+            except (ValueError, KeyError, TypeError):
+                self.send_json(400, {'error': 'Expected a JSON body of the form {"paths": [...]}'})
+                return
+            for img_path in paths:
+                try:
+                    image, metadata = load_path(img_path)
+                except Exception as e:
+                    errors.append({'path': img_path, 'error': str(e)})
+                    continue
+                pending.append(self.service.submit(os.path.basename(img_path), image, metadata, classify))
+        else:
+            filename = query.get('filename', ['upload.jpg'])[0]
+            try:
+                image, metadata = load_bytes(body)
+            except Exception as e:
+                self.send_json(400, {'error': f"Could not decode image: {e}"})
+                return
+            pending.append(self.service.submit(filename, image, metadata, classify))
+
+        records = []
+        try:
+            for future in pending:
+                records.extend(future.result(timeout=SERVICE_TIMEOUT))
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        self.send_json(200, {'records': records, 'errors': errors})
+
+def query_service(image_paths, url=f"http://{SERVICE_HOST}:{SERVICE_PORT}", classify=True):
+    """Client helper: sends image paths to a running service and returns (records, errors)."""
+    request = urllib.request.Request(f"{url}/detect?classify={int(classify)}",
+                                     data=json.dumps({'paths': list(image_paths)}).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=SERVICE_TIMEOUT) as response:
+        reply = json.load(response)
+    return reply['records'], reply['errors']
+
+def serve(host=SERVICE_HOST, port=SERVICE_PORT, service=None, **service_options):
+    """Loads the models once and serves requests until interrupted."""
+    start = time.perf_counter()
+    ServiceHandler.service = service or DetectionService(**service_options)
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    print(f"Models ready in {time.perf_counter() - start:.1f}s. Serving on http://{host}:{port} (POST /detect, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Keeps the detection and classification models loaded and serves them over HTTP.")
+    parser.add_argument("--host", type=str, default=SERVICE_HOST, help=f"Address to listen on. (Default: {SERVICE_HOST})")
+    parser.add_argument("--port", type=int, default=SERVICE_PORT, help=f"Port to listen on. (Default: {SERVICE_PORT})")
+    parser.add_argument("--max-batch", type=int, default=SERVICE_MAX_BATCH,
+                        help=f"Most images per MegaDetector forward pass. (Default: {SERVICE_MAX_BATCH})")
+    parser.add_argument("--batch-wait-ms", type=float, default=SERVICE_BATCH_WAIT_MS,
+                        help=f"How long a request waits for others to share its batch. (Default: {SERVICE_BATCH_WAIT_MS})")
+    parser.add_argument("--clf-batch-size", type=int, default=CLASSIFICATION_BATCH_SIZE,
+                        help=f"Number of animal crops per classifier forward pass. (Default: {CLASSIFICATION_BATCH_SIZE})")
+    parser.add_argument("--detector-backend", choices=DETECTOR_BACKENDS, default=DETECTION_BACKEND,
+                        help=f"Inference backend for MegaDetector. (Default: {DETECTION_BACKEND})")
+    parser.add_argument("--classifier-backend", choices=CLASSIFIER_BACKENDS, default=CLASSIFICATION_BACKEND,
+                        help=f"Inference backend for the classifier. (Default: {CLASSIFICATION_BACKEND})")
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads for inference.")
+    parser.add_argument("--interop-threads", type=int, default=None, help="Inter-op threads for inference.")
+    args = parser.parse_args()
+    if args.threads or args.interop_threads:
+        configure_threads(args.threads, args.interop_threads)
+    serve(args.host, args.port, max_batch=args.max_batch, batch_wait_ms=args.batch_wait_ms,
+          clf_batch_size=args.clf_batch_size, detector_backend=args.detector_backend,
+          classifier_backend=args.classifier_backend)
\ No newline at end of file
@@ -1,8 +1,13 @@
 import pandas as pd
 import os
+import time
+import argparse
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from tqdm import tqdm
-from collections import defaultdict
+from collections import defaultdict, deque
+from image_pack import PackWriter
 
 # --- Configuration ---
 
@@ -21,6 +26,7 @@ SEASON_PREFIX = 'SER_S5#'
 # Base URL for the Azure data download
 BASE_URL = 'https://lilawildlife.blob.core.windows.net/lila-wildlife/snapshotserengeti-unzipped/'
 DOWNLOAD_FOLDER = 'raw_captures'
+PACK_DIR = None # Set to a directory to append the images to packed tar shards instead (see image_pack.py)
 
 # Columns
 CAPTURE_ID_COL = 'capture_id'
@@ -28,22 +34,62 @@ PATH_COL = 'image_path_rel'
 
 # Define the chunk size for reading large files
 CHUNK_SIZE = 100000
+
+# Parallel download settings
+DOWNLOAD_WORKERS = 16 # Concurrent downloads (and pooled HTTP connections)
+MAX_RETRIES = 4 # Attempts after the first failure of a single file
+RETRY_BACKOFF = 0.5 # Seconds; doubles after each failed attempt
+REQUEST_TIMEOUT = 30 # Seconds to wait for a connection or the next block of data
 # ---------------------
 
-def download_file(url, local_path):
-    """Downloads a file from a URL to a local path."""
-    try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
+# Statuses worth retrying; other 4xx errors mean the file will never arrive
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
 
-        with open(local_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        return True
-    except requests.exceptions.RequestException:
-        return False
+def make_session(pool_size=DOWNLOAD_WORKERS):
+    """Creates a requests session whose connection pool is large enough for every worker thread."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def download_file(session, url, local_path, retries=MAX_RETRIES, backoff=RETRY_BACKOFF, timeout=REQUEST_TIMEOUT):
+    """
+    Downloads a file from a URL to a local path, retrying with exponential backoff.
+
+    Data goes to '<local_path>.part' and is renamed into place once complete,
+    so a file that exists is never truncated. A partial file left by an earlier
+    attempt or run is resumed with an HTTP Range request.
+    """
+    part_path = local_path + '.part'
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            with session.get(url, stream=True, headers=headers, timeout=timeout) as response:
+                if response.status_code == 416 and offset:
+                    # The partial file already holds every byte
+                    os.replace(part_path, local_path)
+                    return True
+                if response.status_code >= 400 and response.status_code not in RETRYABLE_STATUS:
+                    return False
+                response.raise_for_status()
 
-def download_serengeti_images(annotations_path, images_path, total_limit, season_prefix):
+                # A server that ignores Range sends the whole file again
+                mode = 'ab' if offset and response.status_code == 206 else 'wb'
+                with open(part_path, mode) as f:
+                    for chunk in response.iter_content(chunk_size=65536):
+                        f.write(chunk)
+            os.replace(part_path, local_path)
+            return True
+        except (requests.exceptions.RequestException, OSError):
+            if attempt < retries:
+                time.sleep(backoff * (2 ** attempt))
+    return False
+
+def download_serengeti_images(annotations_path, images_path, total_limit, season_prefix,
+                              base_url=BASE_URL, download_folder=DOWNLOAD_FOLDER, workers=DOWNLOAD_WORKERS,
+                              pack_dir=PACK_DIR):
 
     # 1. --- PASS 1: Collect Target Capture IDs ---
     target_captures = set()
@@ -66,7 +112,7 @@ def download_serengeti_images(annotations_path, images_path, total_limit, season
                 break
 
             chunk[CAPTURE_ID_COL] = chunk[CAPTURE_ID_COL].fillna('').astype(str)
-            season_chunk = chunk[chunk[CAPTURE_ID_COL].str.contains(season_prefix)]
+            season_chunk = chunk[chunk[CAPTURE_ID_COL].str.contains(season_prefix, regex=False)]
            
             # Add unique capture IDs from this chunk to the set
             for capture_id in season_chunk[CAPTURE_ID_COL].unique():
@@ -88,11 +134,79 @@ def download_serengeti_images(annotations_path, images_path, total_limit, season
         return
 
     total_captures_to_find = len(target_captures)
-    print(f"\n--- PASS 2: Downloading Images (Total Unique Captures: {total_captures_to_find}) ---")
+    print(f"\n--- PASS 2: Downloading Images (Total Unique Captures: {total_captures_to_find}, Workers: {workers}) ---")
 
-    os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+    # Packed downloads are staged one file at a time and appended to a shard once complete
+    writer = PackWriter(pack_dir) if pack_dir else None
+    staging_folder = os.path.join(pack_dir, 'incoming') if pack_dir else download_folder
+    os.makedirs(staging_folder, exist_ok=True)
     
     downloaded_count = 0
+    failed_count = 0
+    session = make_session(workers)
+    # Every image path found for a capture still to be downloaded, in file order. One image
+    # per capture is in flight at a time; if it fails, the capture's next image is tried,
+    # and a capture leaves target_captures only once one of its images has arrived.
+    candidates = defaultdict(deque)
+    in_flight = {}
+    busy = set() # Captures with a download in flight
+    ready = {} # Captures (in order) waiting for their next image to be submitted
+    max_in_flight = workers * 4
+    start_time = time.perf_counter()
+
+    def fetch(url, local_path):
+        # A staged file left complete by an interrupted run is packed without downloading it again
+        if writer is None or not os.path.exists(local_path):
+            if not download_file(session, url, local_path):
+                return False
+        if writer is not None:
+            writer.add_file(local_path)
+            os.remove(local_path)
+        return True
+
+    def retire(capture_id):
+        target_captures.discard(capture_id)
+        candidates.pop(capture_id, None)
+        ready.pop(capture_id, None)
+        pbar.update(1)
+
+    def collect(done):
+        nonlocal downloaded_count, failed_count
+        for future in done:
+            capture_id = in_flight.pop(future)
+            busy.discard(capture_id)
+            if future.result():
+                downloaded_count += 1
+                retire(capture_id)
+            else:
+                failed_count += 1
+                if candidates.get(capture_id):
+                    ready[capture_id] = None
+
+    def submit_ready():
+        while ready:
+            capture_id = next(iter(ready))
+            del ready[capture_id]
+            paths = candidates.get(capture_id)
+            if not paths:
+                continue
+            rel_path = paths.popleft()
+            filename = os.path.basename(rel_path)
+            local_path = os.path.join(staging_folder, filename)
+
+            # Resumable Check: Skip if file already exists (or is already packed)
+            if (filename in writer) if writer is not None else os.path.exists(local_path):
+                retire(capture_id)
+                continue
+
+            # Bound the queue so memory stays flat on full-season pulls
+            while len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            future = executor.submit(fetch, base_url + rel_path, local_path)
+            in_flight[future] = capture_id
+            busy.add(capture_id)
 
     try:
         img_reader = pd.read_csv(
@@ -104,34 +218,28 @@ def download_serengeti_images(annotations_path, images_path, total_limit, season
 
         pbar = tqdm(total=total_captures_to_find, desc="Download Progress", unit="file", position=0)
     
-        for i, chunk in enumerate(img_reader):
-            target_ids = list(target_captures)
-        
-            filtered_paths = chunk[chunk[CAPTURE_ID_COL].isin(target_ids)]
-        
-            for _, row in filtered_paths.iterrows():
-                capture_id = row[CAPTURE_ID_COL]
-                rel_path = row[PATH_COL]
-            
-                if capture_id in target_captures:
-                    full_url = BASE_URL + rel_path
-                    local_path = os.path.join(DOWNLOAD_FOLDER, os.path.basename(rel_path))
-
-                    # Resumable Check: Skip if file already exists
-                    if os.path.exists(local_path):
-                        target_captures.remove(capture_id)
-                        pbar.update(1)  
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for i, chunk in enumerate(img_reader):
+                # Vectorized membership test; every image of a capture is kept as a fallback
+                filtered_paths = chunk[chunk[CAPTURE_ID_COL].isin(target_captures)]
+
+                for capture_id, rel_path in zip(filtered_paths[CAPTURE_ID_COL].values, filtered_paths[PATH_COL].values):
+                    if capture_id not in target_captures:
                         continue
+                    candidates[capture_id].append(rel_path)
+                    if capture_id not in busy:
+                        ready[capture_id] = None
+                submit_ready()
 
-                    if download_file(full_url, local_path):
-                        downloaded_count += 1
-                        target_captures.remove(capture_id)
-                        pbar.update(1)  
-                        pbar.refresh()
-            
-            if not target_captures:
-                print("\nAll target image paths found and processed. Stopping Pass 2.")
-                break
+                if not target_captures:
+                    print("\nAll target image paths found and processed. Stopping Pass 2.")
+                    break
+
+            # Failures after the last chunk still fall back to the capture's other images
+            while in_flight or ready:
+                submit_ready()
+                if in_flight:
+                    collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
         
         pbar.close()
         
@@ -139,19 +247,48 @@ def download_serengeti_images(annotations_path, images_path, total_limit, season
         print(f"\n❌ Images file processing error: {e}")
         pbar.close()
         return
+    finally:
+        session.close()
+        if writer is not None:
+            writer.close()
 
+    elapsed = time.perf_counter() - start_time
     print("\n--- ✅ Download Complete ---")
     print(f"Total Download Limit: {'ALL' if total_limit == -1 else total_limit}")
     print(f"Season Filtered: {season_prefix.strip('#')}")
-    print(f"New files downloaded: {downloaded_count}")
-    print(f"\nAll files saved directly to the '{DOWNLOAD_FOLDER}' directory.")
+    print(f"New files downloaded: {downloaded_count} ({downloaded_count / elapsed:.1f} files/sec)")
+    if failed_count:
+        print(f"Failed downloads (after {MAX_RETRIES} retries): {failed_count}")
+    if target_captures:
+        print(f"Captures without a downloaded image: {len(target_captures)}")
+    if writer is not None:
+        print(f"\nAll files packed into tar shards in '{pack_dir}' (use it as the pipeline's input directory).")
+    else:
+        print(f"\nAll files saved directly to the '{download_folder}' directory.")
     print("----------------------------")
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Downloads Snapshot Serengeti images from LILA for one season.")
+    parser.add_argument("--annotations", default=ANNOTATIONS_PATH, help="Path to the annotations CSV.")
+    parser.add_argument("--images", default=IMAGES_PATH, help="Path to the images CSV.")
+    parser.add_argument("--limit", type=int, default=MAX_TOTAL_DOWNLOADS,
+                        help=f"Maximum number of captures to download, or -1 for all. (Default: {MAX_TOTAL_DOWNLOADS})")
+    parser.add_argument("--season", default=SEASON_PREFIX, help=f"Capture ID prefix to match. (Default: {SEASON_PREFIX})")
+    parser.add_argument("--base-url", default=BASE_URL, help="URL prefix that image paths are appended to.")
+    parser.add_argument("--output-dir", default=DOWNLOAD_FOLDER, help=f"Download folder. (Default: {DOWNLOAD_FOLDER})")
+    parser.add_argument("--workers", type=int, default=DOWNLOAD_WORKERS,
+                        help=f"Concurrent downloads. (Default: {DOWNLOAD_WORKERS})")
+    parser.add_argument("--pack-dir", default=PACK_DIR,
+                        help="Append the images to packed tar shards in this directory instead of writing one file each.")
+    args = parser.parse_args()
     download_serengeti_images(
-        ANNOTATIONS_PATH,
-        IMAGES_PATH,
-        MAX_TOTAL_DOWNLOADS,
-        SEASON_PREFIX
+        args.annotations,
+        args.images,
+        args.limit,
+        args.season,
+        base_url=args.base_url,
+        download_folder=args.output_dir,
+        workers=args.workers,
+        pack_dir=args.pack_dir
     )
\ No newline at end of file
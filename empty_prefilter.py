@@ -0,0 +1,160 @@
+# empty_prefilter.py
+import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from capture_events import group_bursts, neighbour_frames, parse_capture_name
+from extract_metadata import read_image_metadata
+from image_loader import list_images, open_image_file
+from record_store import load_records
+
+# --- CONFIGURATION ---
+PREFILTER_THRESHOLD = 0.02 # A frame is static if less than this fraction of its thumbnail changed
+PREFILTER_PIXEL_DIFF = 1.0 # Per-pixel change (in standard deviations of the normalized thumbnail)
+PREFILTER_SIZE = (64, 48) # Thumbnail size compared between frames
+PREFILTER_CONTEXT_BURSTS = 4 # Neighbouring bursts on each side that form a camera's background
+PREFILTER_MIN_CONTEXT = 2 # Fewer neighbouring bursts than this and a frame is never skipped
+PREFILTER_CONTEXT_FRAMES = 30 # Frames of the same camera either side of an image read to find its neighbouring bursts
+PREFILTER_WORKERS = 8 # Threads reading headers and thumbnails
+VALIDATION_CONF_THRES = 0.1 # Detections above this confidence count as a non-empty frame (as in sort_images)
+# ---------------------
+
+def load_thumbnail(img_path, size=PREFILTER_SIZE):
+    """
+    Decodes a small, exposure-normalized grayscale thumbnail.
+
+    For JPEGs, draft() lets the decoder scale by 1/2 to 1/8 while decoding the
+    DCT blocks, so the full-resolution frame is never built.
+    """
+    with open_image_file(img_path) as f, Image.open(f) as img:
+        img.draft('L', (size[0] * 2, size[1] * 2))
+        thumb = np.asarray(img.convert('L').resize(size, Image.BILINEAR), dtype=np.float32)
+    return (thumb - thumb.mean()) / (thumb.std() + 1e-6)
+
+def changed_fraction(frame, reference, pixel_diff=PREFILTER_PIXEL_DIFF):
+    """Fraction of thumbnail pixels that differ from the reference by more than pixel_diff."""
+    return float(np.mean(np.abs(frame - reference) > pixel_diff))
+
+def motion_scores(input_dir, filenames, context_filenames=None, workers=PREFILTER_WORKERS,
+                  pixel_diff=PREFILTER_PIXEL_DIFF):
+    """
+    Returns {filename: score} where score is the largest fraction of changed pixels
+    against (a) the median of the frame's own burst and (b) a background built
+    from the medians of the neighbouring bursts of the same camera.
+
+    A frame that changed neither within its burst nor against the camera's usual
+    view is very likely empty. Frames without enough neighbouring bursts get a
+    score of 1.0, so they are never skipped. Neighbours are taken from the
+    frames of context_filenames (default: a listing of input_dir) within
+    PREFILTER_CONTEXT_FRAMES of the target files, so only their headers are
+    read. Callers that run the prefilter per chunk or batch should list the
+    folder once and pass it in.
+    """
+    if context_filenames is None:
+        context_filenames = list_images(input_dir)
+    candidates = sorted(set(filenames).union(
+        neighbour_frames(filenames, context_filenames, window=PREFILTER_CONTEXT_FRAMES)))
+
+    def read_timestamp(filename):
+        try:
+            return read_image_metadata(os.path.join(input_dir, filename))[2]
+        except Exception:
+            return ''
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        timestamps = dict(zip(candidates, executor.map(read_timestamp, candidates)))
+
+    # Only the target bursts and their neighbours are ever decoded
+    targets = set(filenames)
+    bursts = group_bursts(candidates, timestamps)
+    burst_camera = [parse_capture_name(burst[0])[0] for burst in bursts]
+    needed = set()
+    for i, burst in enumerate(bursts):
+        if targets.intersection(burst):
+            for j in range(max(0, i - PREFILTER_CONTEXT_BURSTS), min(len(bursts), i + PREFILTER_CONTEXT_BURSTS + 1)):
+                if burst_camera[j] == burst_camera[i]:
+                    needed.add(j)
+
+    def read_thumbnail(filename):
+        try:
+            return load_thumbnail(os.path.join(input_dir, filename))
+        except Exception:
+            return None
+
+    needed_files = [filename for j in sorted(needed) for filename in bursts[j]]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        thumbnails = dict(zip(needed_files, executor.map(read_thumbnail, needed_files)))
+
+    burst_medians = {}
+    for j in needed:
+        frames = [thumbnails[filename] for filename in bursts[j] if thumbnails.get(filename) is not None]
+        if frames:
+            burst_medians[j] = np.median(np.stack(frames), axis=0)
+
+    scores = {}
+    for i, burst in enumerate(bursts):
+        if not targets.intersection(burst):
+            continue
+        neighbours = [burst_medians[j] for j in range(i - PREFILTER_CONTEXT_BURSTS, i + PREFILTER_CONTEXT_BURSTS + 1)
+                      if j != i and j in burst_medians and burst_camera[j] == burst_camera[i]]
+        background = np.median(np.stack(neighbours), axis=0) if len(neighbours) >= PREFILTER_MIN_CONTEXT else None
+        for filename in targets.intersection(burst):
+            frame = thumbnails.get(filename)
+            if frame is None or background is None:
+                scores[filename] = 1.0
+                continue
+            score = changed_fraction(frame, background, pixel_diff)
+            if len(burst) > 1 and i in burst_medians:
+                score = max(score, changed_fraction(frame, burst_medians[i], pixel_diff))
+            scores[filename] = score
+    return scores
+
+def find_static_frames(input_dir, filenames, threshold=PREFILTER_THRESHOLD, context_filenames=None,
+                       workers=PREFILTER_WORKERS):
+    """Returns the set of filenames whose motion score is below threshold (treated as empty)."""
+    scores = motion_scores(input_dir, filenames, context_filenames=context_filenames, workers=workers)
+    return {filename for filename, score in scores.items() if score < threshold}
+
+def validate(input_dir, detection_log_path, thresholds, conf_thres=VALIDATION_CONF_THRES):
+    """
+    Compares prefilter decisions with a full MegaDetector log of the same images.
+
+    For each threshold, reports how many frames would be skipped and how many of
+    those MegaDetector found non-empty (missed frames). Returns the report dict.
+    """
+    records = load_records(detection_log_path)
+    logged = sorted({record['Image_Filename'] for record in records})
+    non_empty = {record['Image_Filename'] for record in records
+                 if int(record['MD_Class_ID']) != -1 and float(record['MD_Confidence']) > conf_thres}
+    scores = motion_scores(input_dir, logged, context_filenames=list_images(input_dir))
+
+    report = {'images': len(logged), 'non_empty': len(non_empty), 'thresholds': []}
+    print(f"--- Prefilter Validation: {len(logged)} images, {len(non_empty)} non-empty per MegaDetector ---")
+    for threshold in thresholds:
+        skipped = {filename for filename, score in scores.items() if score < threshold}
+        missed = sorted(skipped & non_empty)
+        row = {'threshold': threshold, 'skipped': len(skipped),
+               'skip_rate': round(len(skipped) / len(logged), 4) if logged else 0.0,
+               'missed': len(missed),
+               'miss_rate': round(len(missed) / len(non_empty), 4) if non_empty else 0.0,
+               'missed_files': missed}
+        report['thresholds'].append(row)
+        print(f"threshold {threshold:<6g}: skips {row['skipped']:>6} frames ({row['skip_rate']:.1%}), "
+              f"misses {row['missed']:>4} non-empty frames ({row['miss_rate']:.1%})")
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Validates the empty-frame prefilter against a full MegaDetector detection log.")
+    parser.add_argument("input_dir", type=str, help="Directory containing the images.")
+    parser.add_argument("detection_log", type=str, help="Detection log from a run without the prefilter.")
+    parser.add_argument("--thresholds", type=float, nargs='+', default=[0.005, 0.01, PREFILTER_THRESHOLD, 0.05],
+                        help="Prefilter thresholds to compare.")
+    parser.add_argument("--output", type=str, default=None, help="Write the validation report as JSON to this path.")
+    args = parser.parse_args()
+    report = validate(args.input_dir, args.detection_log, args.thresholds)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f"Validation report written to: {args.output}")
\ No newline at end of file
@@ -1,112 +1,249 @@
 # export_to_json.py
-import csv
 import json
+import gzip
 import argparse
 import os
+from itertools import groupby
+from capture_events import record_event_id
+from record_store import iter_records
+import profiling
 
-def load_csv_data(csv_path):
-    """Loads all records from the CSV file."""
-    try:
-        with open(csv_path, 'r', newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            return list(reader)
-    except FileNotFoundError:
-        print(f"Error: Input CSV file not found at {csv_path}")
-        return []
-
-def create_researcher_json(input_csv_path, output_json_path):
-    """
-    Groups CSV records by image, filters for classified animal detections,
-    and converts the data to a standardized JSON format.
-    """
-    all_records = load_csv_data(input_csv_path)
-    if not all_records:
-        print("Error: Input CSV is empty or cannot be read.")
-        return
+# --- CONFIGURATION ---
+JSON_FORMAT = 'json' # 'json' (indented array), 'compact' (array, no whitespace) or 'jsonl' (one image per line)
+PER_EVENT = False # Write one entry per capture event instead of one per image
+# ---------------------
+
+JSON_FORMATS = ['json', 'compact', 'jsonl']
 
-    # 1. Group records by Image_Filename
+def group_records_by_image(all_records):
+    """Groups an in-memory record table by Image_Filename, keeping first-seen order."""
     records_by_image = {}
     for record in all_records:
         filename = record['Image_Filename']
         if filename not in records_by_image:
             records_by_image[filename] = []
         records_by_image[filename].append(record)
+    return records_by_image.items()
 
-    final_json_data = []
+def stream_groups_by_image(record_stream):
+    """
+    Yields (filename, detections) from a record stream whose rows are already
+    grouped by image, as every pipeline step writes them. Only one image's rows
+    are held at a time. Raises ValueError if an image shows up in two groups.
+    """
+    seen = set()
+    for filename, detections in groupby(record_stream, key=lambda record: record['Image_Filename']):
+        if filename in seen:
+            raise ValueError(f"Rows for {filename} are not contiguous in the detection log.")
+        seen.add(filename)
+        yield filename, list(detections)
+
+def build_image_record(filename, detections):
+    """Converts one image's records to a standardized JSON entry, or None if it has no classified animals."""
+    # Skip if essential metadata is missing
+    if not all(k in detections[0] for k in ['Image_Width', 'Image_Height', 'Timestamp']):
+        return None
 
-    # 2. Process and restructure the data for each image
-    for filename, detections in records_by_image.items():
-        # Skip if essential metadata is missing
-        if not all(k in detections[0] for k in ['Image_Width', 'Image_Height', 'Timestamp']):
+    try:
+        image_record = {
+            "file_name": filename,
+            "width": int(detections[0]['Image_Width']),
+            "height": int(detections[0]['Image_Height']),
+            "datetime_original": detections[0]['Timestamp'],
+            "annotations": []
+        }
+    except ValueError:
+        print(f"Warning: Skipping {filename} due to invalid Image_Width/Height.")
+        return None
+
+
+    for record in detections:
+        # Filter 1: Only process records that represent a valid animal detection (MD_Class_ID '0')
+        try:
+            md_class_id = int(record.get('MD_Class_ID', -1))
+            if md_class_id != 0:
+                continue 
+        except ValueError:
+            continue
+            
+        # Filter 2: Only include classified animals
+        predicted_species = record.get('Predicted_Species', '').strip()
+        if not predicted_species or predicted_species.lower() in ['unknown', 'none', '']:
             continue
 
         try:
-            image_record = {
-                "file_name": filename,
-                "width": int(detections[0]['Image_Width']),
-                "height": int(detections[0]['Image_Height']),
-                "datetime_original": detections[0]['Timestamp'],
-                "annotations": []
+            # Convert bounding box coordinates to integers
+            x_min = int(record['X_min'])
+            y_min = int(record['Y_min'])
+            x_max = int(record['X_max'])
+            y_max = int(record['Y_max'])
+            
+            # Calculate [x_min, y_min, width, height] for the standardized bbox format
+            bbox_width = x_max - x_min
+            bbox_height = y_max - y_min
+
+            annotation = {
+                "detection_id": int(record['Detection_Index']),
+                "category": predicted_species,
+                "confidence": float(record['Classification_Confidence']),
+                "bbox": [x_min, y_min, bbox_width, bbox_height]
             }
-        except ValueError:
-            print(f"Warning: Skipping {filename} due to invalid Image_Width/Height.")
+            
+            image_record['annotations'].append(annotation)
+
+        except Exception:
+            # Catch records with missing or invalid numeric data
             continue
 
+    # Filter 3: Only include image records that have annotations
+    return image_record if image_record['annotations'] else None
+
+def build_event_record(event_id, file_names, image_records):
+    """
+    Merges the JSON entries of one capture event's frames into a single entry, or None.
+
+    The annotations are those of the frame showing the most classified animals
+    (the event's representative frame). species_counts holds, per species, the
+    largest number seen in any one frame.
+    """
+    if not image_records:
+        return None
+    chosen = max(image_records, key=lambda entry: (len(entry['annotations']),
+                                                   sum(annotation['confidence'] for annotation in entry['annotations'])))
+    species_counts = {}
+    for entry in image_records:
+        counts = {}
+        for annotation in entry['annotations']:
+            counts[annotation['category']] = counts.get(annotation['category'], 0) + 1
+        for species, count in counts.items():
+            species_counts[species] = max(species_counts.get(species, 0), count)
+    timestamps = [entry['datetime_original'] for entry in image_records if entry['datetime_original']]
+    return {
+        "event_id": event_id,
+        "file_names": sorted(file_names),
+        "width": chosen['width'],
+        "height": chosen['height'],
+        "datetime_original": min(timestamps) if timestamps else '',
+        "representative_file": chosen['file_name'],
+        "species_counts": species_counts,
+        "annotations": chosen['annotations']
+    }
+
+def iter_event_records(image_groups):
+    """
+    Yields one JSON entry per capture event (Event_ID) from (filename, detections) groups.
 
-        for record in detections:
-            # Filter 1: Only process records that represent a valid animal detection (MD_Class_ID '0')
-            try:
-                md_class_id = int(record.get('MD_Class_ID', -1))
-                if md_class_id != 0:
-                    continue 
-            except ValueError:
-                continue
-                
-            # Filter 2: Only include classified animals
-            predicted_species = record.get('Predicted_Species', '').strip()
-            if not predicted_species or predicted_species.lower() in ['unknown', 'none', '']:
-                continue
-
-            try:
-                # Convert bounding box coordinates to integers
-                x_min = int(record['X_min'])
-                y_min = int(record['Y_min'])
-                x_max = int(record['X_max'])
-                y_max = int(record['Y_max'])
-                
-                # Calculate [x_min, y_min, width, height] for the standardized bbox format
-                bbox_width = x_max - x_min
-                bbox_height = y_max - y_min
-
-                annotation = {
-                    "detection_id": int(record['Detection_Index']),
-                    "category": predicted_species,
-                    "confidence": float(record['Classification_Confidence']),
-                    "bbox": [x_min, y_min, bbox_width, bbox_height]
-                }
-                
-                image_record['annotations'].append(annotation)
-
-            except Exception:
-                # Catch records with missing or invalid numeric data
-                continue
-
-        # Filter 3: Only include image records that have annotations
-        if image_record['annotations']:
-            final_json_data.append(image_record)
-
-    # 3. Write the final data to JSON
+    The log is still read one image at a time; only the compact per-image
+    entries are kept until the end, since an event's frames need not be adjacent.
+    """
+    events = {}
+    for filename, detections in image_groups:
+        event = events.setdefault(record_event_id(detections[0]), ([], []))
+        event[0].append(filename)
+        image_record = build_image_record(filename, detections)
+        if image_record is not None:
+            event[1].append(image_record)
+    for event_id, (file_names, image_records) in events.items():
+        yield build_event_record(event_id, file_names, image_records)
+
+def write_image_records(image_groups, f, output_format, per_event=PER_EVENT):
+    """
+    Writes one JSON entry per image group (or per capture event) to f as it is
+    built and returns the count.
+
+    'json' output is byte-identical to json.dump(entries, f, indent=4), but no
+    list of entries is ever built.
+    """
+    count = 0
+    if output_format != 'jsonl':
+        f.write('[')
+    if per_event:
+        entries = iter_event_records(image_groups)
+    else:
+        entries = (build_image_record(filename, detections) for filename, detections in image_groups)
+    for image_record in entries:
+        if image_record is None:
+            continue
+        if output_format == 'jsonl':
+            f.write(json.dumps(image_record))
+            f.write('\n')
+        elif output_format == 'compact':
+            f.write(',' if count else '')
+            f.write(json.dumps(image_record, separators=(',', ':')))
+        else:
+            # JSON strings never contain raw newlines, so re-indenting line by line is safe
+            f.write(',\n    ' if count else '\n    ')
+            f.write(json.dumps(image_record, indent=4).replace('\n', '\n    '))
+        count += 1
+    if output_format == 'json':
+        f.write('\n]' if count else ']')
+    elif output_format == 'compact':
+        f.write(']')
+    return count
+
+@profiling.timed_stage('json')
+def create_researcher_json(input_csv_path, output_json_path, records=None, output_format=JSON_FORMAT, compress=None,
+                           per_event=PER_EVENT):
+    """
+    Groups CSV records by image, filters for classified animal detections,
+    and converts the data to a standardized JSON format.
+    An in-memory record table can be passed instead of re-reading the CSV.
+
+    The log is streamed one image group at a time, so peak memory does not grow
+    with the number of images. compress gzips the output (the default is to
+    compress when output_json_path ends in '.gz'). per_event writes one entry per
+    capture event instead of one per image (see build_event_record).
+    """
+    if compress is None:
+        compress = output_json_path.endswith('.gz')
+
+    def open_output(path):
+        if compress:
+            return gzip.open(path, 'wt', encoding='utf-8')
+        return open(path, 'w')
+
+    if records is not None:
+        if not records:
+            print("Error: Input CSV is empty or cannot be read.")
+            return
+        image_groups = group_records_by_image(records)
+    else:
+        if not os.path.exists(input_csv_path):
+            print(f"Error: Input CSV file not found at {input_csv_path}")
+            return
+        image_groups = stream_groups_by_image(iter_records(input_csv_path))
+
+    # Write to a temporary file so a failed export never leaves a truncated file behind
     os.makedirs(os.path.dirname(output_json_path) or '.', exist_ok=True)
-    with open(output_json_path, 'w') as f:
-        json.dump(final_json_data, f, indent=4)
+    tmp_path = f"{output_json_path}.tmp"
+    try:
+        with open_output(tmp_path) as f:
+            exported_count = write_image_records(image_groups, f, output_format, per_event)
+    except ValueError as e:
+        # Logs edited by hand may interleave images; fall back to grouping in memory
+        print(f"Warning: {e} Grouping the whole log in memory instead.")
+        with open_output(tmp_path) as f:
+            exported_count = write_image_records(group_records_by_image(iter_records(input_csv_path)),
+                                                 f, output_format, per_event)
+
+    os.replace(tmp_path, output_json_path)
+    profiling.add_images(exported_count)
 
     print(f"\n--- JSON Export Complete ---")
-    print(f"Exported data for {len(final_json_data)} classified images to: {output_json_path}")
+    print(f"Exported data for {exported_count} classified {'events' if per_event else 'images'} to: {output_json_path}")
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Exports the Master Detection CSV to a standardized JSON format.")
     parser.add_argument("input_csv_path", type=str, help="Path to the final classified Master Detection CSV file.")
     parser.add_argument("output_json_path", type=str, help="Path for the output standardized JSON file.")
+    parser.add_argument("--format", dest="output_format", choices=JSON_FORMATS, default=JSON_FORMAT,
+                        help=f"'json' is an indented array, 'compact' drops the whitespace, 'jsonl' writes one image per line. (Default: {JSON_FORMAT})")
+    parser.add_argument("--gzip", dest="compress", action="store_true", default=None,
+                        help="Gzip the output (implied when the output path ends in '.gz').")
+    parser.add_argument("--per-event", action="store_true", default=PER_EVENT,
+                        help="Write one entry per capture event (burst) instead of one per image.")
     args = parser.parse_args()
-    create_researcher_json(args.input_csv_path, args.output_json_path)
\ No newline at end of file
+    with profiling.profile_run():
+        create_researcher_json(args.input_csv_path, args.output_json_path,
+                               output_format=args.output_format, compress=args.compress, per_event=args.per_event)
\ No newline at end of file
@@ -1,20 +1,34 @@
 # extract_metadata.py
 import os
-import csv
+import time
+import struct
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from PIL.ExifTags import TAGS
 import datetime
+from capture_events import assign_events, neighbour_frames
+from image_loader import list_images, open_image_file, read_image_list
+from record_store import load_records, save_records
+import profiling
+
+# --- CONFIGURATION ---
+METADATA_WORKERS = 8 # Threads reading image headers in parallel
+HEADER_BUFFER_SIZE = 64 * 1024 # Read buffer for header parsing; an EXIF APP1 segment is at most 64 KB
+# ---------------------
 
 # Define the EXIF tag ID for 'DateTimeOriginal'
 EXIF_TAG_DATETIME_ORIGINAL = 36867
+EXIF_TAG_EXIF_IFD_POINTER = 34665
+
+# JPEG Start-Of-Frame markers carry the image dimensions (DHT, JPG and DAC share the range but do not)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+JPEG_STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
 
 def load_csv_data(csv_path):
-    """Loads all records from the CSV file as strings."""
+    """Loads all records from the detection log, reporting a missing file."""
     try:
-        with open(csv_path, 'r', newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            return list(reader)
+        return load_records(csv_path)
     except FileNotFoundError:
         print(f"Error: CSV file not found at {csv_path}")
         return []
@@ -34,14 +48,135 @@ def get_exif_data(img):
         pass
     return exif_data
 
-def update_metadata(input_dir, input_csv_path, field_order_str):
-    """Adds image width, height, and timestamp to the CSV records."""
+def parse_exif_datetime(tiff):
+    """Returns DateTimeOriginal from a raw EXIF (TIFF) block, or '' if it is absent."""
+    byte_order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if byte_order is None:
+        raise ValueError("Invalid TIFF byte order in EXIF block")
+
+    def read_ifd(offset):
+        # Maps tag -> (type, count, value/offset field) for one IFD
+        (count,) = struct.unpack_from(byte_order + 'H', tiff, offset)
+        entries = {}
+        for i in range(count):
+            tag, kind, n, value = struct.unpack_from(byte_order + 'HHI4s', tiff, offset + 2 + 12 * i)
+            entries[tag] = (kind, n, value)
+        return entries
+
+    (ifd0_offset,) = struct.unpack_from(byte_order + 'I', tiff, 4)
+    entries = read_ifd(ifd0_offset)
+    if EXIF_TAG_EXIF_IFD_POINTER in entries:
+        (exif_offset,) = struct.unpack_from(byte_order + 'I', entries[EXIF_TAG_EXIF_IFD_POINTER][2])
+        entries.update(read_ifd(exif_offset))
+
+    if EXIF_TAG_DATETIME_ORIGINAL not in entries:
+        return ''
+    kind, n, value = entries[EXIF_TAG_DATETIME_ORIGINAL]
+    if kind != 2: # ASCII
+        raise ValueError("Unexpected DateTimeOriginal type")
+    if n > 4:
+        (data_offset,) = struct.unpack_from(byte_order + 'I', value)
+        value = tiff[data_offset:data_offset + n]
+    return value[:n].split(b'\x00', 1)[0].decode('ascii', errors='replace')
+
+def read_jpeg_header(img_path):
+    """
+    Returns (width, height, timestamp) by walking the JPEG marker segments.
+
+    Only the EXIF APP1 segment and the Start-Of-Frame header are read. Other
+    segments are skipped with seeks and pixel data is never touched. Raises
+    ValueError on anything that is not a well-formed JPEG header.
+    """
+    timestamp = ''
+    with open_image_file(img_path, buffering=HEADER_BUFFER_SIZE) as f:
+        if f.read(2) != b'\xff\xd8':
+            raise ValueError("Not a JPEG file")
+
+        while True:
+            byte = f.read(1)
+            if byte != b'\xff':
+                raise ValueError("Corrupt JPEG marker stream")
+            marker = f.read(1)
+            while marker == b'\xff': # Fill bytes
+                marker = f.read(1)
+            if not marker:
+                raise ValueError("Unexpected end of file")
+            marker = marker[0]
+
+            if marker in JPEG_STANDALONE_MARKERS:
+                continue
+            if marker in (0xD9, 0xDA): # End of image / start of scan before any frame header
+                raise ValueError("No frame header found")
+
+            (length,) = struct.unpack('>H', f.read(2))
+            if marker in JPEG_SOF_MARKERS:
+                _, height, width = struct.unpack('>BHH', f.read(5))
+                return width, height, timestamp
+            if marker == 0xE1 and not timestamp:
+                segment = f.read(length - 2)
+                if segment.startswith(b'Exif\x00\x00'):
+                    timestamp = parse_exif_datetime(segment[6:])
+            else:
+                f.seek(length - 2, os.SEEK_CUR)
+
+def read_image_metadata(img_path):
+    """Returns (width, height, timestamp), parsing only the JPEG header and falling back to PIL."""
+    try:
+        return read_jpeg_header(img_path)
+    except FileNotFoundError:
+        raise
+    except Exception:
+        # Malformed or non-baseline file: let PIL work it out
+        # Image.open only parses the header; pixels are never decoded here
+        with open_image_file(img_path) as f, Image.open(f) as img_pil:
+            width, height = img_pil.size
+            return width, height, get_exif_data(img_pil).get('Timestamp', '')
+
+def read_capture_events(input_dir, timestamps, workers=METADATA_WORKERS, context_filenames=None):
+    """
+    Returns {filename: event_id} for the images in timestamps (filename -> EXIF timestamp).
+
+    Nearby frames of the same cameras, taken from context_filenames (default:
+    a listing of input_dir), are read as well, so a burst that is split across
+    runs or chunks still gets a single event ID. Callers that run per chunk or
+    batch should list the folder once and pass it in.
+    """
+    if context_filenames is None:
+        context_filenames = list_images(input_dir)
+    context = [filename for filename in neighbour_frames(timestamps, context_filenames) if filename not in timestamps]
+
+    def read_timestamp(filename):
+        try:
+            return read_image_metadata(os.path.join(input_dir, filename))[2]
+        except Exception:
+            return ''
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        all_timestamps = dict(zip(context, executor.map(read_timestamp, context)))
+    all_timestamps.update(timestamps)
+    events = assign_events(list(all_timestamps), all_timestamps)
+    return {filename: events[filename] for filename in timestamps}
+
+@profiling.timed_stage('metadata')
+def update_metadata(input_dir, input_csv_path, field_order_str, records=None, images=None, only_files=None,
+                    workers=METADATA_WORKERS, context_filenames=None):
+    """
+    Adds image width, height, timestamp and capture event to the CSV records.
+
+    When called in-process, an in-memory record table is updated in place
+    and not written back. The dimensions are read from an already decoded
+    image table (filename -> RGB array) when one is given. If only_files is
+    given, only those images are updated. Headers are read by a thread pool,
+    so latency on network mounts overlaps across files. Frames of one camera
+    taken in a burst share an Event_ID (see capture_events.group_bursts);
+    context_filenames is the folder listing their neighbours are found in.
+    """
     
     field_order = field_order_str.split(',')
     
-    all_records = load_csv_data(input_csv_path)
+    all_records = records if records is not None else load_csv_data(input_csv_path)
     if not all_records:
-        return
+        return all_records
 
     print(f"Starting metadata extraction for {len(all_records)} records...")
 
@@ -49,10 +184,30 @@ def update_metadata(input_dir, input_csv_path, field_order_str):
     records_by_image = {}
     for record in all_records:
         records_by_image.setdefault(record['Image_Filename'], []).append(record)
+    if only_files is not None:
+        records_by_image = {filename: records_by_image[filename] for filename in only_files if filename in records_by_image}
 
     metadata_added_count = 0
+    timestamps = {}
     
-    for filename, records in records_by_image.items():
+    # Per-file header read times (list.append is thread-safe)
+    latencies = []
+
+    def timed_read(img_path):
+        start = time.perf_counter()
+        try:
+            return read_image_metadata(img_path)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    # Read all headers in parallel; results are consumed in order
+    with profiling.substep('read_headers'):
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {filename: executor.submit(timed_read, os.path.join(input_dir, filename))
+                       for filename in records_by_image}
+    profiling.add_latencies(latencies)
+
+    for filename, image_records in records_by_image.items():
         img_path = os.path.join(input_dir, filename)
         
         # Initialize default values
@@ -60,13 +215,12 @@ def update_metadata(input_dir, input_csv_path, field_order_str):
         timestamp = ''
         
         try:
-            with Image.open(img_path) as img_pil:
-                # 1. Extract Dimensions
-                width, height = img_pil.size
-                
-                # 2. Extract Timestamp
-                exif = get_exif_data(img_pil)
-                timestamp = exif.get('Timestamp', '')
+            # 1. Extract Dimensions and 2. Extract Timestamp
+            width, height, timestamp = futures[filename].result()
+
+            # Reuse the decoded buffer's dimensions if there is one
+            if images is not None and filename in images:
+                height, width = images[filename].shape[:2]
 
         except FileNotFoundError:
             print(f"Warning: Image file not found at {img_path}. Skipping metadata extraction.")
@@ -74,28 +228,31 @@ def update_metadata(input_dir, input_csv_path, field_order_str):
             print(f"Error processing image {filename}: {e}. Setting metadata to default.")
             
         # Update all records belonging to this image
-        for record in records:
+        for record in image_records:
             record['Image_Width'] = width
             record['Image_Height'] = height
             record['Timestamp'] = timestamp
             metadata_added_count += 1
+        timestamps[filename] = timestamp
+
+    # Group the frames into capture events (bursts)
+    with profiling.substep('events'):
+        events = read_capture_events(input_dir, timestamps, workers, context_filenames=context_filenames)
+    for filename, image_records in records_by_image.items():
+        for record in image_records:
+            record['Event_ID'] = events[filename]
+    print(f"Grouped {len(timestamps)} images into {len(set(events.values()))} capture events.")
                 
     # Re-Export the entire updated CSV file
-    
-    # Get the union of all keys from all records to ensure the header is complete
-    all_keys = set()
-    for record in all_records:
-        all_keys.update(record.keys())
-    
-    fieldnames = list(all_keys)
-    
-    with open(input_csv_path, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=field_order)
-        writer.writeheader()
-        writer.writerows(all_records)
-
     print(f"\n--- Metadata Extraction Complete ---")
-    print(f"Updated {metadata_added_count} records with image size and timestamp in: {input_csv_path}")
+
+    if records is None:
+        with profiling.substep('write'):
+            save_records(all_records, input_csv_path, field_order)
+        print(f"Updated {metadata_added_count} records with image size, timestamp and event in: {input_csv_path}")
+    else:
+        print(f"Updated {metadata_added_count} records with image size, timestamp and event.")
+    return all_records
 
 
 if __name__ == '__main__':
@@ -103,5 +260,12 @@ if __name__ == '__main__':
     parser.add_argument("input_dir", type=str, help="Directory containing input images.")
     parser.add_argument("input_csv_path", type=str, help="Path to the Master Detection CSV file to be updated.")
     parser.add_argument("field_order", type=str, help="Comma-separated string defining the final CSV column order.")
+    parser.add_argument("--images-from", type=str, default=None,
+                        help="File listing the image filenames to process (one per line); other rows are left untouched.")
+    parser.add_argument("--workers", type=int, default=METADATA_WORKERS,
+                        help=f"Number of threads reading image headers. (Default: {METADATA_WORKERS})")
     args = parser.parse_args()
-    update_metadata(args.input_dir, args.input_csv_path, args.field_order)
\ No newline at end of file
+    with profiling.profile_run():
+        update_metadata(args.input_dir, args.input_csv_path, args.field_order,
+                        only_files=read_image_list(args.images_from) if args.images_from else None,
+                        workers=args.workers)
\ No newline at end of file
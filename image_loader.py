@@ -0,0 +1,227 @@
+# image_loader.py
+import os
+import glob
+import fnmatch
+import threading
+import collections
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from image_pack import open_pack
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    TURBOJPEG = TurboJPEG()
+except Exception: # PyTurboJPEG (and libjpeg-turbo) are optional; PIL's draft mode is used without them
+    TURBOJPEG = None
+
+# --- CONFIGURATION ---
+LOADER_WORKERS = 4 # Number of background decode workers
+PREFETCH_DEPTH = 16 # Maximum number of decoded images held ahead of the model
+# ---------------------
+
+# Scale-down factors a JPEG decoder can apply to the DCT blocks directly, largest first
+JPEG_REDUCTIONS = (8, 4, 2)
+
+def packed_member(img_path):
+    """Returns (pack, filename) if img_path names an image inside a pack directory (see image_pack.py), else (None, None)."""
+    input_dir, filename = os.path.split(img_path)
+    pack = open_pack(input_dir or '.')
+    return (pack, filename) if pack is not None else (None, None)
+
+def open_image_file(img_path, buffering=-1):
+    """Opens an image for binary reading, whether it is a file or packed."""
+    pack, filename = packed_member(img_path)
+    if pack is not None:
+        return pack.open(filename)
+    return open(img_path, 'rb', buffering=buffering)
+
+def read_image_bytes(img_path):
+    """Returns an image's encoded bytes; packed images are a zero-copy memoryview of their shard."""
+    pack, filename = packed_member(img_path)
+    if pack is not None:
+        return pack.view(filename)
+    with open(img_path, 'rb') as f:
+        return f.read()
+
+def image_stat(img_path):
+    """Returns (size, mtime_ns) of an image file or packed image; raises FileNotFoundError if it is missing."""
+    pack, filename = packed_member(img_path)
+    if pack is not None:
+        return pack.stat(filename)
+    stat = os.stat(img_path)
+    return stat.st_size, stat.st_mtime_ns
+
+def load_rgb_image(img_path, max_side=None):
+    """Decodes an image to an RGB array, optionally shrinking it so its longest side is at most max_side."""
+    with open_image_file(img_path) as f, Image.open(f) as img:
+        img = img.convert('RGB')
+        if max_side and max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.BILINEAR)
+        return np.array(img)
+
+def pick_reduction(size, min_side=None, max_reduction=JPEG_REDUCTIONS[0]):
+    """
+    Returns the largest JPEG reduction (1, 2, 4 or 8) for an image of size (width, height)
+    that keeps its longest side at least min_side and does not exceed max_reduction.
+    """
+    for reduction in JPEG_REDUCTIONS:
+        if reduction <= max_reduction and (min_side is None or max(size) // reduction >= min_side):
+            return reduction
+    return 1
+
+def load_reduced_image(img_path, min_side=None, max_reduction=JPEG_REDUCTIONS[0]):
+    """
+    Decodes an image to an RGB array at a reduced JPEG scale (see pick_reduction).
+
+    The decoder scales the DCT blocks by 1/2, 1/4 or 1/8 while decoding, so the
+    full-resolution frame is never built. libjpeg-turbo is used through
+    PyTurboJPEG when it is installed, PIL's draft mode otherwise. Returns
+    (image, scale), where scale is the (x, y) factor from decoded to original
+    pixel coordinates. Non-JPEG files are decoded at full size.
+    """
+    if TURBOJPEG is not None and os.path.splitext(img_path)[1].lower() in ('.jpg', '.jpeg'):
+        data = read_image_bytes(img_path)
+        try:
+            width, height = TURBOJPEG.decode_header(data)[:2]
+            reduction = pick_reduction((width, height), min_side, max_reduction)
+            image = TURBOJPEG.decode(data, pixel_format=TJPF_RGB, scaling_factor=(1, reduction))
+            return image, (width / image.shape[1], height / image.shape[0])
+        except OSError:
+            pass # Not something libjpeg-turbo can read; let PIL try
+
+    with open_image_file(img_path) as f, Image.open(f) as img:
+        width, height = img.size
+        reduction = pick_reduction(img.size, min_side, max_reduction)
+        if reduction > 1:
+            img.draft('RGB', (-(-width // reduction), -(-height // reduction)))
+        img = img.convert('RGB')
+        return np.array(img), (width / img.size[0], height / img.size[1])
+
+class DecodeStats:
+    """Tallies decoded versus full-resolution pixels on the reduced decode path (thread-safe)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.images = 0
+        self.full_pixels = 0
+        self.decoded_pixels = 0
+        self.reductions = collections.Counter()
+
+    def add(self, image, scale):
+        height, width = image.shape[:2]
+        with self.lock:
+            self.images += 1
+            self.decoded_pixels += width * height
+            self.full_pixels += int(round(width * scale[0])) * int(round(height * scale[1]))
+            self.reductions[int(round(scale[0]))] += 1
+
+    def report(self):
+        """Prints how much decoding and buffer memory the reduced scales saved."""
+        if not self.images:
+            return
+        saved = 1 - self.decoded_pixels / self.full_pixels if self.full_pixels else 0.0
+        scales = ", ".join(f"1/{reduction}: {count}" if reduction > 1 else f"full: {count}"
+                           for reduction, count in sorted(self.reductions.items(), reverse=True))
+        print(f"Reduced decode: {self.images} images ({scales}), "
+              f"{self.full_pixels * 3 / self.images / 2**20:.1f} MB -> {self.decoded_pixels * 3 / self.images / 2**20:.1f} MB "
+              f"per RGB buffer ({saved:.0%} fewer pixels decoded)")
+
+def prefetch_images(items, load_fn, workers=LOADER_WORKERS, depth=PREFETCH_DEPTH):
+    """
+    Decodes images in background workers and yields them in input order.
+
+    Yields (item, image, error) tuples, where image is load_fn(item) and error is
+    the exception it raised (image is then None). At most `depth` images are in
+    flight or waiting at any time, so decoding overlaps inference without holding
+    the whole folder in memory. Thread workers suit PIL, which releases the GIL
+    while decoding.
+    """
+    items = list(items)
+    depth = max(1, depth)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = collections.deque()
+        next_index = 0
+
+        while next_index < len(items) or pending:
+            # Keep the queue topped up to the configured depth
+            while next_index < len(items) and len(pending) < depth:
+                item = items[next_index]
+                pending.append((item, executor.submit(load_fn, item)))
+                next_index += 1
+
+            item, future = pending.popleft()
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+
+def list_images(input_dir):
+    """Returns the filenames of the input images in input_dir (in pack order for a pack directory)."""
+    pack = open_pack(input_dir)
+    if pack is not None:
+        return [filename for filename in pack.names() if fnmatch.fnmatch(filename, '*.jpg')]
+    return [os.path.basename(img_path) for img_path in glob.glob(os.path.join(input_dir, '*.jpg'))]
+
+def read_image_list(list_path):
+    """Reads a newline-separated list of image filenames (as written for --images-from)."""
+    with open(list_path, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def write_image_list(filenames, list_path):
+    """Writes image filenames one per line, for a step's --images-from argument."""
+    os.makedirs(os.path.dirname(list_path) or '.', exist_ok=True)
+    with open(list_path, 'w') as f:
+        f.writelines(f"{filename}\n" for filename in filenames)
+
+def load_image_from_dir(input_dir, filename, load_fn=load_rgb_image):
+    """Loads `filename` from `input_dir` with load_fn."""
+    return load_fn(os.path.join(input_dir, filename))
+
+def iter_decoded_images(input_dir, filenames, images=None, workers=LOADER_WORKERS, depth=PREFETCH_DEPTH):
+    """
+    Yields (filename, image, error) for each filename, in order.
+
+    When an in-memory image table (filename -> RGB array) is given, its buffers
+    are reused and nothing is decoded again. Otherwise the images are
+    prefetched from input_dir.
+    """
+    if images is not None:
+        for filename in filenames:
+            if filename in images:
+                yield filename, images[filename], None
+            else:
+                yield filename, None, FileNotFoundError(os.path.join(input_dir, filename))
+        return
+
+    yield from prefetch_images(filenames, functools.partial(load_image_from_dir, input_dir),
+                               workers=workers, depth=depth)
+
+def iter_reduced_images(input_dir, filenames, min_side=None, max_reductions=None, images=None,
+                        workers=LOADER_WORKERS, depth=PREFETCH_DEPTH, stats=None):
+    """
+    Yields (filename, image, scale, error) for each filename, in order.
+
+    Like iter_decoded_images, but each image is decoded at a reduced JPEG scale
+    (see load_reduced_image), keeping its longest side at least min_side.
+    max_reductions optionally maps filename -> the largest reduction allowed for
+    that image. Buffers from an in-memory image table are used as they are,
+    with scale (1.0, 1.0). A DecodeStats, if given, tallies the savings.
+    """
+    if images is not None:
+        for filename, image, error in iter_decoded_images(input_dir, filenames, images=images):
+            yield filename, image, (1.0, 1.0), error
+        return
+
+    def load(filename):
+        max_reduction = max_reductions.get(filename, 1) if max_reductions is not None else JPEG_REDUCTIONS[0]
+        image, scale = load_reduced_image(os.path.join(input_dir, filename), min_side, max_reduction)
+        if stats is not None:
+            stats.add(image, scale)
+        return image, scale
+
+    for filename, result, error in prefetch_images(filenames, load, workers=workers, depth=depth):
+        image, scale = result if error is None else (None, None)
+        yield filename, image, scale, error
\ No newline at end of file
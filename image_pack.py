@@ -0,0 +1,259 @@
+# image_pack.py
+import io
+import os
+import re
+import mmap
+import time
+import sqlite3
+import tarfile
+import argparse
+import threading
+from urllib.request import pathname2url
+
+# --- CONFIGURATION ---
+PACK_SHARD_MB = 1024 # A new tar shard is started once the current one reaches this size
+PACK_COMMIT_EVERY = 256 # Images written between index commits (readers only see committed images)
+# ---------------------
+
+PACK_INDEX = 'pack_index.sqlite'
+SHARD_PATTERN = 'pack-%05d.tar'
+SHARD_RE = re.compile(r'^pack-(\d+)\.tar$')
+
+def is_pack_dir(path):
+    """True if path is a directory of packed image shards (it holds a pack index)."""
+    return os.path.isfile(os.path.join(path, PACK_INDEX))
+
+def connect_index(pack_dir, read_only=False):
+    """
+    Opens the pack index. It keeps SQLite's default rollback journal, since WAL
+    mode needs shared memory that network filesystems do not provide. Readers
+    open it read-only, so a pack on a read-only mount can still be read.
+    """
+    index_path = os.path.abspath(os.path.join(pack_dir, PACK_INDEX))
+    if read_only:
+        return sqlite3.connect(f"file:{pathname2url(index_path)}?mode=ro", uri=True, check_same_thread=False)
+    conn = sqlite3.connect(index_path, check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS members ("
+        " name TEXT PRIMARY KEY,"
+        " shard TEXT NOT NULL,"
+        " offset INTEGER NOT NULL,"
+        " size INTEGER NOT NULL,"
+        " mtime_ns INTEGER NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS members_position ON members(shard, offset)")
+    conn.commit()
+    return conn
+
+class MemberReader(io.RawIOBase):
+    """Read-only, seekable file object over the bytes of one packed image (no copy until read)."""
+
+    def __init__(self, view):
+        super().__init__()
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._pos, os.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(len(self._view), self._pos + size)
+        data = self._view[self._pos:end].tobytes() if end > self._pos else b''
+        self._pos = max(self._pos, end)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._view = None
+        super().close()
+
+class ImagePack:
+    """
+    Reads images from a directory of packed tar shards.
+
+    Each shard (pack-00000.tar, ...) is a plain uncompressed tar, so the images
+    can still be extracted with any tar tool. The SQLite index maps each image
+    filename to its shard, the offset and size of its bytes and its original
+    mtime. Shards are memory-mapped, so an image is a zero-copy slice of the
+    map and a run over the pack turns into large sequential reads instead of
+    one open/stat per small file. Open packs through open_pack, which keeps one
+    ImagePack per directory and process.
+    """
+
+    def __init__(self, pack_dir):
+        self.pack_dir = pack_dir
+        self._maps = {}
+        self._lock = threading.Lock()
+        self._conn = connect_index(pack_dir, read_only=True)
+
+    def names(self):
+        """Returns the image filenames in pack order, so reading them in turn walks each shard front to back."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT name FROM members ORDER BY shard, offset")]
+
+    def member(self, name):
+        """Returns (shard, offset, size, mtime_ns) of a packed image, or raises FileNotFoundError."""
+        with self._lock:
+            row = self._conn.execute("SELECT shard, offset, size, mtime_ns FROM members WHERE name = ?",
+                                     (name,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(os.path.join(self.pack_dir, name))
+        return row
+
+    def __contains__(self, name):
+        try:
+            self.member(name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def stat(self, name):
+        """Returns (size, mtime_ns) of a packed image."""
+        return tuple(self.member(name)[2:])
+
+    def view(self, name):
+        """Returns the bytes of a packed image as a read-only memoryview into the shard's memory map."""
+        shard, offset, size, _ = self.member(name)
+        with self._lock:
+            shard_map = self._maps.get(shard)
+            # A shard still being written may have grown since it was mapped
+            if shard_map is None or len(shard_map) < offset + size:
+                with open(os.path.join(self.pack_dir, shard), 'rb') as f:
+                    shard_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if hasattr(shard_map, 'madvise'):
+                    shard_map.madvise(mmap.MADV_SEQUENTIAL)
+                self._maps[shard] = shard_map
+        return memoryview(shard_map)[offset:offset + size]
+
+    def open(self, name):
+        """Returns a file object reading one packed image."""
+        return MemberReader(self.view(name))
+
+# One ImagePack per (process, directory); process pools must not share SQLite connections
+_PACKS = {}
+_PACKS_LOCK = threading.Lock()
+
+def open_pack(pack_dir):
+    """Returns the ImagePack of pack_dir, or None if it is an ordinary directory."""
+    key = (os.getpid(), os.path.abspath(pack_dir))
+    if key not in _PACKS:
+        with _PACKS_LOCK:
+            if key not in _PACKS:
+                _PACKS[key] = ImagePack(pack_dir) if is_pack_dir(pack_dir) else None
+    return _PACKS[key]
+
+class PackWriter:
+    """
+    Appends images to a pack directory (see ImagePack), rolling over to a new
+    tar shard every shard_mb. Thread-safe. Images already in the pack are
+    skipped. Each writer starts a fresh shard, so an interrupted run never
+    leaves a half-written image inside an indexed shard. Readers see new images
+    once the index is committed (every PACK_COMMIT_EVERY images and on close).
+    """
+
+    def __init__(self, pack_dir, shard_mb=PACK_SHARD_MB):
+        os.makedirs(pack_dir, exist_ok=True)
+        self.pack_dir = pack_dir
+        self.shard_bytes = shard_mb * 1024 * 1024
+        self.added = 0
+        self._lock = threading.Lock()
+        self._conn = connect_index(pack_dir)
+        self._tar = None
+        self._shard = None
+        numbers = [int(match.group(1)) for match in map(SHARD_RE.match, os.listdir(pack_dir)) if match]
+        self._next_shard = max(numbers) + 1 if numbers else 0
+
+    def __contains__(self, name):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM members WHERE name = ?", (name,)).fetchone() is not None
+
+    def _commit(self):
+        # Image bytes reach the shard before the index points at them
+        if self._tar is not None:
+            self._tar.fileobj.flush()
+        self._conn.commit()
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+        self._conn.commit()
+
+    def add(self, name, data, mtime_ns=None):
+        """Appends one image's bytes under name; returns False if the pack already holds it."""
+        mtime_ns = time.time_ns() if mtime_ns is None else mtime_ns
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM members WHERE name = ?", (name,)).fetchone():
+                return False
+            if self._tar is None or self._tar.offset >= self.shard_bytes:
+                self._close_shard()
+                self._shard = SHARD_PATTERN % self._next_shard
+                self._next_shard += 1
+                self._tar = tarfile.open(os.path.join(self.pack_dir, self._shard), 'w')
+
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = mtime_ns // 10**9 # Whole seconds keep the header plain ustar
+            self._tar.addfile(info, io.BytesIO(data))
+            # The data sits right before the padding to the next 512-byte block
+            offset = self._tar.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            self._conn.execute("INSERT INTO members VALUES (?, ?, ?, ?, ?)",
+                               (name, self._shard, offset, len(data), mtime_ns))
+            self.added += 1
+            if self.added % PACK_COMMIT_EVERY == 0:
+                self._commit()
+            return True
+
+    def add_file(self, path, name=None):
+        """Appends an image file (under its basename by default), keeping its mtime."""
+        with open(path, 'rb') as f:
+            data = f.read()
+        return self.add(name or os.path.basename(path), data, os.stat(path).st_mtime_ns)
+
+    def close(self):
+        """Finishes the current shard and commits the index."""
+        with self._lock:
+            self._close_shard()
+            self._conn.close()
+
+def pack_folder(input_dir, pack_dir, shard_mb=PACK_SHARD_MB):
+    """
+    Packs the '*.jpg' images of input_dir into pack_dir, in filename order so
+    the frames of a roll end up next to each other. Returns the number added.
+    """
+    from image_loader import list_images
+    filenames = sorted(list_images(input_dir))
+    writer = PackWriter(pack_dir, shard_mb)
+    start = time.perf_counter()
+    try:
+        for filename in filenames:
+            writer.add_file(os.path.join(input_dir, filename))
+    finally:
+        writer.close()
+    print(f"Packed {writer.added} of {len(filenames)} images into {pack_dir} in {time.perf_counter() - start:.1f}s "
+          f"({len(filenames) - writer.added} already packed)")
+    return writer.added
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Packs a folder of images into memory-mapped tar shards that every pipeline step can read as its input directory.")
+    parser.add_argument("input_dir", type=str, help="Directory containing the source images.")
+    parser.add_argument("pack_dir", type=str, help="Directory to write the tar shards and their index to.")
+    parser.add_argument("--shard-mb", type=int, default=PACK_SHARD_MB,
+                        help=f"Size at which a new shard is started. (Default: {PACK_SHARD_MB})")
+    args = parser.parse_args()
+    pack_folder(args.input_dir, args.pack_dir, args.shard_mb)
\ No newline at end of file
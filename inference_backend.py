@@ -0,0 +1,402 @@
+# inference_backend.py
+import os
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+from PIL import Image
+import torch
+from backend_names import DETECTOR_BACKENDS, CLASSIFIER_BACKENDS
+from capture_events import box_iou
+
+try:
+    import onnxruntime as ort
+except ImportError: # ONNX Runtime is optional; only the 'onnx' backend needs it
+    ort = None
+
+# --- CONFIGURATION ---
+INFERENCE_THREADS = None # Intra-op threads for PyTorch and ONNX Runtime (None keeps the library default)
+INTEROP_THREADS = None # Inter-op threads for PyTorch and ONNX Runtime (None keeps the library default)
+ONNX_DIR = os.path.join('data', 'onnx_models') # Exported ONNX graphs are kept here and reused
+ONNX_OPSET = 17
+PARITY_IOU_THRES = 0.5 # An eager box without a backend box of the same class overlapping this much is a disagreement
+BATCH_PARITY_IOU_THRES = 0.9 # Batched and single-image boxes come from the same weights, so they must overlap this much
+# ---------------------
+
+# Thread counts applied to ONNX Runtime sessions created after configure_threads
+THREAD_SETTINGS = {'threads': INFERENCE_THREADS, 'interop_threads': INTEROP_THREADS}
+
+def backend_model_name(name, backend):
+    """Names a model for the inference cache; non-eager backends get their own entries."""
+    return name if backend == 'eager' else f"{name}-{backend}"
+
+def configure_threads(threads=INFERENCE_THREADS, interop_threads=INTEROP_THREADS):
+    """Sets the intra- and inter-op thread counts for PyTorch and for ONNX Runtime sessions created afterwards."""
+    THREAD_SETTINGS.update(threads=threads, interop_threads=interop_threads)
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # PyTorch only accepts this before any inter-op work has started
+            print(f"Warning: inter-op threads are already fixed at {torch.get_num_interop_threads()}.")
+    print(f"Inference threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op")
+
+def onnx_session(onnx_path):
+    """Opens an ONNX Runtime CPU session with the configured thread counts."""
+    if ort is None:
+        raise ImportError("The 'onnx' backend requires onnxruntime (pip install onnxruntime).")
+    options = ort.SessionOptions()
+    if THREAD_SETTINGS['threads']:
+        options.intra_op_num_threads = THREAD_SETTINGS['threads']
+    if THREAD_SETTINGS['interop_threads']:
+        options.inter_op_num_threads = THREAD_SETTINGS['interop_threads']
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    return ort.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+
+def weights_tag(module):
+    """Short fingerprint of a module's weights; export names carry it, so changed weights get a fresh graph."""
+    digest = hashlib.sha256()
+    for key, value in module.state_dict().items():
+        if torch.is_tensor(value):
+            digest.update(key.encode())
+            digest.update(value.detach().cpu().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()[:12]
+
+def quantized_weight_share(module, layer_types):
+    """Fraction of a module's parameters held by layers of the given types."""
+    total = sum(parameter.numel() for parameter in module.parameters())
+    covered = sum(parameter.numel() for layer in module.modules() if isinstance(layer, tuple(layer_types))
+                  for parameter in layer.parameters(recurse=False))
+    return covered / total if total else 0.0
+
+def export_onnx(module, example, onnx_path):
+    """Exports module to onnx_path with a dynamic batch axis, unless it was exported before."""
+    if os.path.exists(onnx_path):
+        return onnx_path
+    print(f"Exporting ONNX graph: {onnx_path}")
+    os.makedirs(os.path.dirname(onnx_path) or '.', exist_ok=True)
+    tmp_path = f"{onnx_path}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(module, example, tmp_path, input_names=['images'], output_names=['output'],
+                          dynamic_axes={'images': {0: 'batch'}, 'output': {0: 'batch'}}, opset_version=ONNX_OPSET)
+    os.replace(tmp_path, onnx_path)
+    return onnx_path
+
+def onnx_forward(session):
+    """Returns a forward function running a batch tensor through an ONNX Runtime session."""
+    def forward(batch, *args, **kwargs):
+        output = session.run(None, {'images': batch.detach().cpu().numpy().astype(np.float32)})[0]
+        return torch.from_numpy(output).to(batch.device)
+    return forward
+
+class FirstOutput(torch.nn.Module):
+    """Keeps only the first output of a detection network, the predictions its post-processing reads."""
+
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, x):
+        output = self.module(x)
+        return output[0] if isinstance(output, (list, tuple)) else output
+
+class PerShapeDetector(torch.nn.Module):
+    """
+    Stands in for the network inside MegaDetector's Ultralytics predictor and
+    runs it as a TorchScript or ONNX graph.
+
+    YOLO heads bake the anchor grid of the input size into a traced or exported
+    graph, so one graph is built per letterboxed input size, the first time it
+    is seen. Camera-trap frames only come in a few sizes.
+    """
+
+    def __init__(self, network, backend, name):
+        super().__init__()
+        self.network = FirstOutput(network).eval()
+        self.backend = backend
+        self.name = name
+        self.graphs = {}
+        self.tag = None
+
+    def build(self, example):
+        if self.backend == 'torchscript':
+            with torch.no_grad():
+                return torch.jit.freeze(torch.jit.trace(self.network, example, check_trace=False))
+        height, width = example.shape[2:]
+        if self.tag is None:
+            self.tag = weights_tag(self.network)
+        onnx_path = export_onnx(self.network, example,
+                                os.path.join(ONNX_DIR, f"{self.name}_{self.tag}_{height}x{width}.onnx"))
+        return onnx_forward(onnx_session(onnx_path))
+
+    def forward(self, x, *args, **kwargs):
+        shape = tuple(x.shape[2:])
+        if shape not in self.graphs:
+            self.graphs[shape] = self.build(x[:1])
+        with torch.no_grad():
+            return self.graphs[shape](x)
+
+def apply_detector_backend(detection_model, backend, name):
+    """
+    Switches MegaDetector's network to another backend in place and returns the model.
+
+    'compile' wraps the network in torch.compile; 'torchscript' and 'onnx' use
+    PerShapeDetector. Letterboxing and post-processing stay with the Ultralytics
+    predictor, so the results have the same format as with the eager model.
+    """
+    if backend == 'eager':
+        return detection_model
+    if backend not in DETECTOR_BACKENDS:
+        raise ValueError(f"Unknown detector backend '{backend}'; choose from {', '.join(DETECTOR_BACKENDS)}.")
+
+    predictor = getattr(detection_model, 'predictor', None)
+    network = getattr(getattr(predictor, 'model', None), 'model', None)
+    if not isinstance(network, torch.nn.Module):
+        print(f"Warning: this detector does not expose its network; running it eager instead of '{backend}'.")
+        return detection_model
+
+    if backend == 'compile':
+        predictor.model.model = torch.compile(network, dynamic=True)
+    else:
+        predictor.model.model = PerShapeDetector(network, backend, name)
+    detection_model.backend = backend
+    print(f"Detector backend: {backend}")
+    return detection_model
+
+def apply_classifier_backend(classification_model, backend, name):
+    """
+    Switches a PytorchWildlife classifier's forward pass to another backend and returns the model.
+
+    'int8' applies dynamic int8 quantization to the Linear layers only (a
+    quantized copy is returned); the convolutions of a CNN classifier stay in
+    float, so most of its compute is unchanged. 'torchscript', 'compile' and 'onnx' replace the forward
+    pass, traced or exported at the input size of the model's transform. The
+    transform and results_generation are kept, so predictions come out in the
+    same format.
+    """
+    if backend == 'eager':
+        return classification_model
+    if backend not in CLASSIFIER_BACKENDS:
+        raise ValueError(f"Unknown classifier backend '{backend}'; choose from {', '.join(CLASSIFIER_BACKENDS)}.")
+
+    classification_model.eval()
+    if backend == 'int8':
+        share = quantized_weight_share(classification_model, {torch.nn.Linear})
+        classification_model = torch.ao.quantization.quantize_dynamic(classification_model, {torch.nn.Linear},
+                                                                      dtype=torch.qint8)
+        classification_model.quantized_weight_share = share
+        print(f"int8 quantizes the Linear layers only ({share:.1%} of the classifier's weights).")
+    else:
+        transform = getattr(classification_model, 'transform', None)
+        if transform is None:
+            print(f"Warning: this classifier has no input transform to trace; running it eager instead of '{backend}'.")
+            return classification_model
+        example = transform(Image.new('RGB', (256, 256))).unsqueeze(0)
+
+        if backend == 'compile':
+            forward = torch.compile(classification_model.forward, dynamic=True)
+        elif backend == 'torchscript':
+            with torch.no_grad():
+                traced = torch.jit.freeze(torch.jit.trace(classification_model, example, check_trace=False))
+            forward = lambda batch: traced(batch)
+        else:
+            onnx_path = export_onnx(classification_model, example,
+                                    os.path.join(ONNX_DIR, f"{name}_{weights_tag(classification_model)}.onnx"))
+            forward = onnx_forward(onnx_session(onnx_path))
+        # An instance attribute takes precedence over the class's forward method
+        classification_model.forward = forward
+
+    classification_model.backend = backend
+    print(f"Classifier backend: {backend}")
+    return classification_model
+
+def match_boxes(reference, candidate, iou_thres=PARITY_IOU_THRES):
+    """
+    Pairs each detection in reference with the best-overlapping same-class
+    detection in candidate (at least iou_thres). Returns (pairs, unmatched),
+    unmatched counting the detections of either side left without a partner.
+    """
+    remaining = [record for record in candidate if int(record['MD_Class_ID']) != -1]
+    pairs = []
+    unmatched = 0
+    for record in reference:
+        if int(record['MD_Class_ID']) == -1:
+            continue
+        matches = [other for other in remaining if other['MD_Class_ID'] == record['MD_Class_ID']
+                   and box_iou(record, other) >= iou_thres]
+        if matches:
+            best = max(matches, key=lambda other: box_iou(record, other))
+            remaining.remove(best)
+            pairs.append((record, best))
+        else:
+            unmatched += 1
+    return pairs, unmatched + len(remaining)
+
+def unmatched_boxes(reference, candidate, iou_thres=PARITY_IOU_THRES):
+    """Counts detections in reference without a same-class detection in candidate overlapping at least iou_thres."""
+    return match_boxes(reference, candidate, iou_thres)[1]
+
+def group_by_image(records):
+    by_image = {}
+    for record in records:
+        by_image.setdefault(record['Image_Filename'], []).append(record)
+    return by_image
+
+def parity_check(input_dir, detector_backend='eager', classifier_backend='eager', limit=None, batch_size=None):
+    """
+    Compares the chosen backends with the eager models on the images in input_dir.
+
+    Detection is compared image by image (boxes matched by class and IoU),
+    classification crop by crop on the eager detector's animal boxes. Returns a
+    report with the timings, the speedups and the number of disagreements.
+    Building a graph (tracing, compiling, exporting) happens on a warm-up image
+    and is reported separately. With batch_size, the eager detector is also run
+    batch_size frames per forward pass and compared with single frames; the
+    boxes and confidences should agree.
+    """
+    import supervision as sv
+    import detect_and_log
+    import classify_data
+    from image_loader import list_images, load_rgb_image
+
+    filenames = sorted(list_images(input_dir))[:limit]
+    if not filenames:
+        raise FileNotFoundError(f"No images found in {input_dir}")
+    paths = [os.path.join(input_dir, filename) for filename in filenames]
+    images = [load_rgb_image(path) for path in paths]
+    report = {'images': len(filenames)}
+
+    def detect_all(model, size=1):
+        start = time.perf_counter()
+        records = []
+        for i in range(0, len(filenames), size):
+            batch_results = detect_and_log.detect_image_batch(model, images[i:i + size], paths[i:i + size])
+            for filename, results in zip(filenames[i:i + size], batch_results):
+                records.extend(detect_and_log.build_detection_records(filename, results))
+        return records, time.perf_counter() - start
+
+    def warm_up(run):
+        start = time.perf_counter()
+        run()
+        return round(time.perf_counter() - start, 3)
+
+    eager_detector = detect_and_log.load_detection_model()
+    warm_up(lambda: detect_and_log.detect_image_batch(eager_detector, images[:1], paths[:1]))
+    eager_records, eager_seconds = detect_all(eager_detector)
+    if batch_size:
+        batched_records, batched_seconds = detect_all(eager_detector, batch_size)
+        single_by_image, batched_by_image = group_by_image(eager_records), group_by_image(batched_records)
+        matched = {filename: match_boxes(single_by_image[filename], batched_by_image.get(filename, []),
+                                         BATCH_PARITY_IOU_THRES) for filename in filenames}
+        deltas = [abs(float(single['MD_Confidence']) - float(batched['MD_Confidence']))
+                  for pairs, _ in matched.values() for single, batched in pairs]
+        report['batch'] = {
+            'batch_size': batch_size, 'single_seconds': round(eager_seconds, 3),
+            'batched_seconds': round(batched_seconds, 3),
+            'speedup': round(eager_seconds / batched_seconds, 2) if batched_seconds else None,
+            'images_disagreeing': sum(1 for _, unmatched in matched.values() if unmatched),
+            'boxes_disagreeing': sum(unmatched for _, unmatched in matched.values()),
+            'max_confidence_delta': round(max(deltas, default=0.0), 4),
+        }
+    if detector_backend != 'eager':
+        backend_detector = detect_and_log.load_detection_model(backend=detector_backend)
+        build_seconds = warm_up(lambda: detect_and_log.detect_image_batch(backend_detector, images[:1], paths[:1]))
+        backend_records, backend_seconds = detect_all(backend_detector)
+        eager_by_image, backend_by_image = group_by_image(eager_records), group_by_image(backend_records)
+        differing = {filename: unmatched_boxes(eager_by_image[filename], backend_by_image.get(filename, []))
+                     for filename in filenames}
+        report['detector'] = {
+            'backend': detector_backend, 'eager_seconds': round(eager_seconds, 3),
+            'backend_seconds': round(backend_seconds, 3), 'build_seconds': build_seconds,
+            'speedup': round(eager_seconds / backend_seconds, 2) if backend_seconds else None,
+            'images_disagreeing': sum(1 for count in differing.values() if count),
+            'boxes_disagreeing': sum(differing.values()),
+        }
+
+    if classifier_backend != 'eager':
+        images_by_name = dict(zip(filenames, images))
+        crops = [sv.crop_image(image=images_by_name[record['Image_Filename']],
+                               xyxy=np.array([record['X_min'], record['Y_min'], record['X_max'], record['Y_max']], dtype=int))
+                 for record in eager_records if int(record['MD_Class_ID']) == 0]
+        if not crops:
+            print("Warning: the eager detector found no animals; the classifier is not compared.")
+        else:
+            def classify_all(model):
+                start = time.perf_counter()
+                results = []
+                for i in range(0, len(crops), classify_data.CLASSIFICATION_BATCH_SIZE):
+                    results.extend(classify_data.classify_crop_batch(
+                        model, crops[i:i + classify_data.CLASSIFICATION_BATCH_SIZE]))
+                return results, time.perf_counter() - start
+
+            eager_classifier = classify_data.load_classification_model()
+            warm_up(lambda: classify_data.classify_crop_batch(eager_classifier, crops[:1]))
+            eager_results, eager_seconds = classify_all(eager_classifier)
+            backend_classifier = classify_data.load_classification_model(backend=classifier_backend)
+            build_seconds = warm_up(lambda: classify_data.classify_crop_batch(backend_classifier, crops[:1]))
+            backend_results, backend_seconds = classify_all(backend_classifier)
+            report['classifier'] = {
+                'backend': classifier_backend, 'crops': len(crops), 'eager_seconds': round(eager_seconds, 3),
+                'backend_seconds': round(backend_seconds, 3), 'build_seconds': build_seconds,
+                'speedup': round(eager_seconds / backend_seconds, 2) if backend_seconds else None,
+                'label_disagreements': sum(1 for eager, other in zip(eager_results, backend_results)
+                                           if eager['prediction'] != other['prediction']),
+                'max_confidence_delta': round(max(abs(float(eager['confidence']) - float(other['confidence']))
+                                                  for eager, other in zip(eager_results, backend_results)), 4),
+            }
+            if classifier_backend == 'int8':
+                # Dynamic quantization only covers Linear layers; the convolutions still run in float
+                report['classifier']['quantized_layers'] = 'Linear'
+                report['classifier']['quantized_weight_share'] = round(backend_classifier.quantized_weight_share, 4)
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Checks the speed and accuracy parity of an inference backend against the eager models.")
+    parser.add_argument("input_dir", type=str, nargs='?', default='raw_captures',
+                        help="Directory of sample images. (Default: raw_captures)")
+    parser.add_argument("--detector-backend", choices=DETECTOR_BACKENDS, default='eager',
+                        help="Detector backend to compare with the eager detector.")
+    parser.add_argument("--classifier-backend", choices=CLASSIFIER_BACKENDS, default='eager',
+                        help="Classifier backend to compare with the eager classifier ('int8' quantizes the Linear layers only).")
+    parser.add_argument("--threads", type=int, default=INFERENCE_THREADS, help="Intra-op threads.")
+    parser.add_argument("--interop-threads", type=int, default=INTEROP_THREADS, help="Inter-op threads.")
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of images to compare.")
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="Also check that the eager detector gives the same boxes and confidences at this batch size as one frame at a time.")
+    parser.add_argument("--output", type=str, default=None, help="Write the parity report as JSON to this path.")
+    args = parser.parse_args()
+    if args.detector_backend == 'eager' and args.classifier_backend == 'eager' and not args.batch_size:
+        parser.error("Choose a --detector-backend, --classifier-backend and/or --batch-size to compare.")
+
+    configure_threads(args.threads, args.interop_threads)
+    report = parity_check(args.input_dir, args.detector_backend, args.classifier_backend, args.limit, args.batch_size)
+
+    print(f"\n--- Backend Parity: {report['images']} images ---")
+    if 'batch' in report:
+        result = report['batch']
+        print(f"Detector batch size {result['batch_size']}: {result['speedup']}x single frames "
+              f"({result['single_seconds']}s -> {result['batched_seconds']}s), "
+              f"{result['images_disagreeing']} images / {result['boxes_disagreeing']} boxes disagree, "
+              f"max confidence change {result['max_confidence_delta']}")
+    if 'detector' in report:
+        result = report['detector']
+        print(f"Detector ({result['backend']}): {result['speedup']}x eager "
+              f"({result['eager_seconds']}s -> {result['backend_seconds']}s, build {result['build_seconds']}s), "
+              f"{result['images_disagreeing']} images / {result['boxes_disagreeing']} boxes disagree")
+    if 'classifier' in report:
+        result = report['classifier']
+        print(f"Classifier ({result['backend']}): {result['speedup']}x eager "
+              f"({result['eager_seconds']}s -> {result['backend_seconds']}s, build {result['build_seconds']}s), "
+              f"{result['label_disagreements']} of {result['crops']} labels disagree, "
+              f"max confidence change {result['max_confidence_delta']}")
+        if 'quantized_weight_share' in result:
+            print(f"  int8 quantized the {result['quantized_layers']} layers only "
+                  f"({result['quantized_weight_share']:.1%} of the weights); convolutions ran in float.")
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f"Parity report written to: {args.output}")
\ No newline at end of file
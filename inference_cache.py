@@ -0,0 +1,138 @@
+# inference_cache.py
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from image_loader import image_stat, open_image_file
+
+# --- CONFIGURATION ---
+CACHE_MAX_MB = 512 # Cache size above which the least recently used entries are evicted
+HASH_CHUNK_SIZE = 1 << 20 # Bytes read at a time when hashing image files
+CACHE_COMMIT_EVERY = 256 # Entries stored between commits (the rest are committed on close)
+# ---------------------
+
+def hash_file(path):
+    """Returns the SHA-256 hex digest of a file's (or packed image's) contents."""
+    digest = hashlib.sha256()
+    with open_image_file(path) as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class InferenceCache:
+    """
+    On-disk cache of model outputs, stored in SQLite.
+
+    Entries are keyed by image content hash, model name/version and the
+    settings that affect the output (thresholds, boxes). A renamed or re-synced
+    copy of a frame is still a hit, while a model or threshold change is a
+    miss. When the stored values grow past max_bytes, the least recently used
+    entries are evicted. The total size is tracked as entries are stored, so
+    the table is only scanned when something has to be evicted. New entries
+    are committed every CACHE_COMMIT_EVERY stores and on flush/close.
+    """
+
+    def __init__(self, db_path, max_bytes=CACHE_MAX_MB * 1024 * 1024):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries(last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        self._uncommitted = 0
+
+    def image_hash(self, img_path):
+        """Hashes an image file, remembering the result while its size and mtime are unchanged."""
+        memo_key = (os.path.abspath(img_path),) + tuple(image_stat(img_path))
+        if memo_key not in self._hashes:
+            self._hashes[memo_key] = hash_file(img_path)
+        return self._hashes[memo_key]
+
+    @staticmethod
+    def make_key(image_hash, model_name, **params):
+        """Builds the cache key for one image, model and set of inference settings."""
+        payload = json.dumps([image_hash, model_name, params], sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns the cached value for key (or None), counting the hit or miss."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            return json.loads(row[0])
+
+    def put(self, key, value):
+        """Stores a JSON-serializable value under key, evicting old entries if needed."""
+        payload = json.dumps(value)
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, payload, len(payload), time.time())
+            )
+            self._total_bytes += len(payload) - (old[0] if old else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+            self._uncommitted += 1
+            if self._uncommitted >= CACHE_COMMIT_EVERY:
+                self._commit()
+
+    def _evict(self):
+        """Deletes the least recently used entries until the cache fits in max_bytes."""
+        # Free down to 90% so every insert near the limit does not trigger a new scan
+        to_free = self._total_bytes - int(self.max_bytes * 0.9)
+        doomed = []
+        for key, size in self._conn.execute("SELECT key, size FROM entries ORDER BY last_access"):
+            doomed.append((key,))
+            self._total_bytes -= size
+            to_free -= size
+            if to_free <= 0:
+                break
+        self._conn.executemany("DELETE FROM entries WHERE key = ?", doomed)
+
+    def _commit(self):
+        self._conn.commit()
+        self._uncommitted = 0
+
+    def flush(self):
+        """Commits the entries stored since the last commit."""
+        with self._lock:
+            self._commit()
+
+    def size_bytes(self):
+        """Returns the total size of the stored values."""
+        with self._lock:
+            return self._total_bytes
+
+    def report(self):
+        """Prints the hit/miss counters and current cache size."""
+        lookups = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / lookups if lookups else 0.0
+        print(f"Inference cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+              f"{self.size_bytes() / (1024 * 1024):.1f} MB in {self.db_path}")
+
+    def close(self):
+        """Commits pending access times and closes the database."""
+        with self._lock:
+            self._commit()
+            self._conn.close()
\ No newline at end of file
@@ -0,0 +1,96 @@
+# pipeline_manifest.py
+import os
+import json
+from image_loader import image_stat
+from inference_cache import hash_file
+
+class PipelineManifest:
+    """
+    Per-image record of file identity and the pipeline steps completed for it.
+
+    Each image entry stores the file's size, mtime and SHA-256 plus the list of
+    steps that have finished for it, and the steps that failed for it (an
+    unreadable image, say), which stay pending until they succeed. A file whose size or mtime changed is
+    re-hashed. If its content really changed, its completed steps are cleared,
+    so every step runs again for that image. The manifest is saved atomically
+    after each checkpoint, so an interrupted run resumes where it stopped.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.images = {}
+        try:
+            with open(manifest_path, 'r') as f:
+                self.images = json.load(f).get('images', {})
+        except FileNotFoundError:
+            pass
+
+    def refresh(self, input_dir, filenames):
+        """Updates file identities and returns the filenames that are new or whose content changed."""
+        changed = []
+        for filename in filenames:
+            try:
+                size, mtime_ns = image_stat(os.path.join(input_dir, filename))
+            except FileNotFoundError:
+                continue
+
+            entry = self.images.get(filename)
+            if entry and entry['size'] == size and entry['mtime_ns'] == mtime_ns:
+                continue
+
+            file_hash = hash_file(os.path.join(input_dir, filename))
+            if entry is None or entry['sha256'] != file_hash:
+                entry = {'steps': []}
+                changed.append(filename)
+            entry.update({'size': size, 'mtime_ns': mtime_ns, 'sha256': file_hash})
+            self.images[filename] = entry
+        return changed
+
+    def needs(self, filename, step):
+        """True if `step` has not completed for the current content of `filename`."""
+        entry = self.images.get(filename)
+        return entry is None or step not in entry['steps']
+
+    def pending(self, step, filenames):
+        """Returns the filenames that still need `step`, in input order."""
+        return [filename for filename in filenames if self.needs(filename, step)]
+
+    def mark_done(self, step, filenames, order=None):
+        """
+        Records that `step` completed for the given filenames.
+
+        Fresh detection rows have to go through the later steps again, so
+        marking 'detect' clears every step except those that run before it in
+        `order` (the run's step order; by default detection comes first).
+        """
+        kept = order[:order.index('detect')] if order and 'detect' in order else []
+        for filename in filenames:
+            entry = self.images.get(filename)
+            # An image whose detection failed has no rows for the other steps to work on yet
+            if entry is None or (step != 'detect' and 'detect' in entry.get('failed', [])):
+                continue
+            if step == 'detect':
+                entry['steps'] = [done for done in entry['steps'] if done in kept]
+            if step not in entry['steps']:
+                entry['steps'].append(step)
+            if step in entry.get('failed', []):
+                entry['failed'].remove(step)
+
+    def mark_failed(self, step, filenames):
+        """Records that `step` failed for the given filenames; they stay pending, so the next run retries them."""
+        for filename in filenames:
+            entry = self.images.get(filename)
+            if entry is None:
+                continue
+            if step in entry['steps']:
+                entry['steps'].remove(step)
+            if step not in entry.setdefault('failed', []):
+                entry['failed'].append(step)
+
+    def save(self):
+        """Writes the manifest atomically (temp file + rename)."""
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'images': self.images}, f)
+        os.replace(tmp_path, self.manifest_path)
\ No newline at end of file
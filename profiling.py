@@ -0,0 +1,237 @@
+# profiling.py
+import os
+import sys
+import json
+import time
+import functools
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # Not available on Windows; peak RSS is then omitted
+    resource = None
+
+# --- CONFIGURATION ---
+PROFILE_ENV = 'PIPELINE_PROFILE' # Path of the JSON report; profiling is off when unset
+PROFILER_ENV = 'PIPELINE_PROFILER' # Optional call profiler: 'cprofile' or 'pyinstrument'
+# ---------------------
+
+PROFILERS = ['cprofile', 'pyinstrument']
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process and its finished children, in MB."""
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class StageProfiler:
+    """
+    Collects wall time, image counts, per-image latencies and peak RSS per stage.
+
+    A stage (e.g. 'detect') may run several times, such as once per chunk in
+    --in-process mode; its numbers accumulate. Substeps (e.g. 'decode',
+    'inference', 'write') are charged to the innermost running stage. Timing
+    is always collected because it costs a few perf_counter calls; a report is
+    only written when PIPELINE_PROFILE is set.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._running = []
+
+    def _stats(self, name):
+        return self.stages.setdefault(name, {'wall_seconds': 0.0, 'images': 0, 'substeps': {}, 'latencies': []})
+
+    @contextmanager
+    def stage(self, name):
+        stats = self._stats(name)
+        self._running.append(name)
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats['wall_seconds'] += time.perf_counter() - start
+            stats['peak_rss_mb'] = peak_rss_mb()
+            self._running.pop()
+
+    def add_substep_time(self, name, seconds):
+        if self._running:
+            substeps = self.stages[self._running[-1]]['substeps']
+            substeps[name] = substeps.get(name, 0.0) + seconds
+
+    @contextmanager
+    def substep(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_substep_time(name, time.perf_counter() - start)
+
+    def add_images(self, count, seconds=None):
+        """Counts images finished by the running stage. seconds is the time they took together."""
+        if not self._running or count <= 0:
+            return
+        stats = self.stages[self._running[-1]]
+        stats['images'] += count
+        if seconds is not None:
+            stats['latencies'].extend([seconds / count] * count)
+
+    def add_latencies(self, latencies):
+        """Counts one finished image per entry of latencies (seconds each) for the running stage."""
+        if not self._running:
+            return
+        stats = self.stages[self._running[-1]]
+        stats['images'] += len(latencies)
+        stats['latencies'].extend(latencies)
+
+    def summary(self):
+        """Returns the per-stage report as plain JSON-serializable dicts."""
+        report = {}
+        for name, stats in self.stages.items():
+            latencies = sorted(stats['latencies'])
+            wall = stats['wall_seconds']
+            report[name] = {
+                'wall_seconds': round(wall, 4),
+                'images': stats['images'],
+                'images_per_sec': round(stats['images'] / wall, 2) if wall and stats['images'] else None,
+                'latency_p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+                'latency_p95_ms': round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+                'peak_rss_mb': round(stats['peak_rss_mb'], 1) if stats.get('peak_rss_mb') is not None else None,
+                'substeps': {substep: round(seconds, 4) for substep, seconds in stats['substeps'].items()},
+            }
+        return report
+
+    def write_report(self, path, extra=None):
+        """
+        Merges this process's stages into the JSON report at path (atomically).
+
+        Pipeline steps running as separate scripts each add their own stages to
+        the same report.
+        """
+        report = {'stages': {}}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    report = json.load(f)
+            except ValueError:
+                pass
+        report['stages'].update(self.summary())
+        report['generated'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        if extra:
+            report.setdefault('profiles', []).extend(extra)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(report, f, indent=4)
+        os.replace(tmp_path, path)
+
+    def print_summary(self):
+        print("\n--- Profile ---")
+        for name, stats in self.summary().items():
+            line = f"{name}: {stats['wall_seconds']:.2f}s"
+            if stats['images_per_sec']:
+                line += f", {stats['images']} images, {stats['images_per_sec']:.2f} images/sec"
+            if stats['latency_p50_ms'] is not None:
+                line += f", p50 {stats['latency_p50_ms']:.1f} ms, p95 {stats['latency_p95_ms']:.1f} ms"
+            if stats['peak_rss_mb'] is not None:
+                line += f", peak RSS {stats['peak_rss_mb']:.0f} MB"
+            print(line)
+            for substep, seconds in stats['substeps'].items():
+                print(f"    {substep}: {seconds:.2f}s")
+
+# Process-wide profiler shared by all stages
+PROFILER = StageProfiler()
+
+stage = PROFILER.stage
+substep = PROFILER.substep
+add_substep_time = PROFILER.add_substep_time
+add_images = PROFILER.add_images
+add_latencies = PROFILER.add_latencies
+
+def timed_stage(name):
+    """Decorator that runs a stage function inside PROFILER.stage(name)."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with PROFILER.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timed_iter(iterable, name):
+    """Yields from iterable, charging the time spent waiting for each item to substep name."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            PROFILER.add_substep_time(name, time.perf_counter() - start)
+            return
+        PROFILER.add_substep_time(name, time.perf_counter() - start)
+        yield item
+
+def start_call_profiler(kind):
+    """Starts a cProfile or pyinstrument profiler and returns it, or None if unavailable."""
+    if kind == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    if kind == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("Warning: pyinstrument is not installed (pip install pyinstrument); call profiling is off.")
+            return None
+        profiler = Profiler()
+        profiler.start()
+        return profiler
+    return None
+
+def stop_call_profiler(profiler, kind, output_base):
+    """Stops a call profiler and saves its output next to the report; returns the output path."""
+    if kind == 'cprofile':
+        profiler.disable()
+        path = f"{output_base}.prof"
+        profiler.dump_stats(path)
+    else:
+        profiler.stop()
+        path = f"{output_base}.html"
+        with open(path, 'w') as f:
+            f.write(profiler.output_html())
+    return path
+
+@contextmanager
+def profile_run(report_path=None, call_profiler=None):
+    """
+    Wraps a script's main call. If a report path is given (or PIPELINE_PROFILE is set),
+    the stage report is written when the call ends, even on failure. An optional
+    cProfile/pyinstrument call profile is saved as '<report>.<script>.prof/.html'.
+    """
+    report_path = report_path or os.environ.get(PROFILE_ENV)
+    call_profiler = call_profiler or os.environ.get(PROFILER_ENV)
+    if not report_path:
+        yield
+        return
+
+    profiler = start_call_profiler(call_profiler)
+    try:
+        yield
+    finally:
+        outputs = []
+        if profiler is not None:
+            script = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python'
+            outputs.append(stop_call_profiler(profiler, call_profiler, f"{os.path.splitext(report_path)[0]}.{script}"))
+        PROFILER.print_summary()
+        PROFILER.write_report(report_path, extra=outputs)
+        print(f"Profile report written to: {report_path}")
\ No newline at end of file
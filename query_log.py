@@ -0,0 +1,228 @@
+# query_log.py
+import os
+import time
+import sqlite3
+import argparse
+from capture_events import parse_capture_name, split_camera
+from image_loader import write_image_list
+from record_store import FIELD_TYPES, MASTER_FIELD_ORDER, iter_records, save_records
+
+# --- CONFIGURATION ---
+DEFAULT_LOG = os.path.join('data', 'main_detection_log.csv')
+INSERT_BATCH_ROWS = 50000 # Detections inserted per transaction while building the index
+PRINT_ROWS = 20 # Matching detections the CLI prints (use --output to get all of them)
+# ---------------------
+
+SQL_TYPES = {int: 'INTEGER', float: 'REAL', str: 'TEXT'}
+
+# Site and roll parsed from Image_Filename (see capture_events.parse_capture_name)
+LOCATION_FIELDS = ['Season', 'Site', 'Roll']
+
+# Text columns compared without regard to case ('Zebra' finds 'zebra')
+NOCASE_FIELDS = {'Predicted_Species', 'Season', 'Site', 'Roll'}
+
+# One index per common question; ANALYZE lets SQLite pick between them
+INDEXES = {
+    'species_site_time': ('Predicted_Species', 'Site', 'Timestamp'),
+    'species_time': ('Predicted_Species', 'Timestamp'),
+    'site_time': ('Site', 'Timestamp'),
+    'time': ('Timestamp',),
+    'confidence': ('Classification_Confidence',),
+    'image': ('Image_Filename', 'Detection_Index'),
+}
+
+def index_path_for(log_path):
+    """Returns the default index path of a detection log (next to it, '<log>.index.sqlite')."""
+    return f"{os.path.splitext(log_path)[0]}.index.sqlite"
+
+def location_fields(filename):
+    """Returns (season, site, roll) parsed from an image filename ('' where the name has no such part)."""
+    camera, _ = parse_capture_name(filename)
+    return split_camera(camera)
+
+def index_is_current(log_path, index_path):
+    """True if index_path was built from the current version (size and mtime) of log_path."""
+    if not os.path.exists(index_path):
+        return False
+    stat = os.stat(log_path)
+    conn = sqlite3.connect(index_path)
+    try:
+        meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        conn.close()
+    return meta.get('log_size') == str(stat.st_size) and meta.get('log_mtime_ns') == str(stat.st_mtime_ns)
+
+def build_index(log_path, index_path=None, force=False):
+    """
+    Builds a SQLite index of a detection log (CSV, Parquet or NPZ) and returns its path.
+
+    The log is streamed, so memory stays flat for any log size. Season, site
+    and roll are parsed from each filename into columns of their own. The
+    index remembers the log's size and mtime and is only rebuilt once the log
+    changes (or with force). It is built under a temporary name and renamed, so
+    queries never see a half-built index.
+    """
+    index_path = index_path or index_path_for(log_path)
+    if not force and index_is_current(log_path, index_path):
+        return index_path
+
+    start = time.perf_counter()
+    stat = os.stat(log_path)
+    tmp_path = f"{index_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    fields = MASTER_FIELD_ORDER + LOCATION_FIELDS
+    columns = [f"{field} {SQL_TYPES[FIELD_TYPES.get(field, str)]}"
+               + (" COLLATE NOCASE" if field in NOCASE_FIELDS else "") for field in fields]
+    insert = f"INSERT INTO detections VALUES ({', '.join('?' * len(fields))})"
+
+    conn = sqlite3.connect(tmp_path)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute(f"CREATE TABLE detections ({', '.join(columns)})")
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    rows, count = [], 0
+    for record in iter_records(log_path):
+        # Blank values (e.g. a step that has not run yet) are stored as NULL
+        rows.append([None if record.get(field, '') == '' else record[field] for field in MASTER_FIELD_ORDER]
+                    + list(location_fields(record['Image_Filename'])))
+        if len(rows) == INSERT_BATCH_ROWS:
+            conn.executemany(insert, rows)
+            count += len(rows)
+            rows.clear()
+    conn.executemany(insert, rows)
+    count += len(rows)
+
+    # Indexes are created after loading, which is much faster than maintaining them per insert
+    for name, index_columns in INDEXES.items():
+        conn.execute(f"CREATE INDEX {name} ON detections ({', '.join(index_columns)})")
+    conn.execute("ANALYZE")
+    conn.executemany("INSERT INTO meta VALUES (?, ?)", [('log_path', os.path.abspath(log_path)),
+                                                        ('log_size', str(stat.st_size)),
+                                                        ('log_mtime_ns', str(stat.st_mtime_ns))])
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, index_path)
+    print(f"Indexed {count} detections from {log_path} in {time.perf_counter() - start:.1f}s: {index_path}")
+    return index_path
+
+def exif_time(value, upper=False):
+    """
+    Converts a date bound such as '2012-03', '2012-03-01' or '2012-03-01T12:00'
+    to the EXIF 'YYYY:MM:DD HH:MM:SS' form of the Timestamp column.
+
+    Bounds are prefixes: an upper bound covers everything it is a prefix of,
+    so '--until 2012-03' includes all of March.
+    """
+    date, _, clock = value.strip().replace('T', ' ').partition(' ')
+    bound = date.replace('-', ':') + (f" {clock}" if clock else '')
+    # '~' sorts after every digit, ':' and space, so the bound includes all times it is a prefix of
+    return bound + '~' if upper else bound
+
+def build_filters(species=None, sites=None, rolls=None, seasons=None, since=None, until=None,
+                  min_confidence=None, min_md_confidence=None, md_class=None, images=None):
+    """Returns (where_clause, params) for the given filters; list filters match any of their values."""
+    clauses, params = [], []
+    for column, values in (('Predicted_Species', species), ('Site', sites), ('Roll', rolls), ('Season', seasons),
+                           ('Image_Filename', images)):
+        if values:
+            clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+    if since:
+        clauses.append("Timestamp >= ?")
+        params.append(exif_time(since))
+    if until:
+        clauses.append("Timestamp <= ?")
+        params.append(exif_time(until, upper=True))
+    if min_confidence is not None:
+        clauses.append("Classification_Confidence >= ?")
+        params.append(min_confidence)
+    if min_md_confidence is not None:
+        clauses.append("MD_Confidence >= ?")
+        params.append(min_md_confidence)
+    if md_class is not None:
+        clauses.append("MD_Class_ID = ?")
+        params.append(md_class)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+def query_detections(index_path, limit=None, **filters):
+    """
+    Returns the detections matching filters (see build_filters) as log records,
+    ordered by image filename and Detection_Index. The records can be passed
+    to save_records or to the records argument of the sort and visualize steps.
+    """
+    where, params = build_filters(**filters)
+    query = f"SELECT {', '.join(MASTER_FIELD_ORDER)} FROM detections{where} ORDER BY Image_Filename, Detection_Index"
+    if limit:
+        query += f" LIMIT {int(limit)}"
+    conn = sqlite3.connect(index_path)
+    try:
+        return [{field: '' if value is None else value for field, value in zip(MASTER_FIELD_ORDER, row)}
+                for row in conn.execute(query, params)]
+    finally:
+        conn.close()
+
+def count_detections(index_path, **filters):
+    """Returns (detections, images) matching filters."""
+    where, params = build_filters(**filters)
+    conn = sqlite3.connect(index_path)
+    try:
+        return conn.execute(f"SELECT COUNT(*), COUNT(DISTINCT Image_Filename) FROM detections{where}", params).fetchone()
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Queries the detection log by species, site, roll, time and confidence through a SQLite index.")
+    parser.add_argument("log", type=str, nargs='?', default=DEFAULT_LOG,
+                        help=f"Detection log (CSV, Parquet or NPZ). (Default: {DEFAULT_LOG})")
+    parser.add_argument("--index", type=str, default=None, help="Index path (default: '<log>.index.sqlite').")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the index even if the log has not changed.")
+    parser.add_argument("--species", nargs='+', default=None, help="Predicted species (any of these, case-insensitive).")
+    parser.add_argument("--site", nargs='+', default=None, help="Camera site(s) parsed from the filename, e.g. B04.")
+    parser.add_argument("--roll", nargs='+', default=None, help="SD-card roll(s) parsed from the filename, e.g. R1.")
+    parser.add_argument("--season", nargs='+', default=None, help="Season(s) parsed from the filename, e.g. S5.")
+    parser.add_argument("--since", type=str, default=None, help="Earliest timestamp, e.g. 2012-03 or 2012-03-01 (inclusive).")
+    parser.add_argument("--until", type=str, default=None, help="Latest timestamp, e.g. 2012-03 covers all of March (inclusive).")
+    parser.add_argument("--min-confidence", type=float, default=None, help="Minimum classification confidence.")
+    parser.add_argument("--min-md-confidence", type=float, default=None, help="Minimum MegaDetector confidence.")
+    parser.add_argument("--md-class", type=int, default=None, help="MegaDetector class (0 animal, 1 person, 2 vehicle, -1 empty).")
+    parser.add_argument("--limit", type=int, default=None, help="Return at most this many detections.")
+    parser.add_argument("--count", action="store_true", help="Only print the number of matching detections and images.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Write the matching detections as a log (.csv/.parquet/.npz) that sort_images.py and annotate_images.py can read.")
+    parser.add_argument("--images-out", type=str, default=None,
+                        help="Write the matching image filenames, one per line, for a step's --images-from.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.log):
+        raise SystemExit(f"Error: No detection log at {args.log}")
+    index_path = build_index(args.log, args.index, force=args.rebuild)
+    filters = dict(species=args.species, sites=args.site, rolls=args.roll, seasons=args.season,
+                   since=args.since, until=args.until, min_confidence=args.min_confidence,
+                   min_md_confidence=args.min_md_confidence, md_class=args.md_class)
+
+    start = time.perf_counter()
+    if args.count:
+        detections, images = count_detections(index_path, **filters)
+        print(f"{detections} detections in {images} images ({1000 * (time.perf_counter() - start):.1f} ms)")
+        raise SystemExit(0)
+
+    records = query_detections(index_path, limit=args.limit, **filters)
+    filenames = sorted({record['Image_Filename'] for record in records})
+    print(f"{len(records)} detections in {len(filenames)} images ({1000 * (time.perf_counter() - start):.1f} ms)")
+    for record in records[:PRINT_ROWS]:
+        print(f"  {record['Image_Filename']} #{record['Detection_Index']}  {record['Timestamp'] or '-'}  "
+              f"{record['Predicted_Species'] or '-'} {record['Classification_Confidence'] or ''}")
+    if len(records) > PRINT_ROWS:
+        print(f"  ... {len(records) - PRINT_ROWS} more (use --output to write them all)")
+
+    if args.output:
+        save_records(records, args.output)
+        print(f"Matching detections written to: {args.output}")
+    if args.images_out:
+        write_image_list(filenames, args.images_out)
+        print(f"Matching image list written to: {args.images_out}")
\ No newline at end of file
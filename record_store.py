@@ -0,0 +1,228 @@
+# record_store.py
+import os
+import csv
+import argparse
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # Parquet support is optional
+    pa = None
+    pq = None
+
+# MASTER LIST OF ALL LOG FIELDS IN DESIRED ORDER, WITH THEIR TYPES
+FIELD_TYPES = {
+    'Image_Filename': str, 'Detection_Index': int,
+    'Image_Width': int, 'Image_Height': int, 'Timestamp': str,
+    'MD_Class_ID': int, 'MD_Confidence': float,
+    'X_min': int, 'Y_min': int, 'X_max': int, 'Y_max': int,
+    'Predicted_Species': str, 'Classification_Confidence': float,
+    'Event_ID': str
+}
+MASTER_FIELD_ORDER = list(FIELD_TYPES)
+
+NUMPY_DTYPES = {int: np.int64, float: np.float64}
+
+ITER_BATCH_ROWS = 65536 # Rows converted at a time when streaming columnar logs
+
+def complete_field_order(field_order):
+    """Returns field_order followed by the master fields it lacks (e.g. an older order without Event_ID)."""
+    return list(field_order) + [field for field in MASTER_FIELD_ORDER if field not in field_order]
+
+def log_format(path):
+    """Returns the storage backend ('csv', 'parquet' or 'npz') implied by a log file's extension."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.parquet':
+        return 'parquet'
+    if ext == '.npz':
+        return 'npz'
+    return 'csv'
+
+def parse_value(value, kind):
+    """
+    Converts a CSV string to its field type once, leaving blanks as ''. A value
+    that is not a number (e.g. a hand-edited cell) is kept as the raw string.
+    """
+    if value is None or value == '' or kind is str:
+        return '' if value is None else value
+    try:
+        return kind(value)
+    except ValueError:
+        try:
+            return kind(float(value))
+        except ValueError:
+            return value
+
+def records_to_columns(records, field_order=MASTER_FIELD_ORDER):
+    """
+    Converts row dicts to typed NumPy columns.
+
+    Blank numeric values (e.g. Image_Width before the metadata step) are stored
+    as 0 and tracked in a boolean '<field>__valid' column, so they read back
+    as blanks. Values that are not numbers are stored as blanks too.
+    """
+    columns = {}
+    for field in field_order:
+        kind = FIELD_TYPES.get(field, str)
+        values = [record.get(field, '') for record in records]
+        if kind is str:
+            columns[field] = np.array(['' if v is None else v for v in values], dtype=str)
+            continue
+        try:
+            # Fast path: every value is already a number (or a numeric string)
+            columns[field] = np.array(values, dtype=NUMPY_DTYPES[kind])
+            continue
+        except (ValueError, TypeError):
+            pass
+        parsed = [parse_value(v, kind) if v is not None else '' for v in values]
+        valid = np.array([not isinstance(v, str) for v in parsed], dtype=bool)
+        columns[field] = np.array([v if ok else 0 for v, ok in zip(parsed, valid)], dtype=NUMPY_DTYPES[kind])
+        if not valid.all():
+            columns[f'{field}__valid'] = valid
+    return columns
+
+def columns_to_records(columns):
+    """Converts typed columns back to row dicts with native Python values."""
+    fields = [field for field in columns if not field.endswith('__valid')]
+    lists = {}
+    for field in fields:
+        values = columns[field].tolist()
+        valid = columns.get(f'{field}__valid')
+        if valid is not None:
+            values = [v if ok else '' for v, ok in zip(values, valid.tolist())]
+        lists[field] = values
+    return [dict(zip(fields, row)) for row in zip(*(lists[field] for field in fields))]
+
+def load_columns(path):
+    """Loads a detection log as a dict of typed NumPy columns."""
+    fmt = log_format(path)
+    if fmt == 'npz':
+        with np.load(path, allow_pickle=False) as data:
+            return {field: data[field] for field in data.files}
+    if fmt == 'parquet':
+        if pq is None:
+            raise ImportError("Reading Parquet logs requires pyarrow (pip install pyarrow).")
+        table = pq.read_table(path)
+        columns = {}
+        for name, column in zip(table.column_names, table.columns):
+            kind = FIELD_TYPES.get(name, str)
+            if kind is str:
+                columns[name] = np.array(column.fill_null('').to_pylist(), dtype=str)
+            else:
+                valid = column.is_valid().to_numpy(zero_copy_only=False)
+                columns[name] = column.fill_null(0).to_numpy(zero_copy_only=False).astype(NUMPY_DTYPES[kind])
+                if not valid.all():
+                    columns[f'{name}__valid'] = valid
+        return columns
+    return records_to_columns(load_records(path))
+
+def load_records(path):
+    """
+    Loads all records from a detection log (CSV, Parquet or NPZ) as typed row dicts.
+
+    CSV values are converted to their field types once at load time, so stages
+    get the same types whatever the backend.
+    """
+    if log_format(path) == 'csv':
+        with open(path, 'r', newline='') as csvfile:
+            return [{field: parse_value(value, FIELD_TYPES.get(field, str)) for field, value in row.items()}
+                    for row in csv.DictReader(csvfile)]
+    return columns_to_records(load_columns(path))
+
+def iter_records(path, batch_rows=ITER_BATCH_ROWS):
+    """
+    Yields typed records from a detection log one at a time, in file order.
+
+    CSV and Parquet logs are read incrementally, so memory stays flat however
+    long the log is. NPZ columns are loaded once and turned into row dicts
+    batch_rows at a time.
+    """
+    fmt = log_format(path)
+    if fmt == 'csv':
+        with open(path, 'r', newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                yield {field: parse_value(value, FIELD_TYPES.get(field, str)) for field, value in row.items()}
+        return
+    if fmt == 'parquet':
+        if pq is None:
+            raise ImportError("Reading Parquet logs requires pyarrow (pip install pyarrow).")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows):
+            for row in batch.to_pylist():
+                yield {field: '' if value is None else value for field, value in row.items()}
+        return
+    columns = load_columns(path)
+    total = len(columns['Image_Filename']) if 'Image_Filename' in columns else 0
+    for start in range(0, total, batch_rows):
+        yield from columns_to_records({field: column[start:start + batch_rows] for field, column in columns.items()})
+
+def save_records(records, path, field_order=MASTER_FIELD_ORDER):
+    """
+    Writes records to a detection log, picking the backend from the file
+    extension. The write is atomic. Master fields missing from field_order
+    are written after it, so callers passing an older field order keep every
+    field the records carry.
+    """
+    field_order = complete_field_order(field_order)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fmt = log_format(path)
+    tmp_path = f"{path}.tmp{os.path.splitext(path)[1]}"
+
+    if fmt == 'csv':
+        with open(tmp_path, 'w', newline='') as csvfile:
+            # Fields not present (e.g., Image_Width, Timestamp) are left blank.
+            writer = csv.DictWriter(csvfile, fieldnames=field_order)
+            writer.writeheader()
+            writer.writerows(records)
+    elif fmt == 'npz':
+        np.savez(tmp_path, **records_to_columns(records, field_order))
+    else:
+        if pa is None:
+            raise ImportError("Writing Parquet logs requires pyarrow (pip install pyarrow).")
+        columns = records_to_columns(records, field_order)
+        arrays = {}
+        for field in field_order:
+            valid = columns.get(f'{field}__valid')
+            arrays[field] = pa.array(columns[field], mask=None if valid is None else ~valid)
+        pq.write_table(pa.table(arrays), tmp_path)
+
+    os.replace(tmp_path, path)
+
+def append_records(records, path, field_order=MASTER_FIELD_ORDER):
+    """
+    Adds records to the end of a detection log.
+
+    CSV logs are appended in place (the header is written if the file is new),
+    in the column order of the existing header. A log whose header lacks some
+    of the fields is rewritten through save_records instead. Columnar formats
+    cannot be appended, so the log is rewritten.
+    """
+    field_order = complete_field_order(field_order)
+    if log_format(path) != 'csv':
+        existing = load_records(path) if os.path.exists(path) else []
+        save_records(existing + list(records), path, field_order)
+        return
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+    if not write_header:
+        with open(path, 'r', newline='') as csvfile:
+            header = next(csv.reader(csvfile), [])
+        if any(field not in header for field in field_order):
+            # Appending would shift the new rows into the wrong columns
+            save_records(load_records(path) + list(records), path, header)
+            return
+        field_order = header
+    with open(path, 'a', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=field_order)
+        if write_header:
+            writer.writeheader()
+        writer.writerows(records)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Converts a detection log between CSV, Parquet and NPZ formats.")
+    parser.add_argument("input_path", type=str, help="Source detection log (.csv, .parquet or .npz).")
+    parser.add_argument("output_path", type=str, help="Destination detection log; the format follows the extension.")
+    args = parser.parse_args()
+    records = load_records(args.input_path)
+    save_records(records, args.output_path)
+    print(f"Converted {len(records)} records: {args.input_path} -> {args.output_path}")
\ No newline at end of file
@@ -0,0 +1,213 @@
+# render_service.py
+import io
+import os
+import json
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+from PIL import Image, features
+from annotate_images import make_annotators, draw_annotations, load_output_image
+from image_loader import image_stat
+from query_log import build_index, index_is_current, query_detections
+
+# --- CONFIGURATION ---
+RENDER_HOST = '127.0.0.1' # Only local clients by default
+RENDER_PORT = 8643
+RENDER_CACHE_MB = 256 # Size of the rendered images kept in memory; least recently used ones are dropped beyond it
+RENDER_FORMAT = 'jpeg' # 'jpeg', 'webp' or 'png'
+RENDER_QUALITY = 85 # JPEG/WebP quality
+RENDER_MAX_SIDE = None # Default longest side of a rendered image (None keeps full resolution)
+LOG_CHECK_SECONDS = 5 # How often the detection log is checked for changes
+# ---------------------
+
+RENDER_FORMATS = {'jpeg': ('JPEG', 'image/jpeg'), 'webp': ('WEBP', 'image/webp'), 'png': ('PNG', 'image/png')}
+
+class RenderCache:
+    """In-memory LRU cache of encoded images, bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes=RENDER_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached bytes for key (or None), counting the hit or miss."""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """Stores data under key, dropping the least recently used entries beyond max_bytes."""
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            self.size += len(data) - (len(old) if old is not None else 0)
+            self._entries[key] = data
+            while self.size > self.max_bytes:
+                _, dropped = self._entries.popitem(last=False)
+                self.size -= len(dropped)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'size_mb': round(self.size / (1024 * 1024), 2),
+                    'hits': self.hits, 'misses': self.misses}
+
+class AnnotatedRenderer:
+    """
+    Draws annotated images from the detection log when they are requested.
+
+    An image's records are looked up in the query_log index of the log, so
+    the log is never loaded whole. Images are drawn with the same annotators
+    as annotate_images.py, optionally downscaled (JPEGs are decoded at a
+    reduced DCT scale) and encoded as JPEG, WebP or PNG. Encoded results are
+    kept in a RenderCache keyed by filename, the source file's size and mtime
+    and the render options. The cache is cleared when the log changes.
+    """
+
+    def __init__(self, input_dir, log_path, index_path=None, cache_mb=RENDER_CACHE_MB):
+        self.input_dir = input_dir
+        self.log_path = log_path
+        self.index_path = build_index(log_path, index_path)
+        self.cache = RenderCache(cache_mb * 1024 * 1024)
+        self.rendered = 0
+        self._checked = time.monotonic()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _refresh(self):
+        """Rebuilds the index (and empties the cache) if the log changed since the last check."""
+        with self._lock:
+            if time.monotonic() - self._checked < LOG_CHECK_SECONDS:
+                return
+            if not index_is_current(self.log_path, self.index_path):
+                build_index(self.log_path, self.index_path)
+                self.cache.clear()
+            self._checked = time.monotonic()
+
+    def _annotators(self):
+        # Each request thread draws with its own annotators
+        if not hasattr(self._local, 'annotators'):
+            self._local.annotators = make_annotators()
+        return self._local.annotators
+
+    def render(self, filename, max_side=RENDER_MAX_SIDE, fmt=RENDER_FORMAT, quality=RENDER_QUALITY):
+        """
+        Returns (encoded_bytes, content_type) of filename drawn with its logged
+        detections. Images without detections are returned as they are.
+        Raises KeyError if the image is not in the log, FileNotFoundError if
+        it is missing from input_dir and ValueError for an unusable format.
+        """
+        if fmt not in RENDER_FORMATS:
+            raise ValueError(f"Unknown format '{fmt}'; choose from {', '.join(RENDER_FORMATS)}.")
+        if fmt == 'webp' and not features.check('webp'):
+            raise ValueError("This Pillow build has no WebP support.")
+        self._refresh()
+
+        img_path = os.path.join(self.input_dir, filename)
+        key = (filename,) + tuple(image_stat(img_path)) + (max_side, fmt, quality)
+        data = self.cache.get(key)
+        if data is None:
+            records = query_detections(self.index_path, images=[filename])
+            if not records:
+                raise KeyError(filename)
+            image, scale = load_output_image(img_path, max_side)
+            annotated = draw_annotations(image, records, scale, *self._annotators())
+            buffer = io.BytesIO()
+            pil_format = RENDER_FORMATS[fmt][0]
+            Image.fromarray(image if annotated is None else annotated).save(
+                buffer, format=pil_format, **({} if pil_format == 'PNG' else {'quality': quality}))
+            data = buffer.getvalue()
+            self.cache.put(key, data)
+            self.rendered += 1
+        return data, RENDER_FORMATS[fmt][1]
+
+    def health(self):
+        return {'status': 'ok', 'log': self.log_path, 'rendered': self.rendered, 'cache': self.cache.stats()}
+
+class RenderHandler(BaseHTTPRequestHandler):
+    """GET /annotated/<filename>?max_side=&format=&quality= returns the drawn image; GET /health reports the cache."""
+    renderer = None
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, payload):
+        self.send_body(status, json.dumps(payload).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            self.send_json(200, self.renderer.health())
+            return
+        if not url.path.startswith('/annotated/'):
+            self.send_json(404, {'error': 'Unknown endpoint'})
+            return
+
+        filename = unquote(url.path[len('/annotated/'):])
+        if not filename or os.path.basename(filename) != filename or filename in ('.', '..'):
+            self.send_json(400, {'error': 'Expected a plain image filename'})
+            return
+        query = parse_qs(url.query)
+        try:
+            max_side = int(query['max_side'][0]) if 'max_side' in query else RENDER_MAX_SIDE
+            quality = int(query.get('quality', [RENDER_QUALITY])[0])
+            data, content_type = self.renderer.render(filename, max_side=max_side,
+                                                      fmt=query.get('format', [RENDER_FORMAT])[0], quality=quality)
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except KeyError:
+            self.send_json(404, {'error': f"{filename} is not in the detection log"})
+            return
+        except FileNotFoundError:
+            self.send_json(404, {'error': f"{filename} is not in the input folder"})
+            return
+        self.send_body(200, data, content_type)
+
+    def log_message(self, format, *args):
+        # Keep the console for startup and errors; a gallery page requests many images at once
+        pass
+
+def serve(input_dir, log_path, host=RENDER_HOST, port=RENDER_PORT, cache_mb=RENDER_CACHE_MB):
+    """Serves annotated images drawn on request until interrupted."""
+    RenderHandler.renderer = AnnotatedRenderer(input_dir, log_path, cache_mb=cache_mb)
+    server = ThreadingHTTPServer((host, port), RenderHandler)
+    print(f"Serving annotated images of {input_dir} on http://{host}:{port} (GET /annotated/<filename>, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Draws annotated images from the detection log when they are requested over HTTP.")
+    parser.add_argument("input_dir", type=str, help="Directory containing the source images.")
+    parser.add_argument("log", type=str, help="Detection log (CSV, Parquet or NPZ) to draw the boxes and labels from.")
+    parser.add_argument("--host", type=str, default=RENDER_HOST, help=f"Address to listen on. (Default: {RENDER_HOST})")
+    parser.add_argument("--port", type=int, default=RENDER_PORT, help=f"Port to listen on. (Default: {RENDER_PORT})")
+    parser.add_argument("--cache-mb", type=int, default=RENDER_CACHE_MB,
+                        help=f"Memory for rendered images before the least recently used are dropped. (Default: {RENDER_CACHE_MB})")
+    args = parser.parse_args()
+    serve(args.input_dir, args.log, host=args.host, port=args.port, cache_mb=args.cache_mb)
\ No newline at end of file
@@ -3,6 +3,15 @@ import argparse
 import subprocess
 import os
 import sys
+import traceback
+from backend_names import DETECTOR_BACKENDS, CLASSIFIER_BACKENDS
+from empty_prefilter import PREFILTER_THRESHOLD
+from image_pack import is_pack_dir
+from pipeline_manifest import PipelineManifest
+from record_store import MASTER_FIELD_ORDER, load_records, save_records
+from shard_pipeline import SHARD_MODES, SHARD_BY, SHARD_COUNT, LEASE_SECONDS
+from sort_images import LINK_MODE_FALLBACKS
+import profiling
 
 # Define default paths
 DEFAULT_CSV = "data/main_detection_log.csv"
@@ -10,15 +19,24 @@ DEFAULT_SORTED = "output/sorted_images"
 DEFAULT_ANNOTATED = "output/annotated_images"
 DEFAULT_CROPS = "output/cropped_crops_by_species"
 DEFAULT_JSON = "data/analyzed_data.json"
+DEFAULT_MANIFEST = "data/pipeline_manifest.json"
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_CLF_BATCH_SIZE = 32
+DEFAULT_VISUALIZE_WORKERS = 1
+DEFAULT_LOADER_WORKERS = 4
+DEFAULT_PREFETCH_DEPTH = 16
+DEFAULT_CHUNK_SIZE = 256
+DEFAULT_CACHE_MAX_MB = 512
+DEFAULT_LINK_MODE = 'copy'
+DEFAULT_JSON_FORMAT = 'json'
+DEFAULT_POLL_INTERVAL = 2.0
+DEFAULT_PREFILTER_THRESHOLD = PREFILTER_THRESHOLD
+DEFAULT_SHARD_BY = SHARD_BY
+DEFAULT_SHARDS = SHARD_COUNT
+DEFAULT_LEASE_SECONDS = LEASE_SECONDS
+DEFAULT_BACKEND = 'eager'
 
-# MASTER LIST OF ALL CSV FIELDS IN DESIRED ORDER
-MASTER_FIELD_ORDER = [
-    'Image_Filename', 'Detection_Index', 
-    'Image_Width', 'Image_Height', 'Timestamp',
-    'MD_Class_ID', 'MD_Confidence', 
-    'X_min', 'Y_min', 'X_max', 'Y_max',
-    'Predicted_Species', 'Classification_Confidence'
-]
+# MASTER LIST OF ALL CSV FIELDS IN DESIRED ORDER (defined with their types in record_store.py)
 FIELD_ORDER_STRING = ",".join(MASTER_FIELD_ORDER)
 
 # Define the order of execution
@@ -37,7 +55,8 @@ def execute_step(script_name, arguments):
     print(f"\n--- Running Step: {script_name} ---")
     print(f"Command: {' '.join(cmd)}")
     try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        with profiling.substep(os.path.splitext(script_name)[0]):
+            result = subprocess.run(cmd, check=True, capture_output=True, text=True)
         print(result.stdout)
         return True
     except subprocess.CalledProcessError as e:
@@ -46,7 +65,354 @@ def execute_step(script_name, arguments):
     except FileNotFoundError:
         print(f"ERROR: Script not found: {script_name}. Ensure all scripts are in the current directory.")
         return False
+
+def prefilter_threshold(args):
+    """Returns the empty-frame prefilter threshold for detect_and_create_csv, or None when it is off."""
+    return args.prefilter_threshold if args.prefilter else None
+
+def threads_args(args):
+    """Returns the --threads/--interop-threads arguments for the model steps."""
+    thread_args = ['--threads', str(args.threads)] if args.threads else []
+    if args.interop_threads:
+        thread_args += ['--interop-threads', str(args.interop_threads)]
+    return thread_args
+
+def run_in_process(args, detection_model=None, classification_model=None, manifest=None, filenames=None):
+    """
+    Runs the selected steps inside this interpreter on one shared in-memory record table.
+
+    Images are handled in chunks of args.chunk_size. Each image in a chunk is
+    decoded at most once at full resolution: detection decodes the frames the
+    cache and the prefilter leave to it, and the metadata, classify and
+    visualize steps reuse those buffers. With args.reduced_decode, detect and
+    classify decode at their own reduced scale instead. Models are loaded once per run and steps always run
+    in pipeline order. Without a manifest the CSV is written once at the end.
+    With a PipelineManifest, only images that still need a step are processed,
+    their rows are merged into the existing log, and the CSV and manifest are
+    checkpointed after every chunk. If filenames is given, only those images
+    of args.input_dir are processed.
+    """
+    # The stage modules import torch/PytorchWildlife, so they are only loaded in this mode
+    import detect_and_log
+    import extract_metadata
+    import classify_data
+    import sort_images
+    import annotate_images
+    import export_to_json
+    from image_loader import iter_decoded_images, list_images
+    from inference_cache import InferenceCache
+    from crop_store import CropStore
+
+    steps = [step for step in PIPELINE_STEPS if step in args.steps]
+    image_steps = [step for step in steps if step != 'json']
+
+    # A fresh detection run starts a new log; anything else builds on the existing one
+    records_by_image = {}
+    if os.path.exists(args.csv) and ('detect' not in steps or manifest is not None):
+        for record in load_records(args.csv):
+            records_by_image.setdefault(record['Image_Filename'], []).append(record)
+
+    # The prefilter and the event grouping find each chunk's neighbouring frames in one listing of the folder
+    needs_listing = ('detect' in steps and (filenames is None or args.prefilter)) or 'metadata' in steps
+    folder_files = list_images(args.input_dir) if needs_listing else None
+    if filenames is None:
+        filenames = folder_files if 'detect' in steps else list(records_by_image)
+    if 'detect' in steps and not filenames:
+        print(f"Error: No images found in {args.input_dir}")
+        return []
+
+    def needs(filename, step):
+        return manifest is None or manifest.needs(filename, step)
+
+    if manifest is not None:
+        changed = manifest.refresh(args.input_dir, filenames)
+        print(f"Manifest: {len(changed)} new or changed images out of {len(filenames)}.")
+    todo = [filename for filename in filenames if any(needs(filename, step) for step in image_steps)]
+
+    with profiling.substep('load_models'):
+        if todo and 'detect' in steps and detection_model is None:
+            detection_model = detect_and_log.load_detection_model(args.detector_backend)
+        if todo and 'classify' in steps and classification_model is None:
+            classification_model = classify_data.load_classification_model(args.classifier_backend)
+
+    cache = InferenceCache(args.cache, max_bytes=args.cache_max_mb * 1024 * 1024) if args.cache else None
+    crop_store = CropStore(args.crop_store) if args.crop_store else None
+
+    def has_detections(filename):
+        return any(int(record['MD_Class_ID']) != -1 for record in records_by_image.get(filename, []))
+
+    def all_records():
+        return [record for image_records in records_by_image.values() for record in image_records]
+
+    chunk_count = (len(todo) + args.chunk_size - 1) // args.chunk_size
+    for chunk_index, chunk_start in enumerate(range(0, len(todo), args.chunk_size)):
+        chunk = todo[chunk_start:chunk_start + args.chunk_size]
+        step_files = {step: [filename for filename in chunk if needs(filename, step)] for step in image_steps}
+        print(f"\n--- In-Process Chunk {chunk_index + 1}/{chunk_count}: {len(chunk)} images ---")
+
+        # Detection decodes only the frames the cache and the prefilter leave to it
+        # and hands its full-resolution buffers on to the later steps
+        images = {}
+        if step_files.get('detect'):
+            detected = detect_and_log.detect_and_create_csv(
+                args.input_dir, None, FIELD_ORDER_STRING, batch_size=args.batch_size,
+                loader_workers=args.loader_workers, prefetch_depth=args.prefetch_depth,
+                detection_model=detection_model,
+                image_paths=[os.path.join(args.input_dir, filename) for filename in step_files['detect']],
+                cache=cache, prefilter_threshold=prefilter_threshold(args), reduced_decode=args.reduced_decode,
+                context_filenames=folder_files, keep_images=images)
+            for filename in step_files['detect']:
+                records_by_image.pop(filename, None)
+            for record in detected:
+                records_by_image.setdefault(record['Image_Filename'], []).append(record)
+
+        # Images that could not be read or detected have no rows; they stay pending for every step
+        failed = [filename for filename in step_files.get('detect', []) if filename not in records_by_image]
+        if failed:
+            step_files = {step: [filename for filename in files if filename not in failed]
+                          for step, files in step_files.items()}
+
+        # Decode the rest once for classify and visualize; empty frames are skipped.
+        # With reduced decode, classify decodes its own smaller copies.
+        decode_steps = ('visualize',) if args.reduced_decode else ('classify', 'visualize')
+        to_decode = set()
+        for step in decode_steps:
+            to_decode.update(filename for filename in step_files.get(step, [])
+                             if has_detections(filename) and filename not in images)
+        decoded = iter_decoded_images(args.input_dir, [f for f in chunk if f in to_decode],
+                                      workers=args.loader_workers, depth=args.prefetch_depth)
+        for filename, img, error in profiling.timed_iter(decoded, 'decode'):
+            # Unreadable images are reported by the individual steps
+            if error is None:
+                images[filename] = img
+
+        def step_records(step):
+            return [record for filename in step_files[step] for record in records_by_image.get(filename, [])]
+
+        if step_files.get('metadata'):
+            extract_metadata.update_metadata(args.input_dir, None, FIELD_ORDER_STRING,
+                                             records=step_records('metadata'), images=images,
+                                             context_filenames=folder_files)
+        if step_files.get('classify'):
+            classify_data.update_csv_data(args.input_dir, None, FIELD_ORDER_STRING, batch_size=args.clf_batch_size,
+                                          classification_model=classification_model,
+                                          records=step_records('classify'),
+                                          images=None if args.reduced_decode else images, cache=cache,
+                                          per_event=args.per_event, reduced_decode=args.reduced_decode,
+                                          crop_store=crop_store)
+        if step_files.get('sort'):
+            sort_images.sort_images_by_detection(args.input_dir, None, args.sorted, records=step_records('sort'),
+                                                 link_mode=args.link_mode, per_event=args.per_event)
+        if step_files.get('visualize'):
+            annotate_images.process_visual_outputs(args.input_dir, None, args.annotated, args.crops,
+                                                   records=step_records('visualize'), images=images,
+                                                   workers=args.visualize_workers, max_side=args.annotate_max_side,
+                                                   prerender=args.prerender_annotated, crop_store=crop_store)
+
+        # Checkpoint so an interrupted run resumes after the last finished chunk
+        if manifest is not None:
+            with profiling.substep('checkpoint'):
+                manifest.mark_failed('detect', failed)
+                for step in image_steps:
+                    manifest.mark_done(step, step_files[step])
+                save_records(all_records(), args.csv)
+                manifest.save()
+
+    # Steps that change the log write it once for the whole run
+    if manifest is None and {'detect', 'metadata', 'classify'}.intersection(steps):
+        with profiling.substep('write'):
+            save_records(all_records(), args.csv)
+        print(f"\nData for {len(all_records())} detections saved to: {args.csv}")
+
+    if 'json' in steps:
+        export_to_json.create_researcher_json(args.csv, args.json_output, records=all_records(),
+                                              output_format=args.json_format, per_event=args.per_event)
+        if manifest is not None:
+            manifest.mark_done('json', filenames)
+            manifest.save()
+
+    if cache is not None:
+        cache.close()
+    if crop_store is not None:
+        crop_store.close()
+
+    return all_records()
+
+def run_watching(args, manifest):
+    """
+    Loads the models once and streams new images from args.input_dir until stopped
+    (see watch_pipeline.run_watch). The JSON export runs once the watch ends.
+    """
+    import detect_and_log
+    import classify_data
+    import export_to_json
+    from inference_cache import InferenceCache
+    from crop_store import CropStore
+    from watch_pipeline import run_watch
+
+    detection_model = detect_and_log.load_detection_model(args.detector_backend)
+    classification_model = (classify_data.load_classification_model(args.classifier_backend)
+                            if 'classify' in args.steps else None)
+    cache = InferenceCache(args.cache, max_bytes=args.cache_max_mb * 1024 * 1024) if args.cache else None
+    crop_store = CropStore(args.crop_store) if args.crop_store else None
+    try:
+        run_watch(args, manifest, detection_model, classification_model, cache=cache, crop_store=crop_store,
+                  poll_interval=args.poll_interval, idle_exit=args.idle_exit)
+    finally:
+        if cache is not None:
+            cache.close()
+        if crop_store is not None:
+            crop_store.close()
+
+    if 'json' in args.steps:
+        export_to_json.create_researcher_json(args.csv, args.json_output, output_format=args.json_format,
+                                              per_event=args.per_event)
+
+def run_sharded(args):
+    """
+    Runs this machine as one worker of a sharded run (see shard_pipeline).
+
+    The first worker splits the images of args.input_dir into shards in the
+    queue at args.shard_queue. Every worker then leases shards and runs the
+    detect, metadata, classify and visualize steps on them in-process, writing
+    one partial log per shard. Models are loaded once, on the first lease.
+    Once all shards are done, one worker merges the partial logs into args.csv
+    and runs the sort and json steps on the merged log.
+    """
+    import detect_and_log
+    import classify_data
+    import sort_images
+    import export_to_json
+    from image_loader import list_images
+    from shard_pipeline import ShardQueue, plan_shards, run_shard_worker, WORKER_STEPS
+
+    shard_queue = ShardQueue(args.shard_queue, lease_seconds=args.lease_seconds)
+    if not shard_queue.is_planned():
+        shards = plan_shards(list_images(args.input_dir), args.shard_by, args.shards)
+        if shard_queue.plan(shards):
+            print(f"Planned {len(shards)} shards ({args.shard_by}) for {sum(map(len, shards.values()))} images in {args.shard_queue}")
+
+    worker_steps = [step for step in args.steps if step in WORKER_STEPS]
+    models = {}
+
+    def process_shard(filenames, log_path):
+        if not models:
+            with profiling.substep('load_models'):
+                models['detect'] = detect_and_log.load_detection_model(args.detector_backend)
+                models['classify'] = (classify_data.load_classification_model(args.classifier_backend)
+                                      if 'classify' in worker_steps else None)
+        shard_args = argparse.Namespace(**vars(args))
+        shard_args.csv, shard_args.steps = log_path, worker_steps
+        run_in_process(shard_args, detection_model=models['detect'], classification_model=models['classify'],
+                       filenames=filenames)
+
+    def merge(records, held):
+        # Each output is only written while this worker still holds the merge lease
+        if not held():
+            return
+        with profiling.substep('write'):
+            save_records(records, args.csv)
+        print(f"Merged log of {len(records)} detections saved to: {args.csv}")
+        if 'sort' in args.steps and held():
+            sort_images.sort_images_by_detection(args.input_dir, None, args.sorted, records=records,
+                                                 link_mode=args.link_mode, per_event=args.per_event)
+        if 'json' in args.steps and held():
+            export_to_json.create_researcher_json(args.csv, args.json_output, records=records,
+                                                  output_format=args.json_format, per_event=args.per_event)
+
+    parts_dir = f"{os.path.splitext(args.shard_queue)[0]}_parts"
+    try:
+        return run_shard_worker(shard_queue, parts_dir, process_shard, merge,
+                                log_ext=os.path.splitext(args.csv)[1] or '.csv')
+    finally:
+        shard_queue.close()
+
+def run_as_subprocesses(args, manifest=None):
+    """
+    Runs each selected step as its own script, in the order given by args.steps.
+
+    With a PipelineManifest, each step only gets the images that still need it
+    (via --images-from). Detection merges its rows into the existing log. The
+    manifest is saved after every successful step, so a rerun resumes at the
+    step that failed.
+    """
+    from image_loader import list_images, write_image_list
+
+    all_files = []
+    if manifest is not None:
+        all_files = list_images(args.input_dir)
+        changed = manifest.refresh(args.input_dir, all_files)
+        print(f"Manifest: {len(changed)} new or changed images out of {len(all_files)}.")
+
+    loader_args = ['--loader-workers', str(args.loader_workers), '--prefetch-depth', str(args.prefetch_depth)]
+    event_args = ['--per-event'] if args.per_event else []
+    decode_args = ['--reduced-decode'] if args.reduced_decode else []
+    thread_args = threads_args(args)
+    if args.cache:
+        loader_args += ['--cache', args.cache, '--cache-max-mb', str(args.cache_max_mb)]
+    store_args = ['--crop-store', args.crop_store] if args.crop_store else []
+
+    # Execute Pipeline
+    for step in args.steps:
+        script = PIPELINE_STEPS[step]
+        success = False
+
+        # Restrict the step to the images that still need it
+        incremental_args = []
+        if manifest is not None:
+            pending = manifest.pending(step, all_files)
+            if not pending:
+                print(f"\n--- Skipping Step: {script} (all {len(all_files)} images up to date) ---")
+                continue
+            if step != 'json':
+                list_path = f"{args.manifest}.{step}.pending"
+                write_image_list(pending, list_path)
+                incremental_args = ['--images-from', list_path] + (['--merge'] if step == 'detect' else [])
+    
+        # Pass the field order string to scripts that write or update the CSV
+        if step == 'detect':
+            prefilter_args = ['--prefilter', '--prefilter-threshold', str(args.prefilter_threshold)] if args.prefilter else []
+            success = execute_step(script, [args.input_dir, args.csv, FIELD_ORDER_STRING,
+                                            '--batch-size', str(args.batch_size), '--backend', args.detector_backend]
+                                           + thread_args + loader_args + decode_args + prefilter_args + incremental_args)
+    
+        elif step == 'metadata':
+            success = execute_step(script, [args.input_dir, args.csv, FIELD_ORDER_STRING] + incremental_args)
         
+        elif step == 'classify':
+            success = execute_step(script, [args.input_dir, args.csv, FIELD_ORDER_STRING,
+                                            '--batch-size', str(args.clf_batch_size), '--backend', args.classifier_backend]
+                                           + thread_args + loader_args + decode_args + event_args + store_args + incremental_args)
+        
+        elif step == 'sort':
+            # sort_images.py only READS the CSV
+            success = execute_step(script, [args.input_dir, args.csv, args.sorted,
+                                            '--link-mode', args.link_mode] + event_args + incremental_args)
+
+        elif step == 'visualize':
+            # annotate_images.py reads the CSV and needs both output dirs
+            max_side_args = ['--max-side', str(args.annotate_max_side)] if args.annotate_max_side else []
+            prerender_args = ['--prerender'] if args.prerender_annotated else []
+            success = execute_step(script, [args.input_dir, args.csv, args.annotated, args.crops,
+                                            '--workers', str(args.visualize_workers)]
+                                           + max_side_args + prerender_args + store_args + incremental_args)
+        
+        elif step == 'json':
+            # JSON export needs the final CSV path and the output JSON path
+            success = execute_step(script, [args.csv, args.json_output, '--format', args.json_format] + event_args)
+        
+        if not success:
+            print(f"\nPipeline failed at step: {step}. Stopping execution.")
+            sys.exit(1)
+
+        if manifest is not None:
+            # Images the detector could not read or process have no rows in the log; they are retried next run
+            if step == 'detect':
+                logged = {record['Image_Filename'] for record in load_records(args.csv)}
+                manifest.mark_failed('detect', [filename for filename in pending if filename not in logged])
+                pending = [filename for filename in pending if filename in logged]
+            manifest.mark_done(step, pending, order=args.steps)
+            manifest.save()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Run the PytorchWildlife detection and classification pipeline.")
@@ -63,52 +429,149 @@ if __name__ == '__main__':
     parser.add_argument('--json', dest='json_output', default=DEFAULT_JSON,
                         help=f"Output file path for the standardized JSON data. (Default: {DEFAULT_JSON})")
     
+    parser.add_argument('--json-format', dest='json_format', choices=['json', 'compact', 'jsonl'], default=DEFAULT_JSON_FORMAT,
+                        help=f"Layout of the JSON export; a '.gz' --json path is gzipped. (Default: {DEFAULT_JSON_FORMAT})")
+    
     parser.add_argument('--sorted', dest='sorted', default=DEFAULT_SORTED,
                         help=f"Output directory for sorted 'empty' and 'non-empty' images. (Default: {DEFAULT_SORTED})")
     parser.add_argument('--annotated', dest='annotated', default=DEFAULT_ANNOTATED,
                         help=f"Output directory for annotated images with bounding boxes and labels. (Default: {DEFAULT_ANNOTATED})")
     parser.add_argument('--crops', dest='crops', default=DEFAULT_CROPS,
                         help=f"Output directory for cropped images (with species subfolders). (Default: {DEFAULT_CROPS})")
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"Number of images per MegaDetector forward pass. (Default: {DEFAULT_BATCH_SIZE})")
+    parser.add_argument('--clf-batch-size', dest='clf_batch_size', type=int, default=DEFAULT_CLF_BATCH_SIZE,
+                        help=f"Number of animal crops per classifier forward pass. (Default: {DEFAULT_CLF_BATCH_SIZE})")
+    parser.add_argument('--visualize-workers', dest='visualize_workers', type=int, default=DEFAULT_VISUALIZE_WORKERS,
+                        help=f"Worker processes for annotation and cropping. (Default: {DEFAULT_VISUALIZE_WORKERS})")
+    parser.add_argument('--loader-workers', dest='loader_workers', type=int, default=DEFAULT_LOADER_WORKERS,
+                        help=f"Number of background image decode workers for detect and classify. (Default: {DEFAULT_LOADER_WORKERS})")
+    parser.add_argument('--prefetch-depth', dest='prefetch_depth', type=int, default=DEFAULT_PREFETCH_DEPTH,
+                        help=f"Maximum number of decoded images queued ahead of the models. (Default: {DEFAULT_PREFETCH_DEPTH})")
+    parser.add_argument('--reduced-decode', dest='reduced_decode', action='store_true',
+                        help="Let detect and classify decode JPEGs at the smallest DCT scale their models still need (not with --watch).")
+    parser.add_argument('--annotate-max-side', dest='annotate_max_side', type=int, default=None,
+                        help="Render annotated images and crops at most this many pixels on the longest side (default: full resolution).")
+    parser.add_argument('--detector-backend', dest='detector_backend', choices=DETECTOR_BACKENDS, default=DEFAULT_BACKEND,
+                        help=f"Inference backend for MegaDetector (see inference_backend.py). (Default: {DEFAULT_BACKEND})")
+    parser.add_argument('--classifier-backend', dest='classifier_backend', choices=CLASSIFIER_BACKENDS, default=DEFAULT_BACKEND,
+                        help=f"Inference backend for the classifier, including 'int8' (dynamic quantization of the Linear layers only; convolutions stay float). (Default: {DEFAULT_BACKEND})")
+    parser.add_argument('--threads', dest='threads', type=int, default=None,
+                        help="Intra-op threads for inference (default: the library's choice).")
+    parser.add_argument('--interop-threads', dest='interop_threads', type=int, default=None,
+                        help="Inter-op threads for inference (default: the library's choice).")
+    parser.add_argument('--link-mode', dest='link_mode', choices=list(LINK_MODE_FALLBACKS), default=DEFAULT_LINK_MODE,
+                        help=f"How the sort step places images: copies, links, or moves ('auto' picks the cheapest). (Default: {DEFAULT_LINK_MODE})")
+    parser.add_argument('--cache', dest='cache', default=None,
+                        help="SQLite inference cache shared by detect and classify; unchanged images are not re-run.")
+    parser.add_argument('--crop-store', dest='crop_store', default=None,
+                        help="Directory of a crop store shared by classify and visualize; each animal crop is cut once.")
+    parser.add_argument('--prerender-annotated', dest='prerender_annotated', action='store_true',
+                        help="Let the visualize step also write every annotated image (default: only crops; render_service.py draws them on request).")
+    parser.add_argument('--cache-max-mb', dest='cache_max_mb', type=int, default=DEFAULT_CACHE_MAX_MB,
+                        help=f"Size limit of the inference cache before LRU eviction. (Default: {DEFAULT_CACHE_MAX_MB})")
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+                        help="Only process new or changed images and resume interrupted runs, using the manifest.")
+    parser.add_argument('--manifest', dest='manifest', default=DEFAULT_MANIFEST,
+                        help=f"Per-image stage manifest used by --incremental. (Default: {DEFAULT_MANIFEST})")
+    parser.add_argument('--in-process', dest='in_process', action='store_true',
+                        help="Run all steps in this process on a shared in-memory record table, decoding each image once.")
+    parser.add_argument('--prefilter', dest='prefilter', action='store_true',
+                        help="Skip MegaDetector on frames that are static within their burst and against the camera's background.")
+    parser.add_argument('--prefilter-threshold', dest='prefilter_threshold', type=float, default=DEFAULT_PREFILTER_THRESHOLD,
+                        help=f"Largest fraction of changed thumbnail pixels for a static frame. (Default: {DEFAULT_PREFILTER_THRESHOLD})")
+    parser.add_argument('--per-event', dest='per_event', action='store_true',
+                        help="Treat bursts as capture events: classify once per tracked animal, sort and export per event.")
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        help="Keep running and stream new images through the steps as they appear in input_dir.")
+    parser.add_argument('--poll-interval', dest='poll_interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help=f"Seconds between scans of input_dir in --watch mode. (Default: {DEFAULT_POLL_INTERVAL})")
+    parser.add_argument('--idle-exit', dest='idle_exit', type=float, default=None,
+                        help="In --watch mode, stop after this many seconds without new images.")
+    parser.add_argument('--shard-queue', dest='shard_queue', default=None,
+                        help="Run as one worker of a sharded run, leasing image shards from this SQLite queue (start one per node).")
+    parser.add_argument('--shard-by', dest='shard_by', choices=SHARD_MODES, default=DEFAULT_SHARD_BY,
+                        help=f"How images are split into shards: by SD-card roll or by filename hash. (Default: {DEFAULT_SHARD_BY})")
+    parser.add_argument('--shards', dest='shards', type=int, default=DEFAULT_SHARDS,
+                        help=f"Number of shards for --shard-by hash. (Default: {DEFAULT_SHARDS})")
+    parser.add_argument('--lease-seconds', dest='lease_seconds', type=float, default=DEFAULT_LEASE_SECONDS,
+                        help=f"Seconds without a heartbeat before a worker's shard is handed to another worker. (Default: {DEFAULT_LEASE_SECONDS})")
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help="Write per-stage timings, throughput, latency percentiles and peak RSS to this JSON report.")
+    parser.add_argument('--profiler', dest='profiler', choices=profiling.PROFILERS, default=None,
+                        help="Also record a call profile for each step next to the --profile report.")
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f"Images decoded and held in memory at once in --in-process mode. (Default: {DEFAULT_CHUNK_SIZE})")
 
     args = parser.parse_args()
+
+    # Moving the originals would leave nothing for the steps that read them after sorting
+    if args.link_mode == 'move' and 'sort' in args.steps and 'visualize' in args.steps:
+        parser.error("--link-mode move removes the input images before the visualize step; run visualize separately first.")
     
     # Ensure base output directories exist
     os.makedirs(os.path.dirname(args.csv) or '.', exist_ok=True)
     os.makedirs(os.path.dirname(args.json_output) or '.', exist_ok=True)
     os.makedirs(args.sorted, exist_ok=True)
-    os.makedirs(args.annotated, exist_ok=True)
+    if args.prerender_annotated:
+        os.makedirs(args.annotated, exist_ok=True)
     os.makedirs(args.crops, exist_ok=True)
 
-    # Execute Pipeline
-    for step in args.steps:
-        script = PIPELINE_STEPS[step]
-        success = False
-        
-        # Pass the field order string to scripts that write or update the CSV
-        if step == 'detect':
-            success = execute_step(script, [args.input_dir, args.csv, FIELD_ORDER_STRING])
-        
-        elif step == 'metadata':
-            success = execute_step(script, [args.input_dir, args.csv, FIELD_ORDER_STRING])
-            
-        elif step == 'classify':
-            success = execute_step(script, [args.input_dir, args.csv, FIELD_ORDER_STRING])
-            
-        elif step == 'sort':
-            # sort_images.py only READS the CSV
-            success = execute_step(script, [args.input_dir, args.csv, args.sorted])
+    if args.watch and 'detect' not in args.steps:
+        parser.error("--watch streams new images from detection onwards; include 'detect' in --steps.")
+    if args.watch and args.reduced_decode:
+        parser.error("--reduced-decode is not available with --watch, whose decode stage shares full-resolution images between the steps.")
+    if args.watch and is_pack_dir(args.input_dir):
+        parser.error("--watch looks for new image files; a packed input directory only grows through its writer.")
+    if args.shard_queue and 'detect' not in args.steps:
+        parser.error("--shard-queue builds each shard's log from detection onwards; include 'detect' in --steps.")
+    if args.shard_queue and (args.watch or args.incremental):
+        parser.error("--shard-queue tracks progress per shard; it cannot be combined with --watch or --incremental.")
 
-        elif step == 'visualize':
-            # annotate_images.py reads the CSV and needs both output dirs
-            success = execute_step(script, [args.input_dir, args.csv, args.annotated, args.crops])
-            
-        elif step == 'json':
-            # JSON export needs the final CSV path and the output JSON path
-            success = execute_step(script, [args.csv, args.json_output])
-            
-        if not success:
-            print(f"\nPipeline failed at step: {step}. Stopping execution.")
-            sys.exit(1)
+    # Watch mode always tracks progress in the manifest, so a restart skips finished images
+    manifest = PipelineManifest(args.manifest) if args.incremental or args.watch else None
+
+    if args.profile:
+        # Steps run as scripts inherit these and add their stages to the same report
+        os.environ[profiling.PROFILE_ENV] = args.profile
+        if args.profiler:
+            os.environ[profiling.PROFILER_ENV] = args.profiler
+        if os.path.exists(args.profile):
+            os.remove(args.profile)
+
+    if (args.threads or args.interop_threads) and (args.watch or args.in_process or args.shard_queue):
+        from inference_backend import configure_threads
+        configure_threads(args.threads, args.interop_threads)
+
+    with profiling.profile_run(args.profile, args.profiler), profiling.stage('pipeline'):
+        if args.shard_queue:
+            try:
+                merged = run_sharded(args)
+            except Exception:
+                traceback.print_exc()
+                print("\nShard worker failed. Stopping execution.")
+                sys.exit(1)
+            if not merged:
+                sys.exit(1)
+        elif args.watch:
+            try:
+                run_watching(args, manifest)
+            except Exception:
+                traceback.print_exc()
+                print("\nWatch mode failed. Stopping execution.")
+                sys.exit(1)
+        elif args.in_process:
+            try:
+                run_in_process(args, manifest=manifest)
+            except Exception:
+                traceback.print_exc()
+                print("\nIn-process pipeline failed. Stopping execution.")
+                sys.exit(1)
+        else:
+            run_as_subprocesses(args, manifest=manifest)
+        if args.profile:
+            from image_loader import list_images
+            profiling.add_images(len(list_images(args.input_dir)))
 
     print("\n\n✅ Pipeline finished successfully!")
     print(f"Final data exported to CSV: {args.csv}")
@@ -0,0 +1,370 @@
+# shard_pipeline.py
+import os
+import re
+import time
+import zlib
+import json
+import socket
+import sqlite3
+import argparse
+import threading
+import traceback
+from capture_events import parse_capture_name
+from record_store import load_records
+
+# --- CONFIGURATION ---
+SHARD_BY = 'roll' # 'roll' puts each SD-card roll (e.g. S5_B04_R1) in its own shard; 'hash' spreads files by name
+SHARD_COUNT = 16 # Number of shards for 'hash' (and for names without a roll prefix)
+LEASE_SECONDS = 600 # A shard whose worker stops renewing its lease for this long goes back to the queue
+MAX_ATTEMPTS = 3 # Leases a shard gets before it is marked failed
+POLL_SECONDS = 10 # How often an idle worker checks for expired leases while other workers finish
+# ---------------------
+
+SHARD_MODES = ['roll', 'hash']
+
+# Steps each worker runs on its shard; the rest run once, on the merged log
+WORKER_STEPS = ('detect', 'metadata', 'classify', 'visualize')
+MERGE_STEPS = ('sort', 'json')
+
+def shard_key(filename, shard_by=SHARD_BY, shards=SHARD_COUNT):
+    """
+    Returns the shard ID of an image filename.
+
+    With 'roll', this is the season/site/roll prefix of camera-trap names, so
+    every burst stays within one shard. Other names, and every name with
+    'hash', go to one of `shards` buckets by CRC32 of the filename, which is the
+    same on every machine.
+    """
+    if shard_by == 'roll':
+        camera, _ = parse_capture_name(filename)
+        if camera:
+            return camera
+    return f"hash-{zlib.crc32(filename.encode('utf-8')) % shards:04d}"
+
+def plan_shards(filenames, shard_by=SHARD_BY, shards=SHARD_COUNT):
+    """Returns {shard_id: sorted filenames} for the given images."""
+    planned = {}
+    for filename in sorted(filenames):
+        planned.setdefault(shard_key(filename, shard_by, shards), []).append(filename)
+    return planned
+
+class ShardQueue:
+    """
+    Durable queue of image shards, stored in SQLite.
+
+    A shard is 'pending', 'leased' to one worker, 'done' or 'failed'. Workers
+    lease shards in a transaction, so two workers never hold the same shard,
+    and renew the lease while they work. A shard whose lease runs out (its
+    worker died or lost the network) is leased again, up to max_attempts
+    times. The queue also records which worker merges the finished shards.
+    The file must sit on a filesystem with working locks shared by every
+    worker (a local disk when all workers run on one machine).
+    """
+
+    def __init__(self, db_path, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # Autocommit mode; every change below runs in its own BEGIN IMMEDIATE transaction
+        self._conn = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS shards ("
+            " shard_id TEXT PRIMARY KEY,"
+            " files TEXT NOT NULL,"
+            " state TEXT NOT NULL DEFAULT 'pending',"
+            " worker TEXT,"
+            " lease_expires REAL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " last_error TEXT)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS merge ("
+            " id INTEGER PRIMARY KEY CHECK (id = 1),"
+            " state TEXT NOT NULL,"
+            " worker TEXT,"
+            " lease_expires REAL)"
+        )
+
+    def _transaction(self, work):
+        """Runs work(connection) inside one write transaction and returns its result."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def is_planned(self):
+        """True once shards have been added to the queue."""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM shards").fetchone()[0] > 0
+
+    def plan(self, shards):
+        """Adds {shard_id: filenames} to an empty queue; returns False if another worker planned it first."""
+        def work(conn):
+            if conn.execute("SELECT COUNT(*) FROM shards").fetchone()[0]:
+                return False
+            conn.executemany("INSERT INTO shards (shard_id, files) VALUES (?, ?)",
+                             [(shard_id, json.dumps(files)) for shard_id, files in sorted(shards.items())])
+            return True
+        return self._transaction(work)
+
+    def lease(self, worker):
+        """Leases the next pending or expired shard to worker, returning (shard_id, filenames) or None."""
+        def work(conn):
+            now = time.time()
+            # Shards whose last allowed lease ran out are given up on
+            conn.execute("UPDATE shards SET state = 'failed', last_error = COALESCE(last_error, 'lease expired') "
+                         "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?", (now, self.max_attempts))
+            row = conn.execute("SELECT shard_id, files, attempts FROM shards "
+                               "WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+                               "ORDER BY attempts, shard_id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            shard_id, files, attempts = row
+            conn.execute("UPDATE shards SET state = 'leased', worker = ?, lease_expires = ?, attempts = ? "
+                         "WHERE shard_id = ?", (worker, now + self.lease_seconds, attempts + 1, shard_id))
+            return shard_id, json.loads(files)
+        return self._transaction(work)
+
+    def renew(self, shard_id, worker):
+        """Extends worker's lease on a shard; returns False if the lease was lost to another worker."""
+        def work(conn):
+            return conn.execute("UPDATE shards SET lease_expires = ? WHERE shard_id = ? AND state = 'leased' AND worker = ?",
+                                (time.time() + self.lease_seconds, shard_id, worker)).rowcount == 1
+        return self._transaction(work)
+
+    def complete(self, shard_id, worker):
+        """Marks a shard done; returns False if worker no longer held its lease."""
+        def work(conn):
+            return conn.execute("UPDATE shards SET state = 'done', lease_expires = NULL "
+                                "WHERE shard_id = ? AND state = 'leased' AND worker = ?", (shard_id, worker)).rowcount == 1
+        return self._transaction(work)
+
+    def release(self, shard_id, worker, error):
+        """Returns a shard that failed on worker to the queue, or marks it failed after max_attempts."""
+        def work(conn):
+            conn.execute("UPDATE shards SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                         "lease_expires = NULL, last_error = ? WHERE shard_id = ? AND state = 'leased' AND worker = ?",
+                         (self.max_attempts, error, shard_id, worker))
+        self._transaction(work)
+
+    def retry_failed(self):
+        """Puts failed shards back in the queue with a fresh set of attempts; returns how many."""
+        def work(conn):
+            count = conn.execute("UPDATE shards SET state = 'pending', attempts = 0, worker = NULL "
+                                 "WHERE state = 'failed'").rowcount
+            if count:
+                conn.execute("DELETE FROM merge")
+            return count
+        return self._transaction(work)
+
+    def counts(self):
+        """Returns {state: number of shards}, counting expired leases as 'pending'."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT CASE WHEN state = 'leased' AND lease_expires < ? THEN 'pending' ELSE state END, COUNT(*) "
+                "FROM shards GROUP BY 1", (time.time(),)).fetchall()
+        return dict(rows)
+
+    def shards(self, state=None):
+        """Returns [(shard_id, filenames, state, worker, attempts, last_error)], optionally for one state."""
+        query = "SELECT shard_id, files, state, worker, attempts, last_error FROM shards"
+        with self._lock:
+            rows = (self._conn.execute(query + " WHERE state = ? ORDER BY shard_id", (state,)) if state
+                    else self._conn.execute(query + " ORDER BY shard_id")).fetchall()
+        return [(shard_id, json.loads(files), *rest) for shard_id, files, *rest in rows]
+
+    def claim_merge(self, worker):
+        """Claims the merge for worker once every shard is done; False if it is done or another worker holds it."""
+        def work(conn):
+            now = time.time()
+            if conn.execute("SELECT COUNT(*) FROM shards WHERE state != 'done'").fetchone()[0]:
+                return False
+            row = conn.execute("SELECT state, lease_expires FROM merge WHERE id = 1").fetchone()
+            if row is not None and (row[0] == 'done' or row[1] >= now):
+                return False
+            conn.execute("INSERT OR REPLACE INTO merge (id, state, worker, lease_expires) VALUES (1, 'leased', ?, ?)",
+                         (worker, now + self.lease_seconds))
+            return True
+        return self._transaction(work)
+
+    def renew_merge(self, worker):
+        """Extends worker's lease on the merge; returns False if the lease was lost to another worker."""
+        def work(conn):
+            return conn.execute("UPDATE merge SET lease_expires = ? WHERE id = 1 AND state = 'leased' AND worker = ?",
+                                (time.time() + self.lease_seconds, worker)).rowcount == 1
+        return self._transaction(work)
+
+    def finish_merge(self, worker):
+        """Records that worker finished the merge; returns False if worker no longer held the merge lease."""
+        def work(conn):
+            return conn.execute("UPDATE merge SET state = 'done', lease_expires = NULL "
+                                "WHERE id = 1 AND state = 'leased' AND worker = ?", (worker,)).rowcount == 1
+        return self._transaction(work)
+
+    def merge_done(self):
+        """True once the finished shards have been merged."""
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM merge WHERE id = 1").fetchone()
+        return row is not None and row[0] == 'done'
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class LeaseHeartbeat(threading.Thread):
+    """
+    Renews a lease in the background until stopped, noting whether the lease
+    was lost. renew() extends the lease and returns False once it is lost
+    (ShardQueue.renew for a shard, ShardQueue.renew_merge for the merge).
+    """
+
+    def __init__(self, renew, lease_seconds):
+        super().__init__(daemon=True)
+        self.renew = renew
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._stop_event = threading.Event()
+
+    def held(self):
+        """Renews the lease now; True while it is still held."""
+        if not self.lost and not self.renew():
+            self.lost = True
+        return not self.lost
+
+    def run(self):
+        while not self._stop_event.wait(self.lease_seconds / 3):
+            if not self.held():
+                return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def part_path(parts_dir, shard_id, log_ext='.csv'):
+    """Returns the path of a shard's partial detection log."""
+    return os.path.join(parts_dir, f"{shard_id}{log_ext}")
+
+def merge_partial_logs(parts_dir, shard_ids, log_ext='.csv'):
+    """
+    Concatenates the partial logs of the given shards into one record list.
+
+    Rows are ordered by image filename and Detection_Index, so the merged log
+    is the same whichever workers produced the shards and in which order.
+    """
+    records = []
+    for shard_id in sorted(shard_ids):
+        records.extend(load_records(part_path(parts_dir, shard_id, log_ext)))
+    records.sort(key=lambda record: (record['Image_Filename'], int(record['Detection_Index'])))
+    return records
+
+def run_shard_worker(shard_queue, parts_dir, process_shard, merge, log_ext='.csv', worker=None,
+                     poll_seconds=POLL_SECONDS):
+    """
+    Works through shard_queue until every shard is done or failed, then merges.
+
+    process_shard(filenames, log_path) runs the worker steps on one shard and
+    writes its partial log to log_path. The log is written under a temporary
+    name and renamed once complete, so a half-written part is never merged. A
+    shard that raises goes back to the queue. While other workers still hold
+    leases, an idle worker waits, so it can take over shards whose worker
+    died. The worker that claims the merge calls merge(records, held) with
+    the merged log, renewing the merge lease while it runs. merge should call
+    held() before writing each output and stop once it returns False, so a
+    worker whose lease was taken over never publishes alongside the new one.
+    Returns False if some shards failed for good or the merge lease was lost.
+    """
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    # Workers on different hosts can share a pid, so temporary parts are named by the whole worker id
+    worker_tag = re.sub(r'[^\w.-]', '_', worker)
+    os.makedirs(parts_dir, exist_ok=True)
+    processed = 0
+
+    while True:
+        lease = shard_queue.lease(worker)
+        if lease is None:
+            counts = shard_queue.counts()
+            if counts.get('pending') or counts.get('leased'):
+                # Other workers are still busy; one of their leases may yet expire
+                time.sleep(poll_seconds)
+                continue
+            break
+
+        shard_id, filenames = lease
+        print(f"\n=== Shard {shard_id}: {len(filenames)} images (worker {worker}) ===")
+        final_path = part_path(parts_dir, shard_id, log_ext)
+        tmp_path = os.path.join(parts_dir, f"{shard_id}.{worker_tag}.tmp{log_ext}")
+        heartbeat = LeaseHeartbeat(lambda: shard_queue.renew(shard_id, worker), shard_queue.lease_seconds)
+        heartbeat.start()
+        try:
+            process_shard(filenames, tmp_path)
+            os.replace(tmp_path, final_path)
+        except Exception as error:
+            traceback.print_exc()
+            print(f"Shard {shard_id} failed; returning it to the queue.")
+            shard_queue.release(shard_id, worker, f"{type(error).__name__}: {error}")
+            continue
+        finally:
+            heartbeat.stop()
+
+        if heartbeat.lost or not shard_queue.complete(shard_id, worker):
+            # Another worker took over after our lease expired; its identical part wins
+            print(f"Warning: the lease on shard {shard_id} expired while it ran; leaving it to the new worker.")
+        else:
+            processed += 1
+
+    counts = shard_queue.counts()
+    print(f"\n--- Shard Worker {worker} Finished: processed {processed} shards ---")
+    print("Queue: " + ", ".join(f"{counts[state]} {state}" for state in sorted(counts)))
+    failed = shard_queue.shards('failed')
+    if failed:
+        for shard_id, _, _, _, attempts, last_error in failed:
+            print(f"  Failed shard {shard_id} after {attempts} attempts: {last_error}")
+        print("Not merging until the failed shards are done (see `python shard_pipeline.py --retry-failed`).")
+        return False
+
+    if shard_queue.claim_merge(worker):
+        print(f"\n=== Merging {sum(counts.values())} shards ===")
+        done = shard_queue.shards('done')
+        heartbeat = LeaseHeartbeat(lambda: shard_queue.renew_merge(worker), shard_queue.lease_seconds)
+        heartbeat.start()
+        try:
+            merge(merge_partial_logs(parts_dir, [shard_id for shard_id, *_ in done], log_ext), heartbeat.held)
+        finally:
+            heartbeat.stop()
+        if heartbeat.lost or not shard_queue.finish_merge(worker):
+            print("Warning: the merge lease expired while merging; leaving the merge to the worker that took it over.")
+            return False
+    elif shard_queue.merge_done():
+        print("The shards have already been merged.")
+    else:
+        print("Another worker is merging the shards.")
+    return True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Shows the state of a sharded pipeline run's queue.")
+    parser.add_argument("shard_queue", type=str, help="Path to the SQLite shard queue (run_pipeline.py --shard-queue).")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Put failed shards back in the queue; re-run the workers to process and merge them.")
+    args = parser.parse_args()
+    if not os.path.exists(args.shard_queue):
+        raise SystemExit(f"Error: No shard queue at {args.shard_queue}")
+
+    shard_queue = ShardQueue(args.shard_queue)
+    if args.retry_failed:
+        print(f"Re-queued {shard_queue.retry_failed()} failed shards.")
+    counts = shard_queue.counts()
+    print(f"--- Shard Queue: {args.shard_queue} ---")
+    print(", ".join(f"{counts[state]} {state}" for state in sorted(counts)) or "empty")
+    for shard_id, filenames, state, worker, attempts, last_error in shard_queue.shards():
+        if state != 'done':
+            detail = f" ({last_error})" if last_error else ""
+            print(f"  {shard_id}: {state}, {len(filenames)} images, {attempts} attempts, worker {worker or '-'}{detail}")
+    print(f"Merged: {'yes' if shard_queue.merge_done() else 'no'}")
+    shard_queue.close()
\ No newline at end of file
@@ -1,26 +1,114 @@
 # sort_images.py
 import os
-import csv
+import time
 import argparse
 import shutil
+import errno
+from concurrent.futures import ThreadPoolExecutor
+from capture_events import record_event_id
+from image_loader import packed_member, read_image_list
+from record_store import load_records
+import profiling
 
 # --- CONFIGURATION ---
 MD_CONF_THRES = 0.1 # Confidence threshold for detection
+LINK_MODE = 'copy' # How images are placed into the sorted folders (see LINK_MODE_FALLBACKS)
+COPY_WORKERS = 8 # Threads placing files concurrently
+PER_EVENT = False # Sort whole capture events into one subfolder each instead of single frames
 # ---------------------
 
-def load_csv_data(csv_path):
-    """Loads all records from the CSV file."""
-    with open(csv_path, 'r', newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        return list(reader)
+# Strategies tried in order for each --link-mode; 'auto' picks the cheapest the filesystem supports
+LINK_MODE_FALLBACKS = {
+    'auto': ['reflink', 'hardlink', 'copy'],
+    'copy': ['copy'],
+    'hardlink': ['hardlink', 'copy'],
+    'symlink': ['symlink', 'copy'],
+    'reflink': ['reflink', 'copy'],
+    'move': ['move'],
+}
 
-def sort_images_by_detection(input_dir, input_csv_path, output_dir):
-    """Sorts and copies images based on the presence of detections."""
+# Linux ioctl that shares a file's extents with another file (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+def reflink_file(src_path, dst_path):
+    """Creates dst_path as a copy-on-write clone of src_path, or raises OSError if unsupported."""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(dst_path)
+            raise
+
+def place_file(src_path, dst_path, link_mode):
+    """
+    Puts src_path at dst_path with the first strategy for link_mode that works.
+
+    Returns the strategy that was used. A missing source raises FileNotFoundError.
+    Other failures (cross-device links, no reflink support) fall through to the
+    next strategy. Packed images (see image_pack.py) have no file of their own
+    to link or move, so their bytes are always copied out of the shard.
+    """
+    pack, filename = packed_member(src_path)
+    if pack is not None:
+        _, mtime_ns = pack.stat(filename)
+        if os.path.lexists(dst_path):
+            os.remove(dst_path)
+        with open(dst_path, 'wb') as f:
+            f.write(pack.view(filename))
+        os.utime(dst_path, ns=(mtime_ns, mtime_ns))
+        return 'copy'
+
+    if not os.path.exists(src_path):
+        raise FileNotFoundError(src_path)
+
+    strategies = LINK_MODE_FALLBACKS[link_mode]
+    for i, strategy in enumerate(strategies):
+        # Re-runs replace what a previous run left behind
+        if os.path.lexists(dst_path) and strategy != 'move':
+            os.remove(dst_path)
+        try:
+            if strategy == 'reflink':
+                reflink_file(src_path, dst_path)
+            elif strategy == 'hardlink':
+                os.link(src_path, dst_path)
+            elif strategy == 'symlink':
+                os.symlink(os.path.abspath(src_path), dst_path)
+            elif strategy == 'move':
+                shutil.move(src_path, dst_path)
+            else:
+                shutil.copy2(src_path, dst_path)
+            return strategy
+        except OSError:
+            if i == len(strategies) - 1:
+                raise
+
+@profiling.timed_stage('sort')
+def sort_images_by_detection(input_dir, input_csv_path, output_dir, records=None, only_files=None,
+                             link_mode=LINK_MODE, workers=COPY_WORKERS, per_event=PER_EVENT):
+    """
+    Sorts and copies images based on the presence of detections (from the CSV or an in-memory record table).
+
+    link_mode selects how files are placed: 'copy' duplicates them, 'hardlink',
+    'symlink' and 'reflink' only touch metadata (falling back to a copy where
+    the filesystem refuses), 'move' relocates the originals, and 'auto' picks
+    the cheapest supported option. Files are placed by a thread pool.
+
+    With per_event, a capture event (Event_ID) is non-empty if any of its frames
+    is, and all its frames go into a subfolder named after the event.
+    """
     
-    all_records = load_csv_data(input_csv_path)
+    all_records = records if records is not None else load_records(input_csv_path)
     if not all_records:
         print("Error: Input CSV is empty or cannot be read.")
         return
+    if only_files is not None:
+        only_files = set(only_files)
+        all_records = [record for record in all_records if record['Image_Filename'] in only_files]
 
     # Determine which images are non-empty
     non_empty_files = set()
@@ -33,34 +121,66 @@ def sort_images_by_detection(input_dir, input_csv_path, output_dir):
     processed_files = set(record['Image_Filename'] for record in all_records)
     empty_files = processed_files - non_empty_files
 
+    # Per-event mode: keep the frames of a burst together
+    event_of = {}
+    if per_event:
+        event_of = {record['Image_Filename']: record_event_id(record) for record in all_records}
+        non_empty_events = {event_of[filename] for filename in non_empty_files}
+        non_empty_files = {filename for filename in processed_files if event_of[filename] in non_empty_events}
+        empty_files = processed_files - non_empty_files
+
     # Create output directories
     non_empty_path = os.path.join(output_dir, 'non-empty')
     empty_path = os.path.join(output_dir, 'empty')
     os.makedirs(non_empty_path, exist_ok=True)
     os.makedirs(empty_path, exist_ok=True)
 
-    copied_count = 0
-    
-    # Copy files
+    # Plan where each file goes
+    placements = []
+    event_dirs = set()
     for filename in processed_files:
         src_path = os.path.join(input_dir, filename)
         
         if filename in non_empty_files:
-            dst_path = os.path.join(non_empty_path, filename)
+            dst_dir = non_empty_path
         elif filename in empty_files:
-            dst_path = os.path.join(empty_path, filename)
+            dst_dir = empty_path
         else:
             continue
+        if per_event:
+            dst_dir = os.path.join(dst_dir, event_of[filename])
+            if dst_dir not in event_dirs:
+                os.makedirs(dst_dir, exist_ok=True)
+                event_dirs.add(dst_dir)
+        placements.append((src_path, os.path.join(dst_dir, filename)))
+
+    # Per-file placement times (list.append is thread-safe)
+    latencies = []
 
+    def place(paths):
+        src_path, dst_path = paths
+        start = time.perf_counter()
         try:
-            shutil.copy2(src_path, dst_path)
-            copied_count += 1
+            strategy = place_file(src_path, dst_path, link_mode)
         except FileNotFoundError:
             print(f"Warning: Source file not found: {src_path}")
+            return None
+        latencies.append(time.perf_counter() - start)
+        return strategy
+
+    with profiling.substep('place'):
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            strategies_used = [strategy for strategy in executor.map(place, placements) if strategy]
+    profiling.add_latencies(latencies)
 
     print(f"\n--- Image Sorting Complete ---")
-    print(f"Total files copied: {copied_count}")
+    print(f"Total files placed: {len(strategies_used)}")
+    if strategies_used:
+        breakdown = ", ".join(f"{strategy}: {strategies_used.count(strategy)}" for strategy in sorted(set(strategies_used)))
+        print(f"Placement ({link_mode}): {breakdown}")
     print(f"Non-Empty: {len(non_empty_files)} | Empty: {len(empty_files)}")
+    if per_event:
+        print(f"Events: {len(non_empty_events)} non-empty of {len(set(event_of.values()))}")
 
 
 if __name__ == '__main__':
@@ -68,5 +188,16 @@ if __name__ == '__main__':
     parser.add_argument("input_dir", type=str, help="Directory containing source images.")
     parser.add_argument("input_csv_path", type=str, help="Path to the Master Detection CSV file.")
     parser.add_argument("output_dir", type=str, help="Parent directory for 'empty' and 'non-empty' subfolders.")
+    parser.add_argument("--images-from", type=str, default=None,
+                        help="File listing the image filenames to process (one per line).")
+    parser.add_argument("--link-mode", choices=list(LINK_MODE_FALLBACKS), default=LINK_MODE,
+                        help=f"How images are placed into the sorted folders. (Default: {LINK_MODE})")
+    parser.add_argument("--workers", type=int, default=COPY_WORKERS,
+                        help=f"Number of threads placing files. (Default: {COPY_WORKERS})")
+    parser.add_argument("--per-event", action="store_true", default=PER_EVENT,
+                        help="Sort whole capture events into one subfolder each (an event is non-empty if any frame is).")
     args = parser.parse_args()
-    sort_images_by_detection(args.input_dir, args.input_csv_path, args.output_dir)
\ No newline at end of file
+    with profiling.profile_run():
+        sort_images_by_detection(args.input_dir, args.input_csv_path, args.output_dir,
+                                 only_files=read_image_list(args.images_from) if args.images_from else None,
+                                 link_mode=args.link_mode, workers=args.workers, per_event=args.per_event)
\ No newline at end of file
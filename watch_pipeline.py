@@ -0,0 +1,214 @@
+# watch_pipeline.py
+import os
+import time
+import queue
+import threading
+import traceback
+from image_loader import iter_decoded_images
+from record_store import MASTER_FIELD_ORDER, load_records, save_records, append_records
+
+# --- CONFIGURATION ---
+POLL_INTERVAL = 2.0 # Seconds between scans of the watched folder
+STAGE_QUEUE_DEPTH = 4 # Batches waiting between two stages; bounds memory when a stage falls behind
+# ---------------------
+
+FIELD_ORDER_STRING = ",".join(MASTER_FIELD_ORDER)
+
+# Marks the end of the stream as it passes down the stage chain
+END_OF_STREAM = None
+
+def scan_folder(input_dir):
+    """Returns {filename: (size, mtime_ns)} for the input images in input_dir (same '*.jpg' match as list_images)."""
+    snapshot = {}
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.jpg') and entry.is_file():
+                stat = entry.stat()
+                snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+class StageThread(threading.Thread):
+    """
+    One link of the stage chain: takes a batch from `inbox`, applies `work` and
+    passes the batch on to `outbox`. END_OF_STREAM is forwarded after the last
+    batch. If any stage has failed, the remaining batches are drained without
+    being processed, so no stage blocks on a full queue while the watcher stops.
+    """
+
+    def __init__(self, name, work, inbox, outbox, errors):
+        super().__init__(name=name, daemon=True)
+        self.work, self.inbox, self.outbox, self.errors = work, inbox, outbox, errors
+
+    def run(self):
+        while True:
+            batch = self.inbox.get()
+            if batch is END_OF_STREAM:
+                break
+            if self.errors:
+                continue
+            try:
+                self.work(batch)
+            except Exception:
+                self.errors.append((self.name, traceback.format_exc()))
+                continue
+            if self.outbox is not None:
+                self.outbox.put(batch)
+        if self.outbox is not None:
+            self.outbox.put(END_OF_STREAM)
+
+def run_watch(args, manifest, detection_model, classification_model, cache=None, crop_store=None,
+              poll_interval=POLL_INTERVAL, idle_exit=None):
+    """
+    Watches args.input_dir and streams new or changed images through the pipeline.
+
+    A file is picked up once its size and mtime have not changed for one poll
+    interval, so images still being copied off an SD card are left alone. Files
+    travel in batches through a chain of threads: decode -> detect + metadata
+    -> classify -> sort + visualize -> log. While one batch is being classified,
+    the next is already being detected. Each finished batch is appended to the
+    log and checkpointed in the manifest. The watch runs until Ctrl+C, or until
+    no new image has arrived for idle_exit seconds. Returns the number of
+    images processed.
+    """
+    import detect_and_log
+    import extract_metadata
+    import classify_data
+    import sort_images
+    import annotate_images
+
+    steps = set(args.steps)
+    image_steps = [step for step in ('detect', 'metadata', 'classify', 'sort', 'visualize') if step in steps]
+    manifest_lock = threading.Lock()
+    errors = []
+
+    # Images already in the log; re-processing one means rewriting the log instead of appending
+    logged_files = set()
+    if os.path.exists(args.csv):
+        logged_files = {record['Image_Filename'] for record in load_records(args.csv)}
+
+    def decode(batch):
+        batch['images'] = {}
+        for filename, img, error in iter_decoded_images(args.input_dir, batch['filenames'],
+                                                        workers=args.loader_workers, depth=args.prefetch_depth):
+            if error is None:
+                batch['images'][filename] = img
+            else:
+                print(f"Warning: Could not read image {filename}: {error}. Skipping.")
+
+    def detect(batch):
+        readable = [filename for filename in batch['filenames'] if filename in batch['images']]
+        batch['records'] = detect_and_log.detect_and_create_csv(
+            args.input_dir, None, FIELD_ORDER_STRING, batch_size=args.batch_size,
+            detection_model=detection_model,
+            image_paths=[os.path.join(args.input_dir, filename) for filename in readable],
+            images=batch['images'], cache=cache, context_filenames=batch['context'],
+            prefilter_threshold=args.prefilter_threshold if args.prefilter else None) if readable else []
+        if 'metadata' in steps and batch['records']:
+            extract_metadata.update_metadata(args.input_dir, None, FIELD_ORDER_STRING,
+                                             records=batch['records'], images=batch['images'],
+                                             context_filenames=batch['context'])
+
+    def classify(batch):
+        if 'classify' in steps and batch['records']:
+            classify_data.update_csv_data(args.input_dir, None, FIELD_ORDER_STRING, batch_size=args.clf_batch_size,
+                                          classification_model=classification_model,
+                                          records=batch['records'], images=batch['images'], cache=cache,
+                                          per_event=args.per_event, crop_store=crop_store)
+
+    def render(batch):
+        if 'sort' in steps and batch['records']:
+            sort_images.sort_images_by_detection(args.input_dir, None, args.sorted, records=batch['records'],
+                                                 link_mode=args.link_mode, per_event=args.per_event)
+        if 'visualize' in steps and batch['records']:
+            annotate_images.process_visual_outputs(args.input_dir, None, args.annotated, args.crops,
+                                                   records=batch['records'], images=batch['images'],
+                                                   max_side=args.annotate_max_side, prerender=args.prerender_annotated)
+        # The pixels are no longer needed once the last image stage is done
+        batch['images'] = None
+
+    def write_log(batch):
+        done = sorted({record['Image_Filename'] for record in batch['records']})
+        if logged_files.intersection(done):
+            kept = [record for record in load_records(args.csv) if record['Image_Filename'] not in set(done)]
+            save_records(kept + batch['records'], args.csv)
+        else:
+            append_records(batch['records'], args.csv)
+        logged_files.update(done)
+        # Unreadable files are retried only once they change on disk
+        for filename in set(batch['filenames']).difference(done):
+            try:
+                stat = os.stat(os.path.join(args.input_dir, filename))
+                unreadable[filename] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                pass
+        with manifest_lock:
+            manifest.mark_failed('detect', set(batch['filenames']).difference(done))
+            for step in image_steps:
+                manifest.mark_done(step, done)
+            manifest.save()
+        in_flight.difference_update(batch['filenames'])
+        totals['images'] += len(done)
+        print(f"[watch] Logged {len(batch['records'])} records for {len(done)} images "
+              f"({totals['images']} since start) to {args.csv}")
+
+    # Wire the chain; bounded queues make a slow stage hold back the ones before it
+    queues = [queue.Queue(maxsize=STAGE_QUEUE_DEPTH) for _ in range(5)]
+    chain = [StageThread('decode', decode, queues[0], queues[1], errors),
+             StageThread('detect', detect, queues[1], queues[2], errors),
+             StageThread('classify', classify, queues[2], queues[3], errors),
+             StageThread('render', render, queues[3], queues[4], errors),
+             StageThread('log', write_log, queues[4], None, errors)]
+    for thread in chain:
+        thread.start()
+
+    in_flight = set()
+    unreadable = {}
+    totals = {'images': 0}
+    previous = {}
+    last_activity = time.monotonic()
+    print(f"[watch] Watching {args.input_dir} every {poll_interval:g}s (Ctrl+C to stop)...")
+
+    try:
+        while not errors:
+            snapshot = scan_folder(args.input_dir)
+            # Only files that have stopped changing since the last scan are ready
+            settled = [filename for filename, stat in snapshot.items()
+                       if previous.get(filename) == stat and filename not in in_flight
+                       and unreadable.get(filename) != stat]
+            previous = snapshot
+
+            with manifest_lock:
+                manifest.refresh(args.input_dir, [filename for filename in settled
+                                                  if filename not in manifest.images
+                                                  or (manifest.images[filename]['size'],
+                                                      manifest.images[filename]['mtime_ns']) != snapshot[filename]])
+                ready = sorted(filename for filename in settled
+                               if any(manifest.needs(filename, step) for step in image_steps))
+
+            for start in range(0, len(ready), args.chunk_size):
+                filenames = ready[start:start + args.chunk_size]
+                in_flight.update(filenames)
+                # The scan's listing gives the prefilter its neighbouring frames without listing again
+                queues[0].put({'filenames': filenames, 'context': list(snapshot)})
+            if ready:
+                print(f"[watch] Queued {len(ready)} new images.")
+                last_activity = time.monotonic()
+            elif in_flight:
+                last_activity = time.monotonic()
+            elif idle_exit is not None and time.monotonic() - last_activity >= idle_exit:
+                print(f"[watch] No new images for {idle_exit:g}s. Stopping.")
+                break
+
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("\n[watch] Stopping; finishing the images already queued...")
+    finally:
+        queues[0].put(END_OF_STREAM)
+        for thread in chain:
+            thread.join()
+
+    for stage_name, error in errors:
+        print(f"ERROR in watch stage '{stage_name}':\n{error}")
+    if errors:
+        raise RuntimeError(f"Watch stage '{errors[0][0]}' failed.")
+    return totals['images']
\ No newline at end of file